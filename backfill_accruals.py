@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Скрипт для доначисления бонусов за отгрузки в диапазоне дат
+Проходит отгрузки МойСклад страницами с паузой и начисляет пропущенные,
+уведомления клиентам не отправляются
+
+Использование:
+    python backfill_accruals.py 2024-01-01 2024-02-01 [--throttle 1.0] [--restart]
+
+Прерванный запуск того же диапазона продолжается с места остановки,
+--restart проходит диапазон с начала
+"""
+
+import asyncio
+import argparse
+import logging
+from datetime import datetime, time
+
+from bot import db_postgres
+from bot.accrual import AccrualPipeline
+from bot.moysklad import MS_DEMANDS_PAGE_LIMIT
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Доначисление бонусов за период")
+    parser.add_argument("date_from", help="начало периода, YYYY-MM-DD")
+    parser.add_argument("date_to", help="конец периода включительно, YYYY-MM-DD")
+    parser.add_argument("--throttle", type=float, default=1.0, help="пауза между страницами, сек")
+    parser.add_argument("--page-size", type=int, default=MS_DEMANDS_PAGE_LIMIT,
+                        help=f"отгрузок на страницу, не больше {MS_DEMANDS_PAGE_LIMIT}")
+    parser.add_argument("--restart", action="store_true",
+                        help="пройти диапазон с начала, а не с сохранённой позиции")
+    args = parser.parse_args()
+    if not 1 <= args.page_size <= MS_DEMANDS_PAGE_LIMIT:
+        parser.error(f"--page-size должен быть от 1 до {MS_DEMANDS_PAGE_LIMIT}")
+
+    date_from = datetime.strptime(args.date_from, "%Y-%m-%d")
+    date_to = datetime.combine(datetime.strptime(args.date_to, "%Y-%m-%d"), time.max).replace(microsecond=0)
+
+    db_postgres.startup()
+    try:
+        pipeline = AccrualPipeline(page_size=args.page_size, notify=False)
+        seen = asyncio.run(pipeline.backfill(date_from, date_to, throttle=args.throttle, restart=args.restart))
+        print(f"✅ Просмотрено отгрузок: {seen}")
+    finally:
+        db_postgres.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
+import time
+import zlib
 import logging
 import asyncio
-from datetime import datetime, timezone
-from aiogram import Bot
-from .config import BOT_TOKEN, BONUS_RATE, MS_BASE, MSK
-from .db_postgres import change_balance, conn, get_tg_id_by_agent, get_loyalty_level, update_total_spent, add_bonus_transaction
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from .config import BONUS_RATE, MS_BASE, MSK, METRICS_PORT
+from .db_postgres import (
+    get_tg_id_by_agent, get_loyalty_level, record_accrual,
+    filter_processed_demands, load_recent_processed_demands,
+    get_accrual_cursor, set_accrual_cursor,
+    claim_outbox_events, complete_outbox_event, fail_outbox_event,
+    WorkerConnection
+)
 from .formatting import fmt_money
-from .moysklad import fetch_demands, fetch_demand_full
-from .loyalty import get_bonus_rate, get_level_up_message
+from .messenger import messenger
+from .metrics import accrual_metrics, serve_metrics, metrics_log_loop
+from .moysklad import fetch_demands_page, fetch_demand_full, MS_DEMANDS_PAGE_LIMIT
+from .loyalty import get_rules, get_level_up_message
+from .maintenance import extract_mileage
+from .analytics import invalidate_agent_analytics
 from dateutil import parser as dateparser, relativedelta
 
 log = logging.getLogger(__name__)
@@ -15,107 +29,147 @@ def doc_age_seconds(iso: str) -> float:
     ts = dateparser.isoparse(iso).replace(tzinfo=MSK)
     return (datetime.now(MSK) - ts).total_seconds()
 
-async def notify_user_about_demand(demand: dict, bonus_amount: int):
+# ─── Уведомления ───
+# Возвращают False, если сообщение не доставлено: диспетчер outbox повторит отправку
+
+async def notify_user_about_demand(agent_id: str, demand_sum: int, bonus_amount: int) -> bool:
     """Отправляет уведомление пользователю о готовой машине и бонусах"""
     try:
-        # Получаем agent_id из demand
-        agent_id = demand["agent"]["meta"]["href"].split("/")[-1]
         # Получаем tg_id пользователя
         tg_id = get_tg_id_by_agent(agent_id)
         
         if tg_id:
-            bot = Bot(token=BOT_TOKEN)
-            try:
-                message = (
-                    "🚗 <b>Ваша машина готова!</b>\n\n"
-                    f"💰 Сумма к оплате: <b>{fmt_money(demand['sum'])}</b>\n"
-                    f"✨ Будет начислено бонусов: <b>{fmt_money(bonus_amount)}</b>"
-                )
-                await bot.send_message(
-                    chat_id=tg_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                log.info(f"Notification sent to user {tg_id}")
-            except Exception as e:
-                log.error(f"Failed to send notification: {e}")
-            finally:
-                await bot.session.close()
+            message = (
+                "🚗 <b>Ваша машина готова!</b>\n\n"
+                f"💰 Сумма к оплате: <b>{fmt_money(demand_sum)}</b>\n"
+                f"✨ Будет начислено бонусов: <b>{fmt_money(bonus_amount)}</b>"
+            )
+            if not await messenger.send(tg_id, message, parse_mode="HTML"):
+                log.error(f"Failed to send notification to user {tg_id}")
+                return False
+            log.info(f"Notification sent to user {tg_id}")
+        return True
     except Exception as e:
         log.error(f"Error in notify_user_about_demand: {e}")
+        return False
 
 
-async def notify_user_about_purchase(demand: dict, bonus_amount: int, level_id: int):
+async def notify_user_about_purchase(agent_id: str, demand_sum: int, bonus_amount: int, level_id: int) -> bool:
     """Отправляет уведомление о начислении бонусов с учетом уровня"""
     from .loyalty import get_level_info
     
     try:
-        agent_id = demand["agent"]["meta"]["href"].split("/")[-1]
         tg_id = get_tg_id_by_agent(agent_id)
         
         if tg_id:
-            bot = Bot(token=BOT_TOKEN)
-            try:
-                level_info = get_level_info(level_id)
-                message = (
-                    f"🚗 <b>Ваша машина готова!</b>\n\n"
-                    f"💰 Сумма к оплате: <b>{fmt_money(demand['sum'])}</b>\n"
-                    f"✨ Начислено бонусов: <b>{fmt_money(bonus_amount)}</b>\n"
-                    f"🏆 Ваш статус: {level_info['emoji']} <b>{level_info['name']}</b> ({level_info['bonus_rate']*100:.0f}% бонусов)"
-                )
-                await bot.send_message(
-                    chat_id=tg_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                log.info(f"Purchase notification sent to user {tg_id}")
-            except Exception as e:
-                log.error(f"Failed to send purchase notification: {e}")
-            finally:
-                await bot.session.close()
+            level_info = get_level_info(level_id)
+            message = (
+                f"🚗 <b>Ваша машина готова!</b>\n\n"
+                f"💰 Сумма к оплате: <b>{fmt_money(demand_sum)}</b>\n"
+                f"✨ Начислено бонусов: <b>{fmt_money(bonus_amount)}</b>\n"
+                f"🏆 Ваш статус: {level_info['emoji']} <b>{level_info['name']}</b> ({level_info['bonus_rate']*100:.0f}% бонусов)"
+            )
+            if not await messenger.send(tg_id, message, parse_mode="HTML"):
+                log.error(f"Failed to send purchase notification to user {tg_id}")
+                return False
+            log.info(f"Purchase notification sent to user {tg_id}")
+        return True
     except Exception as e:
         log.error(f"Error in notify_user_about_purchase: {e}")
+        return False
 
 
-async def notify_level_up(agent_id: str, old_level: int, new_level: int):
+async def notify_level_up(agent_id: str, old_level: int, new_level: int) -> bool:
     """Отправляет уведомление о повышении уровня лояльности"""
     try:
         tg_id = get_tg_id_by_agent(agent_id)
         
         if tg_id:
-            bot = Bot(token=BOT_TOKEN)
-            try:
-                message = get_level_up_message(old_level, new_level)
-                await bot.send_message(
-                    chat_id=tg_id,
-                    text=message,
-                    parse_mode="HTML"
-                )
-                log.info(f"Level up notification sent to user {tg_id} (level {old_level} -> {new_level})")
-            except Exception as e:
-                log.error(f"Failed to send level up notification: {e}")
-            finally:
-                await bot.session.close()
+            message = get_level_up_message(old_level, new_level)
+            if not await messenger.send(tg_id, message, parse_mode="HTML"):
+                log.error(f"Failed to send level up notification to user {tg_id}")
+                return False
+            log.info(f"Level up notification sent to user {tg_id} (level {old_level} -> {new_level})")
+        return True
     except Exception as e:
         log.error(f"Error in notify_level_up: {e}")
+        return False
 
-async def accrue_for_demand(demand: dict) -> int:
-    aid = demand["agent"]["meta"]["href"].split("/")[-1]
+def demand_agent_id(demand: dict) -> str:
+    """Извлекает ID контрагента из отгрузки"""
+    return demand["agent"]["meta"]["href"].split("/")[-1]
+
+
+def product_category(position: dict) -> Optional[str]:
+    """Категория товара — верхняя группа в МойСклад (pathName)"""
+    path = position["assortment"].get("pathName")
+    return path.split("/")[0] if path else None
+
+
+@dataclass
+class AccrualResult:
+    """Результат начисления по отгрузке"""
+    demand: dict
+    agent_id: str
+    bonus_amount: int
+    level_id: int
+    level_update: Optional[dict] = None
+
+
+def accrual_events(demand: dict, bonus_amount: int, level_id: int,
+                   services: list, mileage: int, notify: bool = True) -> List[Tuple[str, dict]]:
+    """
+    События outbox для отгрузки: уведомления клиенту, показание пробега,
+    запись работ ТО и начисление в дневной сводке
+    
+    Событие level_up добавляет record_accrual (тоже только при notify),
+    так как новый уровень известен только внутри транзакции.
+    """
+    events = []
+    if bonus_amount > 0:
+        # Сводки аналитики хранятся в SQLite, поэтому начисление попадает туда через outbox
+        events.append(("rollup", {"date": demand["moment"][:10], "accrued": bonus_amount}))
+    
+    if notify and bonus_amount > 0:
+        payload = {"sum": demand["sum"], "bonus_amount": bonus_amount, "level_id": level_id}
+        events.append(("purchase", payload))
+        events.append(("demand_ready", payload))
     
-    # Получаем текущий уровень клиента
+    if mileage > 0:
+        # Получаем дату отгрузки в формате YYYY-MM-DD
+        demand_date = datetime.fromisoformat(demand["moment"].replace("Z", "+00:00")).strftime("%Y-%m-%d")
+        events.append(("mileage", {"mileage": mileage, "date": demand_date}))
+    
+    if services and mileage > 0:
+        events.append(("maintenance", {
+            "services": [{"assortment": {"name": p["assortment"].get("name", "")}} for p in services],
+            "mileage": mileage,
+            "date": demand_date,
+        }))
+    return events
+
+
+def apply_accrual(demand: dict, notify: bool = True, rules=None) -> Optional[AccrualResult]:
+    """
+    Начисляет бонусы за отгрузку
+    
+    Начисление, запись в accrual_log и события outbox (уведомления и
+    работы ТО) фиксируются одной транзакцией; сами побочные эффекты
+    выполняет OutboxDispatcher. Если отгрузка уже обработана,
+    возвращается None. rules — правила уровней, полученные заранее
+    (при вызове из рабочего потока: get_rules читает SQLite бота).
+    """
+    aid = demand_agent_id(demand)
+    
+    # Получаем текущий уровень клиента и правила начисления
     loyalty_data = get_loyalty_level(aid)
     current_level = loyalty_data["level_id"]
-    bonus_rate = get_bonus_rate(current_level)
+    rules = rules or get_rules()
+    bonus_rate = rules.bonus_rate(current_level)
+    purchased_at = demand_moment(demand)
     
     # Получаем пробег из атрибутов отгрузки
-    mileage = 0
-    attributes = demand.get('attributes', [])
-    for attr in attributes:
-        if attr.get('name') == 'Пробег':
-            mileage_str = str(attr.get('value', '0'))
-            mileage_clean = ''.join(filter(str.isdigit, mileage_str))
-            mileage = int(mileage_clean) if mileage_clean else 0
-            break
+    mileage = extract_mileage(demand)
     
     # Рассчитываем сумму покупки (только товары, не услуги)
     purchase_amount = 0
@@ -126,73 +180,537 @@ async def accrue_for_demand(demand: dict) -> int:
         item_total = int(p["price"] * p["quantity"])
         purchase_amount += item_total
         
-        # Начисляем бонусы только с товаров
+        # Начисляем бонусы только с товаров, по ставке категории и с учётом акций
         if p["assortment"]["meta"]["type"] != "service":
-            bonus_amount += int(item_total * bonus_rate)
+            rate = rules.bonus_rate(current_level, product_category(p), purchased_at)
+            bonus_amount += int(item_total * rate)
         else:
             # Собираем услуги для анализа ТО
             services.append(p)
     
+    # Начисляем бонусы, записываем транзакцию, сумму трат и outbox вместе с accrual_log
+    description = f"Начисление за чек №{demand.get('name', demand['id'][:8])}"
+    events = accrual_events(demand, bonus_amount, current_level, services, mileage, notify)
+    level_update = record_accrual(aid, demand["id"], bonus_amount, purchase_amount, description, events,
+                                  notify=notify, rules=rules)
+    if level_update is None:
+        log.info(f"Demand {demand['id']} already processed, skipping")
+        return None
+    
+    # Начисление записано в Postgres, триггеры SQLite его не видят
+    invalidate_agent_analytics(aid)
+    
+    result = AccrualResult(demand=demand, agent_id=aid, bonus_amount=bonus_amount, level_id=current_level)
     if bonus_amount > 0:
-        # Начисляем бонусы
-        change_balance(aid, bonus_amount)
+        result.level_update = level_update
+        log.info("Accrued %s (rate: %.1f%%) → %s", fmt_money(bonus_amount), bonus_rate*100, aid)
+    
+    return result
+
+
+# ─── Outbox ───
+
+async def _handle_purchase(event: dict) -> bool:
+    payload = event["payload"]
+    return await notify_user_about_purchase(
+        event["agent_id"], payload["sum"], payload["bonus_amount"], payload["level_id"]
+    )
+
+
+async def _handle_demand_ready(event: dict) -> bool:
+    payload = event["payload"]
+    return await notify_user_about_demand(event["agent_id"], payload["sum"], payload["bonus_amount"])
+
+
+async def _handle_level_up(event: dict) -> bool:
+    payload = event["payload"]
+    return await notify_level_up(event["agent_id"], payload["old_level"], payload["new_level"])
+
+
+async def _handle_maintenance(event: dict) -> bool:
+    # process_moysklad_services идемпотентен: повторная запись по demand_id пропускается
+    from .maintenance import process_moysklad_services
+    
+    payload = event["payload"]
+    process_moysklad_services(
+        event["agent_id"], event["demand_id"], payload["services"], payload["mileage"], payload["date"]
+    )
+    log.info(f"Processed {len(payload['services'])} services for maintenance tracking")
+    return True
+
+
+async def _handle_mileage(event: dict) -> bool:
+    from .maintenance import record_mileage
+    
+    payload = event["payload"]
+    return record_mileage(
+        event["agent_id"], payload["mileage"], payload["date"], event["demand_id"], source="accrual"
+    )
+
+
+async def _handle_rollup(event: dict) -> bool:
+    from .db import record_accrual_rollup
+    
+    payload = event["payload"]
+    return record_accrual_rollup(event["demand_id"], payload["date"], payload["accrued"])
+
+
+OUTBOX_HANDLERS = {
+    "purchase": _handle_purchase,
+    "level_up": _handle_level_up,
+    "demand_ready": _handle_demand_ready,
+    "maintenance": _handle_maintenance,
+    "mileage": _handle_mileage,
+    "rollup": _handle_rollup,
+}
+
+# События без уведомлений клиенту: только их backfill доставляет сам
+BACKFILL_EVENT_TYPES = ["rollup", "mileage", "maintenance"]
+# Сколько отгрузок backfill передаётся в одну выборку outbox
+OUTBOX_DRAIN_CHUNK = 500
+
+
+class OutboxDispatcher:
+    """
+    Доставляет события accrual_outbox (at-least-once)
+    
+    События одного клиента обрабатываются по порядку, разные клиенты —
+    параллельно (до concurrency одновременно). Неудачные события
+    откладываются с экспоненциальной задержкой.
+    """
+    
+    def __init__(self, batch_size: int = 50, poll_interval: float = 5.0, concurrency: int = 4):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+    
+    async def _deliver(self, event: dict):
+        handler = OUTBOX_HANDLERS.get(event["event_type"])
+        stage = {"maintenance": "maintenance", "mileage": "maintenance", "rollup": "rollup"}.get(event["event_type"], "notify")
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError(f"unknown event type {event['event_type']}")
+            delivered = await handler(event)
+            error = None if delivered else "delivery failed"
+            if not delivered:
+                accrual_metrics.error(stage, "DeliveryFailed")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            accrual_metrics.error(stage, e)
+        accrual_metrics.observe(stage, time.perf_counter() - started)
         
-        # Записываем транзакцию
-        description = f"Начисление за чек №{demand.get('name', demand['id'][:8])}"
-        add_bonus_transaction(aid, "accrual", bonus_amount, description, demand['id'])
+        if error is None:
+            accrual_metrics.inc("outbox_delivered")
+            complete_outbox_event(event["id"])
+        else:
+            log.warning(f"Outbox event {event['id']} ({event['event_type']}) failed: {error}")
+            fail_outbox_event(event["id"], event["attempts"], error)
+    
+    async def _deliver_agent(self, events: list):
+        async with self.semaphore:
+            for event in events:
+                await self._deliver(event)
+    
+    async def dispatch_once(self, demand_ids: Optional[List[str]] = None,
+                            event_types: Optional[List[str]] = None) -> int:
+        """
+        Забирает и доставляет одну пачку событий; возвращает их количество
         
-        # Обновляем общую сумму трат и проверяем повышение уровня
-        level_update = update_total_spent(aid, purchase_amount)
+        demand_ids и event_types — доставить только события этих отгрузок и типов.
+        """
+        events = claim_outbox_events(self.batch_size, demand_ids=demand_ids, event_types=event_types)
+        by_agent: dict = {}
+        for event in events:
+            by_agent.setdefault(event["agent_id"], []).append(event)
+        await asyncio.gather(*(self._deliver_agent(group) for group in by_agent.values()))
+        return len(events)
+    
+    async def run(self):
+        """Разбирает outbox до отмены"""
+        while True:
+            try:
+                if await self.dispatch_once() == self.batch_size:
+                    continue
+            except Exception as e:
+                log.error(f"Error dispatching outbox: {e}")
+            
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+
+async def accrue_for_demand(demand: dict) -> int:
+    """
+    Начисляет бонусы за отгрузку и сразу доставляет её события из outbox
+    
+    События других отгрузок остаются фоновому диспетчеру.
+    """
+    result = apply_accrual(demand)
+    if result is None:
+        return 0
+    try:
+        await OutboxDispatcher().dispatch_once(demand_ids=[demand["id"]])
+    except Exception as e:
+        log.error(f"Error dispatching outbox: {e}")
+    return result.bonus_amount
+
+
+def _accrue_in_thread(session: WorkerConnection, demand: dict, notify: bool, rules) -> Optional[AccrualResult]:
+    """apply_accrual на соединении воркера (выполняется в рабочем потоке)"""
+    with session:
+        return apply_accrual(demand, notify=notify, rules=rules)
+
+
+class RecentDemands:
+    """Недавно обработанные отгрузки: не больше maxsize, старые вытесняются первыми"""
+    
+    def __init__(self, maxsize: int, demand_ids=()):
+        self.maxsize = maxsize
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self.update(demand_ids)
+    
+    def __contains__(self, demand_id) -> bool:
+        return demand_id in self._ids
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+    
+    def add(self, demand_id: str):
+        self._ids[demand_id] = None
+        self._ids.move_to_end(demand_id)
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+    
+    def update(self, demand_ids):
+        for demand_id in demand_ids:
+            self.add(demand_id)
+
+
+def _shard(agent_id: str, shards: int) -> int:
+    """Номер воркера для клиента: все отгрузки клиента попадают к одному воркеру"""
+    return zlib.crc32(agent_id.encode()) % shards
+
+
+# ─── Сканер отгрузок ───
+
+LIVE_CURSOR = "live"
+BACKFILL_CURSOR = "backfill"
+# С какого момента начинать, если курсора ещё нет
+INITIAL_LOOKBACK = timedelta(days=1)
+# Живой сканер идёт по updated: отгрузка, переведённая в «Отгружен» позже
+# своего moment, попадает в выборку в момент смены статуса
+LIVE_FIELD = "updated"
+# Повторный просмотр хвоста: изменения, сохранённые в МойСклад с задержкой
+RESCAN_OVERLAP = timedelta(minutes=30)
+# Сколько обработанных отгрузок помнить в памяти; вытесненные отсеивает accrual_log
+PROCESSED_CACHE_SIZE = 10000
+
+
+def backfill_cursor_name(date_from: datetime, date_to: datetime) -> str:
+    """Курсор backfill для диапазона: разные диапазоны не сдвигают позиции друг друга"""
+    return f"{BACKFILL_CURSOR}:{_fmt_moment(date_from)}:{_fmt_moment(date_to)}"
+
+
+def demand_position(demand: dict, field: str = "moment") -> datetime:
+    """moment или updated отгрузки с точностью до секунды (как в фильтрах МойСклад)"""
+    return datetime.strptime(demand[field][:19], "%Y-%m-%d %H:%M:%S")
+
+
+def demand_moment(demand: dict) -> datetime:
+    """moment отгрузки с точностью до секунды"""
+    return demand_position(demand, "moment")
+
+
+def _fmt_moment(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _now_msk() -> datetime:
+    return datetime.now(MSK).replace(tzinfo=None)
+
+
+class AccrualPipeline:
+    """
+    Конвейер начисления бонусов
+    
+    scan → dedupe → accrual, этапы связаны ограниченными очередями;
+    уведомления и записи ТО доставляет OutboxDispatcher из accrual_outbox.
+    Сканер идёт по отгрузкам вперёд от сохранённого курсора страницами,
+    пока не догонит текущий момент, поэтому всплеск отгрузок между опросами
+    или простой бота не приводит к пропуску начислений. Живой курсор
+    следует за updated, а не за датой документа: отгрузка, получившая
+    статус «Отгружен» спустя часы или дни, всё равно будет начислена.
+    Этап начисления разбит на воркеры по agent_id, поэтому отгрузки одного
+    клиента обрабатываются строго по порядку, а медленная отправка в
+    Telegram не задерживает начисление.
+    """
+    
+    def __init__(self, poll_interval: int = 30, page_size: int = 100,
+                 accrual_workers: int = 4, notify_workers: int = 4, queue_size: int = 100,
+                 notify: bool = True):
+        self.poll_interval = poll_interval
+        # МойСклад отдаёт не больше MS_DEMANDS_PAGE_LIMIT строк, и по короткой
+        # странице сканер понимает, что догнал конец выборки
+        self.page_size = min(page_size, MS_DEMANDS_PAGE_LIMIT)
+        self.notify = notify
+        # Очередь страниц отгрузок: одна страница на один запрос к МойСклад
+        self.dedupe_queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.accrual_queues = [asyncio.Queue(queue_size) for _ in range(accrual_workers)]
+        self.dispatcher = OutboxDispatcher(concurrency=notify_workers)
+        # Отгрузки, которые уже в конвейере, но ещё не записаны в accrual_log
+        self.in_flight: set = set()
+        # Отгрузки, начисленные за запуск backfill (в живом режиме не копятся)
+        self.accrued_ids: Optional[list] = None
+        # Недавно обработанные отгрузки (загружаются при старте конвейера)
+        self.processed = RecentDemands(PROCESSED_CACHE_SIZE)
+        # Позиции (scan_field) отгрузок текущей страницы, начисление по которым упало
+        self.failed: list = []
+        # Поле, по которому идёт текущий проход сканера
+        self.scan_field: str = "moment"
+        # Отставание курсора от текущего времени после последнего прохода, сек
+        self.lag_seconds: float = 0.0
+        # Последний проход дошёл до конца выборки и курсор не задержан сбоем
+        self.caught_up: bool = False
+    
+    async def scan(self, moment_from: datetime, moment_to: Optional[datetime] = None,
+                   cursor_name: Optional[str] = None, throttle: float = 0.0,
+                   floor: Optional[datetime] = None, field: str = "moment") -> Tuple[datetime, int]:
+        """
+        Проходит отгрузки от moment_from вперёд по field (moment или updated),
+        пока не догонит moment_to (или «сейчас»)
         
-        log.info("Accrued %s (rate: %.1f%%) → %s", fmt_money(bonus_amount), bonus_rate*100, aid)
+        Каждая страница полностью проходит начисление до запроса следующей.
+        Курсор сохраняется после каждой страницы, но не уходит дальше первой
+        отгрузки, начисление по которой не удалось: следующий проход начнёт с неё.
+        floor — позиция, ниже которой курсор не опускается (при повторном
+        просмотре хвоста перед уже сохранённым курсором).
+        
+        Returns:
+            (позиция курсора, число просмотренных отгрузок)
+        """
+        position = moment_from
+        committed = max(moment_from, floor) if floor else moment_from
+        blocked_at: Optional[datetime] = None
+        offset = 0
+        seen = 0
+        self.caught_up = False
+        self.scan_field = field
         
-        # Отправляем уведомление о начислении
-        await notify_user_about_purchase(demand, bonus_amount, current_level)
+        while True:
+            with accrual_metrics.stage("fetch"):
+                page = await asyncio.to_thread(
+                    fetch_demands_page, _fmt_moment(position),
+                    _fmt_moment(moment_to) if moment_to else None, self.page_size, offset,
+                    field=field
+                )
+            if not page:
+                self.caught_up = blocked_at is None
+                break
+            seen += len(page)
+            accrual_metrics.inc("seen", len(page))
+            
+            self.failed = []
+            await self.dedupe_queue.put(page)
+            await self.dedupe_queue.join()
+            await asyncio.gather(*(q.join() for q in self.accrual_queues))
+            
+            if self.failed and blocked_at is None:
+                blocked_at = min(self.failed)
+                log.warning(f"Accrual failed for demands at {_fmt_moment(blocked_at)}, cursor held there")
+            
+            last = demand_position(page[-1], field)
+            if last == position:
+                # Страница целиком из одной секунды — сдвигаемся смещением
+                offset += len(page)
+            else:
+                position, offset = last, 0
+            
+            committed = blocked_at or position
+            if floor:
+                committed = max(committed, floor)
+            if cursor_name:
+                set_accrual_cursor(cursor_name, committed)
+            
+            if len(page) < self.page_size:
+                self.caught_up = blocked_at is None
+                break
+            if throttle:
+                await asyncio.sleep(throttle)
         
-        # Если уровень повысился, отправляем отдельное уведомление
-        if level_update["level_changed"]:
-            await notify_level_up(aid, level_update["old_level"], level_update["new_level"])
+        return committed, seen
     
-    # Анализируем услуги для автоматической записи в журнал ТО
-    if services and mileage > 0:
+    async def live_pass(self, cursor: datetime) -> datetime:
+        """Один проход живого сканера от курсора cursor; возвращает новый курсор"""
+        started = time.perf_counter()
+        cursor, seen = await self.scan(
+            cursor - RESCAN_OVERLAP, cursor_name=LIVE_CURSOR, floor=cursor, field=LIVE_FIELD
+        )
+        # Курсор стоит на последней отгрузке, поэтому в тихие часы разница
+        # с текущим временем растёт без реального отставания
+        self.lag_seconds = 0.0 if self.caught_up else (_now_msk() - cursor).total_seconds()
+        accrual_metrics.set_gauge("cursor_lag_seconds", self.lag_seconds)
+        accrual_metrics.observe("scan_pass", time.perf_counter() - started)
+        log.info(
+            f"Accrual scan: {seen} demands in {time.perf_counter() - started:.1f}s, "
+            f"cursor {_fmt_moment(cursor)}, lag {self.lag_seconds:.0f}s"
+        )
+        return cursor
+    
+    async def scan_stage(self):
+        """Периодически догоняет новые отгрузки от сохранённого курсора"""
+        cursor = get_accrual_cursor(LIVE_CURSOR) or _now_msk() - INITIAL_LOOKBACK
+        while True:
+            try:
+                cursor = await self.live_pass(cursor)
+            except Exception as e:
+                log.error(f"Error scanning demands: {e}")
+                accrual_metrics.error("scan", e)
+            
+            await asyncio.sleep(self.poll_interval)
+    
+    async def dedupe_stage(self):
+        """
+        Отбрасывает уже обработанные отгрузки и раздаёт новые по воркерам
+        
+        Сначала страница сверяется с набором в памяти, оставшиеся ID проверяются
+        в accrual_log одним запросом на всю страницу.
+        """
+        while True:
+            demands = await self.dedupe_queue.get()
+            try:
+                candidates = [
+                    d for d in demands
+                    if d["id"] not in self.processed and d["id"] not in self.in_flight
+                ]
+                accrual_metrics.inc("skipped", len(demands) - len(candidates))
+                if candidates:
+                    with accrual_metrics.stage("dedupe"):
+                        already = filter_processed_demands([d["id"] for d in candidates])
+                    self.processed.update(already)
+                    accrual_metrics.inc("skipped", len(already))
+                    for demand in candidates:
+                        if demand["id"] in already:
+                            continue
+                        self.in_flight.add(demand["id"])
+                        shard = _shard(demand_agent_id(demand), len(self.accrual_queues))
+                        await self.accrual_queues[shard].put(demand)
+            except Exception as e:
+                log.error(f"Error in dedupe stage: {e}")
+                accrual_metrics.error("dedupe_stage", e)
+                self.failed.extend(demand_position(d, self.scan_field) for d in demands)
+            finally:
+                self.dedupe_queue.task_done()
+    
+    async def accrual_worker(self, queue: asyncio.Queue):
+        """
+        Начисляет бонусы; побочные эффекты уходят в outbox той же транзакцией
+        
+        Запись в базу идёт в рабочем потоке на собственном соединении воркера,
+        поэтому воркеры пишут параллельно и не блокируют цикл событий бота.
+        """
+        session = WorkerConnection()
         try:
-            from .maintenance import process_moysklad_services
-            # Получаем дату отгрузки в формате YYYY-MM-DD
-            demand_date = datetime.fromisoformat(demand["moment"].replace("Z", "+00:00")).strftime("%Y-%m-%d")
-            process_moysklad_services(aid, demand["id"], services, mileage, demand_date)
-            log.info(f"Processed {len(services)} services for maintenance tracking")
-        except Exception as e:
-            log.error(f"Error processing maintenance services: {e}")
+            while True:
+                demand = await queue.get()
+                try:
+                    # Правила берутся в потоке цикла: get_rules читает SQLite бота
+                    rules = get_rules()
+                    with accrual_metrics.stage("db_write"):
+                        result = await asyncio.to_thread(_accrue_in_thread, session, demand, self.notify, rules)
+                    self.processed.add(demand["id"])
+                    if result:
+                        if self.accrued_ids is not None:
+                            self.accrued_ids.append(demand["id"])
+                        accrual_metrics.inc("accrued")
+                        accrual_metrics.observe_lag((_now_msk() - demand_moment(demand)).total_seconds())
+                        self.dispatcher.wakeup.set()
+                    else:
+                        accrual_metrics.inc("skipped")
+                except Exception as e:
+                    log.error(f"Error accruing demand {demand.get('id')}: {e}")
+                    self.failed.append(demand_position(demand, self.scan_field))
+                finally:
+                    self.in_flight.discard(demand["id"])
+                    queue.task_done()
+        finally:
+            session.close()
+    
+    def _start_workers(self, dispatch: bool = True) -> list:
+        self.processed = RecentDemands(PROCESSED_CACHE_SIZE, load_recent_processed_demands())
+        log.info(f"Loaded {len(self.processed)} recently processed demands")
+        accrual_metrics.register_gauge("in_flight", lambda: len(self.in_flight))
+        accrual_metrics.register_gauge(
+            "queue_depth", lambda: self.dedupe_queue.qsize() + sum(q.qsize() for q in self.accrual_queues)
+        )
+        tasks = [
+            asyncio.create_task(self.dedupe_stage()),
+            *(asyncio.create_task(self.accrual_worker(q)) for q in self.accrual_queues),
+        ]
+        if dispatch:
+            tasks.append(asyncio.create_task(self.dispatcher.run()))
+        return tasks
+    
+    async def run(self):
+        """Запускает все этапы и работает до отмены"""
+        tasks = [
+            *self._start_workers(),
+            asyncio.create_task(self.scan_stage()),
+            asyncio.create_task(metrics_log_loop()),
+        ]
+        if METRICS_PORT:
+            tasks.append(asyncio.create_task(self._serve_metrics()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def _serve_metrics(self):
+        # Эндпоинт метрик не должен останавливать конвейер (например, если порт занят)
+        try:
+            await serve_metrics()
+        except OSError as e:
+            log.error(f"Metrics endpoint disabled: {e}")
     
-    return bonus_amount
+    async def backfill(self, date_from: datetime, date_to: datetime, throttle: float = 1.0,
+                       restart: bool = False) -> int:
+        """
+        Доначисляет бонусы за отгрузки в диапазоне дат (пакетный режим)
+        
+        Страницы запрашиваются с паузой throttle. Уведомления клиентам не
+        создаются: в outbox попадают только сводки начислений, показания
+        пробега и записи ТО (BACKFILL_EVENT_TYPES). После прохода доставляются
+        только эти события отгрузок, начисленных этим запуском; общий outbox
+        (уведомления живого бота) backfill не разбирает. Позиция сохраняется
+        в курсоре этого диапазона, поэтому прерванный backfill того же диапазона
+        продолжается с места остановки; restart — пройти диапазон заново.
+        """
+        cursor_name = backfill_cursor_name(date_from, date_to)
+        saved = None if restart else get_accrual_cursor(cursor_name)
+        start = saved or date_from
+        
+        self.accrued_ids = []
+        tasks = self._start_workers(dispatch=False)
+        try:
+            cursor, seen = await self.scan(start, date_to, cursor_name=cursor_name, throttle=throttle)
+            # Доставляем события своих отгрузок, накопленные в outbox
+            for i in range(0, len(self.accrued_ids), OUTBOX_DRAIN_CHUNK):
+                chunk = self.accrued_ids[i:i + OUTBOX_DRAIN_CHUNK]
+                while await self.dispatcher.dispatch_once(chunk, BACKFILL_EVENT_TYPES):
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+        log.info(f"Backfill {_fmt_moment(start)} — {_fmt_moment(date_to)}: {seen} demands, cursor {_fmt_moment(cursor)}")
+        log.info(accrual_metrics.summary())
+        return seen
+
 
 async def accrual_loop():
     """Основной цикл начисления бонусов"""
     log.info("Accrual loop started...")
-    while True:
-        try:
-            # Получаем последние отгрузки
-            demands = fetch_demands(limit=10)
-            for demand in demands:
-                # Проверяем, обработана ли уже эта отгрузка
-                already = conn.execute(
-                    "SELECT 1 FROM accrual_log WHERE demand_id=?",
-                    (demand["id"],)
-                ).fetchone()
-                
-                if not already:
-                    # Если отгрузка новая - начисляем бонусы и отправляем уведомление
-                    bonus_amount = await accrue_for_demand(demand)
-                    if bonus_amount > 0:
-                        await notify_user_about_demand(demand, bonus_amount)
-                        conn.execute(
-                            "INSERT INTO accrual_log(demand_id) VALUES(?)",
-                            (demand["id"],)
-                        )
-                        conn.commit()
-        
-        except Exception as e:
-            log.error(f"Error in accrual loop: {e}")
-        
-        # Ждем 5 минут перед следующей проверкой
-        await asyncio.sleep(30)
+    await AccrualPipeline().run()
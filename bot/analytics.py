@@ -3,26 +3,88 @@
 Модуль аналитики и отчетов для системы лояльности
 """
 
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from .db import conn, get_agent_id, get_bonus_transactions
-from .moysklad import fetch_shipments, fetch_demand_full
+from typing import Callable, Dict, List, Optional, Tuple
+from .db import (conn, get_agent_id, get_bonus_transactions, get_client_rank, get_top_clients,
+                 get_period_rollup, get_level_rollup, get_bonus_totals, get_agent_data_version)
+from .moysklad import fetch_shipments_page
 from .formatting import fmt_money, fmt_date_local
 from .loyalty import get_level_info, LOYALTY_LEVELS
 
 
-def get_client_statistics(agent_id: str) -> Dict:
+# Догрузка из МойСклад отгрузок не старше стольких часов, ещё не синхронизированных
+STATS_TOP_UP_HOURS = 6
+
+# Кэш отрисованных экранов аналитики клиента
+VIEW_CACHE_TTL = 600        # секунд; экраны зависят и от текущей даты
+RANKING_VIEW_TTL = 300      # место меняется и от покупок других клиентов
+VIEW_CACHE_SIZE = 5000      # клиентов
+
+
+def _parse_moment(moment: str) -> datetime:
+    return datetime.fromisoformat(moment.replace("Z", "+00:00"))
+
+
+def _fetch_unsynced_shipments(agent_id: str, last_synced: Optional[str]) -> List[Dict]:
+    """Отгрузки клиента за последние STATS_TOP_UP_HOURS часов новее синхронизированных (один запрос)"""
+    since = (datetime.now() - timedelta(hours=STATS_TOP_UP_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    if last_synced and last_synced > since:
+        since = last_synced
+    try:
+        return fetch_shipments_page(agent_id, limit=100, cursor=since, direction="prev")["items"]
+    except Exception:
+        return []
+
+
+def get_client_statistics(agent_id: str, top_up: bool = False) -> Dict:
     """
     Получает статистику клиента: траты, посещения, экономия
-    """
-    # Получаем все отгрузки клиента
-    shipments = fetch_shipments(agent_id, limit=100)
     
-    if not shipments:
+    Считается одним агрегирующим запросом по синхронизированным отгрузкам
+    (contractor_shipments). С top_up=True дополнительно учитываются
+    отгрузки последних STATS_TOP_UP_HOURS часов, которые ещё не попали
+    в базу (один запрос к МойСклад).
+    """
+    current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    month_start = current_month.strftime("%Y-%m-%d %H:%M:%S")
+    
+    row = conn.execute("""
+        SELECT
+            COUNT(*),
+            COALESCE(SUM(sum), 0),
+            MIN(moment),
+            MAX(moment),
+            COALESCE(SUM(moment >= ?), 0),
+            COALESCE(SUM(CASE WHEN moment >= ? THEN sum ELSE 0 END), 0),
+            (SELECT COALESCE(SUM(amount), 0)
+             FROM bonus_transactions
+             WHERE agent_id = ? AND transaction_type = 'redemption')
+        FROM contractor_shipments
+        WHERE agent_id = ? AND moment IS NOT NULL
+    """, (month_start, month_start, agent_id, agent_id)).fetchone()
+    
+    total_visits, total_spent, first_moment, last_moment, visits_this_month, spent_this_month, total_saved = row
+    first_visit = _parse_moment(first_moment) if first_moment else None
+    last_visit = _parse_moment(last_moment) if last_moment else None
+    
+    if top_up:
+        for shipment in _fetch_unsynced_shipments(agent_id, last_moment):
+            moment = _parse_moment(shipment["moment"])
+            total_visits += 1
+            total_spent += shipment.get("sum", 0)
+            if moment >= current_month:
+                visits_this_month += 1
+                spent_this_month += shipment.get("sum", 0)
+            first_visit = min(first_visit, moment) if first_visit else moment
+            last_visit = max(last_visit, moment) if last_visit else moment
+    
+    if total_visits == 0:
         return {
             "total_spent": 0,
             "total_visits": 0,
-            "total_saved": 0,
+            "total_saved": total_saved,
             "avg_check": 0,
             "first_visit": None,
             "last_visit": None,
@@ -31,111 +93,47 @@ def get_client_statistics(agent_id: str) -> Dict:
             "period_days": 0
         }
     
-    # Базовая статистика
-    total_spent = sum(s["sum"] for s in shipments)
-    total_visits = len(shipments)
-    
-    # Даты первого и последнего визита
-    dates = [datetime.fromisoformat(s["moment"].replace("Z", "+00:00")) for s in shipments]
-    first_visit = min(dates)
-    last_visit = max(dates)
-    period_days = (last_visit - first_visit).days + 1
-    
-    # Статистика за текущий месяц
-    current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    visits_this_month = sum(1 for d in dates if d >= current_month)
-    spent_this_month = sum(
-        s["sum"] for s in shipments 
-        if datetime.fromisoformat(s["moment"].replace("Z", "+00:00")) >= current_month
-    )
-    
-    # Средний чек
-    avg_check = total_spent // total_visits if total_visits > 0 else 0
-    
-    # Подсчитываем экономию (сколько бонусов было потрачено)
-    # Используем новую таблицу транзакций для точного подсчета
-    saved_transactions = conn.execute("""
-        SELECT COALESCE(SUM(amount), 0) as total_saved
-        FROM bonus_transactions
-        WHERE agent_id = ? AND transaction_type = 'redemption'
-    """, (agent_id,)).fetchone()
-    
-    total_saved = saved_transactions[0] if saved_transactions else 0
-    
     return {
         "total_spent": total_spent,
         "total_visits": total_visits,
         "total_saved": total_saved,
-        "avg_check": avg_check,
+        "avg_check": total_spent // total_visits,
         "first_visit": first_visit,
         "last_visit": last_visit,
         "visits_this_month": visits_this_month,
         "spent_this_month": spent_this_month,
-        "period_days": period_days
+        "period_days": (last_visit - first_visit).days + 1
     }
 
 
 def get_client_ranking(agent_id: str) -> Dict:
     """
     Получает рейтинг клиента среди всех клиентов
+
+    Место берётся из предрассчитанной client_ranking, топ-10 — из кэша.
     """
-    # Получаем общую сумму трат клиента
-    client_spent = conn.execute(
-        "SELECT total_spent FROM loyalty_levels WHERE agent_id = ?",
-        (agent_id,)
-    ).fetchone()
-    
-    if not client_spent:
+    ranking = get_client_rank(agent_id)
+
+    if not ranking:
         return {
             "rank": 0,
             "total_clients": 0,
             "percentile": 0,
             "spent_rank": 0
         }
-    
-    client_spent = client_spent[0]
-    
-    # Общее количество клиентов
-    total_clients = conn.execute(
-        "SELECT COUNT(*) FROM loyalty_levels"
-    ).fetchone()[0]
-    
-    # Рейтинг по тратам (сколько клиентов потратили меньше)
-    spent_rank = conn.execute(
-        "SELECT COUNT(*) + 1 FROM loyalty_levels WHERE total_spent > ?",
-        (client_spent,)
-    ).fetchone()[0]
-    
+
+    spent_rank = ranking["rank"]
+    total_clients = ranking["total_clients"]
+
     # Процентиль
     percentile = ((total_clients - spent_rank + 1) / total_clients * 100) if total_clients > 0 else 0
-    
-    # Получаем топ-10 клиентов для сравнения
-    top_clients = conn.execute("""
-        SELECT 
-            ll.agent_id,
-            ll.total_spent,
-            ll.level_id,
-            um.fullname
-        FROM loyalty_levels ll
-        LEFT JOIN user_map um ON ll.agent_id = um.agent_id
-        ORDER BY ll.total_spent DESC
-        LIMIT 10
-    """).fetchall()
-    
+
     return {
         "rank": spent_rank,
         "total_clients": total_clients,
         "percentile": percentile,
         "spent_rank": spent_rank,
-        "top_clients": [
-            {
-                "agent_id": row[0],
-                "total_spent": row[1],
-                "level_id": row[2],
-                "fullname": row[3] or "Клиент"
-            }
-            for row in top_clients
-        ]
+        "top_clients": get_top_clients(10)
     }
 
 
@@ -150,32 +148,32 @@ def get_bonus_history(agent_id: str, days: int = 30) -> List[Dict]:
 def get_loyalty_distribution() -> Dict:
     """
     Получает распределение клиентов по уровням лояльности
+
+    Число клиентов и траты берутся из сводки уровней, минимум и максимум —
+    по индексу (level_id, total_spent).
     """
-    distribution = conn.execute("""
-        SELECT 
-            level_id,
-            COUNT(*) as count,
-            AVG(total_spent) as avg_spent,
-            MIN(total_spent) as min_spent,
-            MAX(total_spent) as max_spent
-        FROM loyalty_levels
-        GROUP BY level_id
-        ORDER BY level_id
-    """).fetchall()
+    distribution = get_level_rollup()
     
     result = {}
-    total_clients = sum(row[1] for row in distribution)
+    total_clients = sum(row["clients"] for row in distribution.values())
     
-    for row in distribution:
-        level_id, count, avg_spent, min_spent, max_spent = row
+    for level_id, row in distribution.items():
         level_info = get_level_info(level_id)
+        min_spent, max_spent = conn.execute(
+            """
+            SELECT
+                (SELECT MIN(total_spent) FROM loyalty_levels WHERE level_id = ?),
+                (SELECT MAX(total_spent) FROM loyalty_levels WHERE level_id = ?)
+            """,
+            (level_id, level_id)
+        ).fetchone()
         
         result[level_id] = {
             "name": level_info["name"],
             "emoji": level_info["emoji"],
-            "count": count,
-            "percentage": (count / total_clients * 100) if total_clients > 0 else 0,
-            "avg_spent": int(avg_spent or 0),
+            "count": row["clients"],
+            "percentage": (row["clients"] / total_clients * 100) if total_clients > 0 else 0,
+            "avg_spent": int(row["total_spent"] / row["clients"]),
             "min_spent": int(min_spent or 0),
             "max_spent": int(max_spent or 0)
         }
@@ -302,37 +300,97 @@ def get_monthly_analytics() -> Dict:
     """
     current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     
-    # Статистика по уровням
-    level_stats = conn.execute("""
-        SELECT 
-            level_id,
-            COUNT(*) as clients,
-            SUM(total_spent) as total_revenue,
-            AVG(total_spent) as avg_spent
-        FROM loyalty_levels
-        GROUP BY level_id
-        ORDER BY level_id
-    """).fetchall()
-    
-    # Общая статистика
-    total_stats = conn.execute("""
-        SELECT 
-            COUNT(*) as total_clients,
-            SUM(balance) as total_bonuses,
-            AVG(balance) as avg_balance
-        FROM bonuses
-    """).fetchone()
+    # Статистика по уровням и балансам — из сводок
+    level_stats = get_level_rollup()
+    bonus_totals = get_bonus_totals()
+    total_clients = bonus_totals["clients"]
     
     return {
         "level_distribution": {
-            row[0]: {
-                "clients": row[1],
-                "revenue": row[2] or 0,
-                "avg_spent": row[3] or 0
+            level_id: {
+                "clients": row["clients"],
+                "revenue": row["total_spent"],
+                "avg_spent": row["total_spent"] / row["clients"]
             }
-            for row in level_stats
+            for level_id, row in level_stats.items()
         },
-        "total_clients": total_stats[0] if total_stats else 0,
-        "total_bonuses": total_stats[1] if total_stats else 0,
-        "avg_balance": total_stats[2] if total_stats else 0
+        "total_clients": total_clients,
+        "total_bonuses": bonus_totals["balance"],
+        "avg_balance": bonus_totals["balance"] / total_clients if total_clients else 0,
+        "current_month": get_period_analytics(current_month, datetime.now())
     }
+
+
+def get_period_analytics(date_from: datetime, date_to: datetime) -> Dict:
+    """
+    Выручка, визиты, начисления, списания и регистрации за период
+    (даты включительно) — сумма дневных сводок
+    """
+    totals = get_period_rollup(date_from.strftime("%Y-%m-%d"), date_to.strftime("%Y-%m-%d"))
+    totals["avg_check"] = totals["revenue"] // totals["visits"] if totals["visits"] else 0
+    return totals
+
+
+# ─── Кэш экранов аналитики ───
+# Статистика, рейтинг и история клиента хранятся отрисованными, пока не
+# изменится версия его данных (agent_data_version, увеличивается триггерами
+# при отгрузках, транзакциях и изменении баланса или уровня) или пока не
+# истечёт TTL. Переключение вкладок аналитики отдаёт текст из памяти.
+
+ANALYTICS_VIEWS: Dict[str, Callable[[str], str]] = {
+    "stats": lambda agent_id: format_client_statistics(get_client_statistics(agent_id)),
+    "ranking": lambda agent_id: format_client_ranking(get_client_ranking(agent_id), agent_id),
+    "history": lambda agent_id: format_bonus_history(get_bonus_history(agent_id)),
+}
+
+_view_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _cached_entry(agent_id: str) -> Optional[dict]:
+    """Запись кэша клиента, если версия его данных не изменилась"""
+    entry = _view_cache.get(agent_id)
+    if entry is None:
+        return None
+    if entry["version"] != get_agent_data_version(agent_id):
+        del _view_cache[agent_id]
+        return None
+    _view_cache.move_to_end(agent_id)
+    return entry
+
+
+def get_cached_view(agent_id: str, view: str) -> Optional[str]:
+    """Отрисованный экран из кэша или None"""
+    entry = _cached_entry(agent_id)
+    if entry is None or view not in entry["views"]:
+        return None
+    stored_at, text = entry["views"][view]
+    ttl = RANKING_VIEW_TTL if view == "ranking" else VIEW_CACHE_TTL
+    if time.monotonic() - stored_at > ttl:
+        del entry["views"][view]
+        return None
+    return text
+
+
+def render_analytics_view(agent_id: str, view: str) -> str:
+    """Текст экрана аналитики ("stats", "ranking", "history") из кэша или заново"""
+    text = get_cached_view(agent_id, view)
+    if text is not None:
+        return text
+
+    # Версия читается до расчёта: изменения во время расчёта сбросят запись
+    version = get_agent_data_version(agent_id)
+    text = ANALYTICS_VIEWS[view](agent_id)
+
+    entry = _view_cache.get(agent_id)
+    if entry is None or entry["version"] != version:
+        entry = _view_cache[agent_id] = {"version": version, "views": {}}
+    entry["views"][view] = (time.monotonic(), text)
+    _view_cache.move_to_end(agent_id)
+    while len(_view_cache) > VIEW_CACHE_SIZE:
+        _view_cache.popitem(last=False)
+    return text
+
+
+def invalidate_agent_analytics(agent_id: str):
+    """Сбрасывает кэш экранов клиента (для изменений вне SQLite, например начислений в Postgres)"""
+    _view_cache.pop(agent_id, None)
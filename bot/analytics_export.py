@@ -0,0 +1,276 @@
+# loyalty-bot/bot/analytics_export.py
+"""
+Колоночная выгрузка данных для офлайн-аналитики
+
+Таблицы SQLite выгружаются в каталог с партициями в стиле Hive
+(exports/contractor_shipments/month=2025-07/part-000003-0.arrow).
+По умолчанию файлы пишутся в формате Arrow IPC без сжатия: их можно
+отобразить в память (mmap) и читать без копирования. Формат Parquet
+компактнее, но при чтении распаковывается.
+
+Выгрузка только дописывает новые файлы. Для каждой таблицы в
+_manifest.json хранится водяной знак — максимальный id или updated_at
+уже выгруженных строк, и следующий запуск берёт только строки после
+него. Изменённые строки (INSERT OR REPLACE отгрузок, обновление
+уровней) попадают в выгрузку повторно, поэтому load_table оставляет
+по каждому ключу последнюю версию.
+
+Требуется pyarrow (pip install pyarrow); бот от него не зависит.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+DB_PATH = "loyalty.db"
+EXPORT_DIR = "exports"
+MANIFEST = "_manifest.json"
+FORMATS = {"arrow": "arrow", "parquet": "parquet"}
+
+
+def _month(column: str) -> Callable[[pd.DataFrame], pd.Series]:
+    return lambda df: df[column].fillna("").str[:7].replace("", "unknown")
+
+
+def _export_date(df: pd.DataFrame) -> pd.Series:
+    return pd.Series(datetime.now().strftime("%Y-%m-%d"), index=df.index)
+
+
+@dataclass(frozen=True)
+class ExportSpec:
+    """Как выгружать таблицу"""
+    table: str
+    watermark: str                # колонка водяного знака
+    key: str                      # ключ строки для дедупликации при чтении
+    newest: str                   # из дублей ключа остаётся строка с максимумом этой колонки
+    partition: str                # имя колонки-партиции
+    partition_values: Optional[Callable[[pd.DataFrame], pd.Series]] = None
+    snapshot: bool = False        # True — таблица выгружается целиком в партицию с номером
+                                  # выгрузки, читается последний снимок
+
+
+SPECS: Dict[str, ExportSpec] = {
+    spec.table: spec for spec in (
+        ExportSpec("contractor_shipments", watermark="id", key="demand_id", newest="id",
+                   partition="month", partition_values=_month("moment")),
+        ExportSpec("bonus_transactions", watermark="id", key="id", newest="id",
+                   partition="month", partition_values=_month("created_at")),
+        ExportSpec("loyalty_levels", watermark="updated_at", key="agent_id", newest="updated_at",
+                   partition="snapshot", partition_values=_export_date),
+        ExportSpec("customer_segments", watermark="updated_at", key="agent_id", newest="updated_at",
+                   partition="run", snapshot=True),
+    )
+}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError("Для колоночной выгрузки нужен pyarrow: pip install pyarrow")
+
+
+# ─── Манифест ───
+
+def _read_manifest(export_dir: str) -> dict:
+    path = os.path.join(export_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {"tables": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest(export_dir: str, manifest: dict):
+    """Атомарно заменяет манифест"""
+    path = os.path.join(export_dir, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+# ─── Выгрузка ───
+
+def _arrow_schema(conn: sqlite3.Connection, table: str):
+    """Схема Arrow по объявленным типам колонок SQLite"""
+    import pyarrow as pa
+
+    fields = []
+    for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({table})"):
+        declared = (declared or "").upper()
+        if "INT" in declared:
+            kind = pa.int64()
+        elif any(t in declared for t in ("REAL", "FLOA", "DOUB")):
+            kind = pa.float64()
+        else:
+            kind = pa.string()
+        fields.append(pa.field(name, kind))
+    return pa.schema(fields)
+
+
+def _new_rows(conn: sqlite3.Connection, spec: ExportSpec, state: dict) -> pd.DataFrame:
+    """Строки после водяного знака; для снимков — вся таблица, если она изменилась"""
+    watermark = state.get("watermark")
+    if spec.snapshot:
+        latest = conn.execute(f"SELECT MAX({spec.watermark}) FROM {spec.table}").fetchone()[0]
+        if latest is None or (watermark is not None and latest <= watermark):
+            return pd.DataFrame()
+        return pd.read_sql_query(f"SELECT * FROM {spec.table}", conn)
+
+    if watermark is None:
+        return pd.read_sql_query(f"SELECT * FROM {spec.table}", conn)
+    if spec.watermark == "id":
+        return pd.read_sql_query(f"SELECT * FROM {spec.table} WHERE id > ?", conn, params=(watermark,))
+
+    # updated_at хранится с точностью до секунды: строки с updated_at, равным
+    # водяному знаку, перечитываются, а уже выгруженные из них отбрасываются
+    df = pd.read_sql_query(
+        f"SELECT * FROM {spec.table} WHERE {spec.watermark} >= ?", conn, params=(watermark,)
+    )
+    seen = set(state.get("watermark_keys", []))
+    return df[~((df[spec.watermark] == watermark) & df[spec.key].isin(seen))]
+
+
+def export_table(conn: sqlite3.Connection, spec: ExportSpec, export_dir: str, manifest: dict) -> int:
+    """Дописывает новые строки таблицы в выгрузку; возвращает их количество"""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    state = manifest["tables"].get(spec.table, {})
+    df = _new_rows(conn, spec, state)
+    if df.empty:
+        return 0
+
+    batch = state.get("batches", 0) + 1
+    schema = _arrow_schema(conn, spec.table)
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    partition = (pd.Series(f"{batch:06d}", index=df.index) if spec.snapshot
+                 else spec.partition_values(df))
+    table = table.append_column(spec.partition, pa.array(partition, pa.string()))
+
+    fmt = manifest["format"]
+    ds.write_dataset(
+        table,
+        os.path.join(export_dir, spec.table),
+        format=FORMATS[fmt],
+        partitioning=ds.partitioning(pa.schema([pa.field(spec.partition, pa.string())]), flavor="hive"),
+        basename_template=f"part-{batch:06d}-{{i}}.{fmt}",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+    watermark = df[spec.watermark].max()
+    manifest["tables"][spec.table] = {
+        "watermark": int(watermark) if spec.watermark == "id" else str(watermark),
+        "batches": batch,
+        "rows": state.get("rows", 0) + len(df),
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if spec.watermark != "id" and not spec.snapshot:
+        keys = df.loc[df[spec.watermark] == watermark, spec.key].tolist()
+        if watermark == state.get("watermark"):
+            keys += state.get("watermark_keys", [])
+        manifest["tables"][spec.table]["watermark_keys"] = keys
+    return len(df)
+
+
+def export_tables(db_path: str = DB_PATH, export_dir: str = EXPORT_DIR,
+                  tables: Optional[List[str]] = None, fmt: str = "arrow") -> Dict[str, int]:
+    """
+    Инкрементально выгружает таблицы; возвращает {таблица: новых строк}
+
+    Формат задаётся при первой выгрузке в каталог и дальше не меняется.
+    """
+    _require_pyarrow()
+    os.makedirs(export_dir, exist_ok=True)
+
+    manifest = _read_manifest(export_dir)
+    manifest.setdefault("format", fmt)
+    if manifest["format"] != fmt:
+        raise ValueError(
+            f"Каталог {export_dir} уже содержит выгрузку в формате {manifest['format']}; "
+            f"для смены формата выгрузите в новый каталог"
+        )
+
+    conn = sqlite3.connect(db_path)
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    exported = {}
+    try:
+        for name in tables or list(SPECS):
+            if name not in existing:
+                log.info(f"Таблица {name} отсутствует в базе, пропускаем")
+                continue
+            exported[name] = export_table(conn, SPECS[name], export_dir, manifest)
+            # Манифест фиксируется после каждой таблицы: сбой не откатывает готовые
+            _write_manifest(export_dir, manifest)
+            log.info(f"{name}: выгружено {exported[name]} строк")
+    finally:
+        conn.close()
+    return exported
+
+
+# ─── Чтение ───
+
+def open_dataset(table: str, export_dir: str = EXPORT_DIR):
+    """pyarrow.dataset выгрузки; файлы Arrow IPC читаются через mmap"""
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+
+    spec = SPECS[table]
+    manifest = _read_manifest(export_dir)
+    return ds.dataset(
+        os.path.join(export_dir, table),
+        format=FORMATS[manifest.get("format", "arrow")],
+        partitioning=ds.partitioning(pa.schema([pa.field(spec.partition, pa.string())]), flavor="hive"),
+        filesystem=pafs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def load_table(table: str, export_dir: str = EXPORT_DIR, columns: Optional[List[str]] = None,
+               filter=None) -> pd.DataFrame:
+    """
+    Текущее состояние таблицы из выгрузки в DataFrame
+
+    Из повторно выгруженных строк остаётся последняя версия по ключу,
+    для снимков — только последний снимок. filter — выражение
+    pyarrow.dataset (например, ds.field("month") >= "2025-01"); оно
+    применяется к последним версиям строк.
+    """
+    import pyarrow.dataset as ds
+
+    spec = SPECS[table]
+    dataset = open_dataset(table, export_dir)
+
+    needed = None
+    if columns is not None:
+        needed = list(dict.fromkeys([*columns, spec.key, spec.newest]))
+
+    if spec.snapshot:
+        runs = dataset.to_table(columns=[spec.partition])[spec.partition]
+        if len(runs) == 0:
+            return pd.DataFrame(columns=columns)
+        import pyarrow.compute as pc
+        latest = ds.field(spec.partition) == pc.max(runs).as_py()
+        # В снимке ключи не повторяются, поэтому фильтр можно отдать в чтение
+        result = dataset.to_table(columns=needed, filter=latest if filter is None else filter & latest)
+    else:
+        # Колонки фильтра заранее неизвестны, поэтому с фильтром читаются все
+        result = dataset.to_table(columns=needed if filter is None else None)
+        keys = result.select([spec.key, spec.newest]).to_pandas()
+        keep = keys.sort_values(spec.newest, kind="mergesort").drop_duplicates(spec.key, keep="last").index
+        result = result.take(keep.to_numpy())
+        # Фильтр после дедупликации: иначе устаревшая версия строки, подходящая
+        # под фильтр, пережила бы отброшенную им последнюю
+        if filter is not None:
+            result = ds.dataset(result).to_table(filter=filter)
+
+    df = result.to_pandas()
+    return df[columns] if columns is not None else df
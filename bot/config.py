@@ -22,3 +22,7 @@ BONUS_RATE = 0.05  # 5 %
 REDEEM_CAP = 0.30  # можно списать ≤ 30 %
 MSK = pytz.timezone("Europe/Moscow")
 USER_TZ = pytz.timezone("Europe/Kaliningrad")
+
+# Метрики начислений (локальный эндпоинт; 0 — отключить)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
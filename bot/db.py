@@ -1,11 +1,11 @@
+import time
 import sqlite3
 from typing import Optional
 
-conn = sqlite3.connect("loyalty.db")
-conn.execute("PRAGMA foreign_keys=ON")
+DB_PATH = "loyalty.db"
 
-# ── гарантируем, что все нужные колонки и таблицы есть ───────────────
-conn.executescript("""
+# ── схема: все нужные колонки и таблицы ──────────────────────────────
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS user_map (
     tg_id    INTEGER PRIMARY KEY,
     agent_id TEXT    NOT NULL,
@@ -42,8 +42,185 @@ CREATE TABLE IF NOT EXISTS bonus_transactions (
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
 );
-""")
-conn.commit()
+
+CREATE INDEX IF NOT EXISTS idx_bonus_transactions_agent_date
+    ON bonus_transactions(agent_id, created_at);
+
+-- Рейтинг клиентов по total_spent; поддерживается инкрементально
+-- (rank = 1 + число клиентов с большей суммой трат)
+CREATE TABLE IF NOT EXISTS client_ranking (
+    agent_id TEXT PRIMARY KEY,
+    total_spent INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_client_ranking_spent
+    ON client_ranking(total_spent);
+
+CREATE TABLE IF NOT EXISTS client_ranking_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total_clients INTEGER NOT NULL
+);
+
+-- Отгрузки МойСклад; заполняется скриптами синхронизации (auto_sync.py и др.)
+CREATE TABLE IF NOT EXISTS contractor_shipments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    demand_id TEXT UNIQUE,
+    agent_id TEXT NOT NULL,
+    name TEXT,
+    moment TEXT,
+    sum INTEGER DEFAULT 0,
+    state_name TEXT DEFAULT '',
+    positions_count INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (agent_id) REFERENCES contractors_data(agent_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_contractor_shipments_agent_moment
+    ON contractor_shipments(agent_id, moment);
+
+CREATE INDEX IF NOT EXISTS idx_contractor_shipments_moment
+    ON contractor_shipments(moment);
+
+CREATE INDEX IF NOT EXISTS idx_loyalty_levels_level_spent
+    ON loyalty_levels(level_id, total_spent);
+
+-- Дневные сводки для отчётов; обновляются инкрементально при начислениях,
+-- списаниях, регистрациях и синхронизации отгрузок
+CREATE TABLE IF NOT EXISTS daily_rollup (
+    day TEXT PRIMARY KEY,                      -- YYYY-MM-DD
+    revenue INTEGER NOT NULL DEFAULT 0,        -- сумма отгрузок, копейки
+    visits INTEGER NOT NULL DEFAULT 0,         -- число отгрузок
+    accrued INTEGER NOT NULL DEFAULT 0,
+    redeemed INTEGER NOT NULL DEFAULT 0,
+    registrations INTEGER NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Клиенты и сумма трат по уровням на конец дня (строка есть за дни с изменениями)
+CREATE TABLE IF NOT EXISTS daily_level_rollup (
+    level_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    clients INTEGER NOT NULL,
+    total_spent INTEGER NOT NULL,
+    PRIMARY KEY (level_id, day)
+);
+
+-- Отгрузки, начисления по которым уже учтены в daily_rollup (события outbox)
+CREATE TABLE IF NOT EXISTS daily_rollup_demands (
+    demand_id TEXT PRIMARY KEY,
+    day TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS bonus_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    clients INTEGER NOT NULL,
+    balance INTEGER NOT NULL
+);
+
+-- Версия данных клиента для кэша экранов аналитики: триггеры увеличивают
+-- её при любой записи об отгрузке, транзакции, балансе или уровне клиента,
+-- в том числе из скриптов синхронизации в других процессах
+CREATE TABLE IF NOT EXISTS agent_data_version (
+    agent_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_agent_version_shipments AFTER INSERT ON contractor_shipments
+BEGIN
+    INSERT INTO agent_data_version(agent_id, version) VALUES (NEW.agent_id, 1)
+    ON CONFLICT(agent_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_agent_version_transactions AFTER INSERT ON bonus_transactions
+BEGIN
+    INSERT INTO agent_data_version(agent_id, version) VALUES (NEW.agent_id, 1)
+    ON CONFLICT(agent_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_agent_version_bonuses AFTER UPDATE OF balance ON bonuses
+BEGIN
+    INSERT INTO agent_data_version(agent_id, version) VALUES (NEW.agent_id, 1)
+    ON CONFLICT(agent_id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_agent_version_levels AFTER UPDATE ON loyalty_levels
+BEGIN
+    INSERT INTO agent_data_version(agent_id, version) VALUES (NEW.agent_id, 1)
+    ON CONFLICT(agent_id) DO UPDATE SET version = version + 1;
+END;
+
+-- Правила уровней лояльности (JSON); действует последняя запись
+CREATE TABLE IF NOT EXISTS loyalty_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rules TEXT NOT NULL,
+    comment TEXT DEFAULT '',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+"""
+# ─────────────────────────────────────────────────────────────────────
+
+# ── соединение ───────────────────────────────────────────────────────
+# Соединение открывается при первом обращении, а не при импорте модуля:
+# импорт bot.db ничего не делает с файлом базы.
+_connection: Optional[sqlite3.Connection] = None
+
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает соединение с SQLite, открывая его при первом вызове"""
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(DB_PATH)
+        _connection.execute("PRAGMA foreign_keys=ON")
+    return _connection
+
+
+def init_db(connection=None):
+    """
+    Создаёт недостающие таблицы и индексы (вызывается при запуске бота)
+
+    connection — соединение со сторонней базой (скрипты обслуживания),
+    по умолчанию общее соединение бота.
+    """
+    connection = connection or get_connection()
+    connection.executescript(SCHEMA)
+    connection.commit()
+
+    # Рейтинг пересобирается, если loyalty_levels меняли в обход update_total_spent
+    # (пересчёт уровней, миграции)
+    meta = connection.execute("SELECT total_clients FROM client_ranking_meta WHERE id = 1").fetchone()
+    total = connection.execute("SELECT COUNT(*) FROM loyalty_levels").fetchone()[0]
+    if meta is None or meta[0] != total:
+        rebuild_client_ranking(connection)
+
+    # Сводки: при первом запуске заполняются по истории, далее при каждом
+    # запуске выравниваются снимки по bonuses и loyalty_levels
+    if connection.execute("SELECT 1 FROM daily_rollup LIMIT 1").fetchone() is None:
+        rebuild_daily_rollup(connection)
+    else:
+        sync_rollup_snapshots(connection)
+
+
+def close_connection():
+    """Закрывает соединение (вызывается при остановке бота)"""
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+
+class _LazyConnection:
+    """Прокси для `from .db import conn`: все обращения идут к get_connection()"""
+
+    def __getattr__(self, name):
+        return getattr(get_connection(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_connection(), name, value)
+
+
+conn = _LazyConnection()
 # ─────────────────────────────────────────────────────────────────────
 
 # ── helpers ──────────────────────────────────────────────────────────
@@ -53,6 +230,7 @@ def get_agent_id(tg_id: int) -> Optional[str]:
 
 
 def register_mapping(tg_id: int, agent_id: str, phone: str, fullname: str):
+    is_new = conn.execute("SELECT 1 FROM user_map WHERE tg_id=?", (tg_id,)).fetchone() is None
     conn.execute(
         """
         INSERT INTO user_map(tg_id, agent_id, phone, fullname)
@@ -65,13 +243,17 @@ def register_mapping(tg_id: int, agent_id: str, phone: str, fullname: str):
         (tg_id, agent_id, phone, fullname),
     )
     # Начисление приветственных бонусов, если пользователь новый
-    conn.execute(
+    cursor = conn.execute(
         """
         INSERT INTO bonuses(agent_id, balance) VALUES(?,?)
         ON CONFLICT(agent_id) DO NOTHING
         """,
         (agent_id, 10000),  # 100 бонусов для нового пользователя
     )
+    if cursor.rowcount:
+        _add_to_bonus_totals(1, 10000)
+    if is_new:
+        add_to_daily_rollup(_today(), registrations=1)
     # Инициализируем уровень лояльности
     init_loyalty_level(agent_id)
     conn.commit()
@@ -88,6 +270,7 @@ def get_balance(agent_id: str) -> int:
 
 
 def change_balance(agent_id: str, delta: int):
+    is_new = conn.execute("SELECT 1 FROM bonuses WHERE agent_id=?", (agent_id,)).fetchone() is None
     conn.execute(
         """
         INSERT INTO bonuses(agent_id, balance) VALUES(?,?)
@@ -95,6 +278,7 @@ def change_balance(agent_id: str, delta: int):
         """,
         (agent_id, delta, delta),
     )
+    _add_to_bonus_totals(int(is_new), delta)
     conn.commit()
 
 
@@ -110,7 +294,7 @@ def get_tg_id_by_agent(agent_id: str) -> int | None:
 # ── функции для работы с уровнями лояльности ──────────────────────────
 def init_loyalty_level(agent_id: str):
     """Инициализирует уровень лояльности для нового клиента"""
-    conn.execute(
+    cursor = conn.execute(
         """
         INSERT INTO loyalty_levels(agent_id, level_id, total_spent)
         VALUES (?, 1, 0)
@@ -118,6 +302,9 @@ def init_loyalty_level(agent_id: str):
         """,
         (agent_id,)
     )
+    if cursor.rowcount:
+        _update_ranking(agent_id, None, 0)
+        _add_to_level_rollup(1, 1, 0)
     conn.commit()
 
 
@@ -153,6 +340,12 @@ def update_total_spent(agent_id: str, amount: int) -> dict:
         """,
         (new_total, new_level, agent_id)
     )
+    _update_ranking(agent_id, current_data["total_spent"], new_total)
+    if new_level == current_data["level_id"]:
+        _add_to_level_rollup(new_level, 0, amount)
+    else:
+        _add_to_level_rollup(current_data["level_id"], -1, -current_data["total_spent"])
+        _add_to_level_rollup(new_level, 1, new_total)
     conn.commit()
     
     return {
@@ -163,6 +356,116 @@ def update_total_spent(agent_id: str, amount: int) -> dict:
     }
 
 
+# ── рейтинг клиентов ─────────────────────────────────────────────────
+# client_ranking хранит место каждого клиента по total_spent. При изменении
+# суммы одного клиента сдвигаются только места клиентов, между старой и
+# новой суммой которых он прошёл, поэтому чтение места — один запрос по PK.
+TOP_CLIENTS_TTL = 300  # секунд; страховка от изменений из других процессов
+
+_top_clients_cache: dict = {"rows": None, "limit": 0, "loaded_at": 0.0}
+
+
+def _update_ranking(agent_id: str, old_spent: Optional[int], new_spent: int):
+    """Сдвигает места клиентов после изменения суммы трат (без коммита)"""
+    if old_spent == new_spent:
+        return
+    if old_spent is None:
+        # Новый клиент обходит всех, у кого трат меньше
+        conn.execute(
+            "UPDATE client_ranking SET rank = rank + 1 WHERE total_spent < ?", (new_spent,)
+        )
+        conn.execute("UPDATE client_ranking_meta SET total_clients = total_clients + 1 WHERE id = 1")
+    elif new_spent > old_spent:
+        conn.execute(
+            "UPDATE client_ranking SET rank = rank + 1 "
+            "WHERE total_spent >= ? AND total_spent < ? AND agent_id != ?",
+            (old_spent, new_spent, agent_id)
+        )
+    else:
+        conn.execute(
+            "UPDATE client_ranking SET rank = rank - 1 "
+            "WHERE total_spent >= ? AND total_spent < ? AND agent_id != ?",
+            (new_spent, old_spent, agent_id)
+        )
+
+    conn.execute(
+        """
+        INSERT INTO client_ranking(agent_id, total_spent, rank, updated_at)
+        VALUES (?, ?, (SELECT COUNT(*) + 1 FROM client_ranking WHERE total_spent > ? AND agent_id != ?),
+                CURRENT_TIMESTAMP)
+        ON CONFLICT(agent_id) DO UPDATE SET
+            total_spent = excluded.total_spent, rank = excluded.rank, updated_at = excluded.updated_at
+        """,
+        (agent_id, new_spent, new_spent, agent_id)
+    )
+
+    # Кэш топа сбрасывается, только если изменение могло его затронуть
+    rows = _top_clients_cache["rows"]
+    if rows is not None:
+        threshold = rows[-1]["total_spent"] if len(rows) >= _top_clients_cache["limit"] else -1
+        if max(new_spent, old_spent or 0) >= threshold or any(r["agent_id"] == agent_id for r in rows):
+            _top_clients_cache["rows"] = None
+
+
+def rebuild_client_ranking(connection=None):
+    """Полностью пересобирает client_ranking по loyalty_levels"""
+    db = connection or conn
+    db.execute("DELETE FROM client_ranking")
+    db.execute(
+        """
+        INSERT INTO client_ranking(agent_id, total_spent, rank)
+        SELECT agent_id, total_spent, RANK() OVER (ORDER BY total_spent DESC)
+        FROM loyalty_levels
+        """
+    )
+    db.execute(
+        "INSERT OR REPLACE INTO client_ranking_meta(id, total_clients) "
+        "SELECT 1, COUNT(*) FROM client_ranking"
+    )
+    db.commit()
+    _top_clients_cache["rows"] = None
+
+
+def get_client_rank(agent_id: str) -> Optional[dict]:
+    """Место клиента: {"rank", "total_spent", "total_clients"} или None"""
+    row = conn.execute(
+        """
+        SELECT r.rank, r.total_spent, m.total_clients
+        FROM client_ranking r, client_ranking_meta m
+        WHERE r.agent_id = ? AND m.id = 1
+        """,
+        (agent_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return {"rank": row[0], "total_spent": row[1], "total_clients": row[2]}
+
+
+def get_top_clients(limit: int = 10) -> list:
+    """Топ клиентов по тратам (кэшируется до изменения, затрагивающего топ)"""
+    cache = _top_clients_cache
+    if (cache["rows"] is None or cache["limit"] < limit
+            or time.monotonic() - cache["loaded_at"] > TOP_CLIENTS_TTL):
+        rows = conn.execute(
+            """
+            SELECT r.agent_id, r.total_spent, ll.level_id, um.fullname
+            FROM client_ranking r
+            LEFT JOIN loyalty_levels ll ON ll.agent_id = r.agent_id
+            LEFT JOIN user_map um ON um.agent_id = r.agent_id
+            ORDER BY r.total_spent DESC
+            LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+        cache["rows"] = [
+            {"agent_id": row[0], "total_spent": row[1], "level_id": row[2], "fullname": row[3] or "Клиент"}
+            for row in rows
+        ]
+        cache["limit"] = limit
+        cache["loaded_at"] = time.monotonic()
+    return [dict(row) for row in cache["rows"][:limit]]
+
+
 def add_bonus_transaction(agent_id: str, transaction_type: str, amount: int, description: str, related_demand_id: str = None):
     """Добавляет запись о транзакции бонусов"""
     conn.execute(
@@ -172,6 +475,8 @@ def add_bonus_transaction(agent_id: str, transaction_type: str, amount: int, des
         """,
         (agent_id, transaction_type, amount, description, related_demand_id)
     )
+    if transaction_type in ("accrual", "redemption"):
+        add_to_daily_rollup(_today(), **{"accrued" if transaction_type == "accrual" else "redeemed": abs(amount)})
     conn.commit()
 
 
@@ -200,6 +505,256 @@ def get_bonus_transactions(agent_id: str, days: int = 30) -> list:
     ]
 
 
+def get_bonus_transactions_page(agent_id: str, limit: int = 10,
+                                cursor: tuple | None = None, direction: str = "next") -> dict:
+    """
+    Получает одну страницу истории транзакций (keyset-пагинация)
+
+    Args:
+        agent_id: ID агента
+        limit: размер страницы
+        cursor: (created_at, id) граничной записи предыдущей страницы
+        direction: "next" — более старые записи, "prev" — более новые
+
+    Returns:
+        dict: {"items": [...], "next_cursor": ..., "prev_cursor": ...}
+    """
+    params: list = [agent_id]
+    where = "agent_id = ?"
+    order = "DESC"
+    if cursor:
+        if direction == "prev":
+            where += " AND (created_at, id) > (?, ?)"
+            order = "ASC"
+        else:
+            where += " AND (created_at, id) < (?, ?)"
+        params.extend(cursor)
+
+    rows = conn.execute(
+        f"""
+        SELECT id, transaction_type, amount, description, related_demand_id, created_at
+        FROM bonus_transactions
+        WHERE {where}
+        ORDER BY created_at {order}, id {order}
+        LIMIT ?
+        """,
+        (*params, limit + 1)
+    ).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+
+    items = [
+        {
+            "id": row[0],
+            "type": row[1],
+            "amount": row[2],
+            "description": row[3],
+            "related_demand_id": row[4],
+            "date": datetime.fromisoformat(row[5]),
+            "cursor": (row[5], row[0])
+        }
+        for row in rows
+    ]
+
+    # Есть ли страницы в каждую сторону от текущей
+    has_older = has_more if direction == "next" or not cursor else True
+    has_newer = bool(cursor) and (direction == "next" or has_more)
+
+    return {
+        "items": items,
+        "next_cursor": items[-1]["cursor"] if items and has_older else None,
+        "prev_cursor": items[0]["cursor"] if items and has_newer else None
+    }
+
+
+def get_agent_data_version(agent_id: str) -> int:
+    """Версия данных клиента (см. agent_data_version в схеме)"""
+    row = conn.execute("SELECT version FROM agent_data_version WHERE agent_id = ?", (agent_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# ── дневные сводки ───────────────────────────────────────────────────
+# Отчёты за период суммируют строки daily_rollup вместо сканирования
+# bonuses, loyalty_levels и отгрузок. Выручка и визиты пересчитываются
+# по затронутым синхронизацией дням, остальные счётчики увеличиваются
+# в момент события.
+ROLLUP_COLUMNS = ("revenue", "visits", "accrued", "redeemed", "registrations")
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def add_to_daily_rollup(day: str, connection=None, **deltas):
+    """Прибавляет deltas (revenue, visits, accrued, ...) к сводке дня (без коммита)"""
+    db = connection or conn
+    columns = [name for name in ROLLUP_COLUMNS if deltas.get(name)]
+    if not columns:
+        return
+    db.execute(
+        f"""
+        INSERT INTO daily_rollup(day, {", ".join(columns)})
+        VALUES (?, {", ".join("?" for _ in columns)})
+        ON CONFLICT(day) DO UPDATE SET
+            {", ".join(f"{name} = {name} + excluded.{name}" for name in columns)},
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        (day, *(deltas[name] for name in columns))
+    )
+
+
+def _add_to_level_rollup(level_id: int, clients: int, spent: int):
+    """Меняет сегодняшний снимок уровня на clients клиентов и spent трат (без коммита)"""
+    conn.execute(
+        """
+        INSERT INTO daily_level_rollup(level_id, day, clients, total_spent)
+        SELECT ?, ?, COALESCE(MAX(clients), 0) + ?, COALESCE(MAX(total_spent), 0) + ?
+        FROM (SELECT clients, total_spent FROM daily_level_rollup
+              WHERE level_id = ? ORDER BY day DESC LIMIT 1)
+        WHERE true
+        ON CONFLICT(level_id, day) DO UPDATE SET
+            clients = clients + ?, total_spent = total_spent + ?
+        """,
+        (level_id, _today(), clients, spent, level_id, clients, spent)
+    )
+
+
+def _add_to_bonus_totals(clients: int, balance: int):
+    conn.execute(
+        "UPDATE bonus_totals SET clients = clients + ?, balance = balance + ? WHERE id = 1",
+        (clients, balance)
+    )
+
+
+def refresh_shipment_rollup(days, connection=None):
+    """Пересчитывает выручку и визиты за дни days по contractor_shipments и коммитит"""
+    db = connection or conn
+    for day in sorted({d[:10] for d in days if d}):
+        next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        db.execute(
+            """
+            INSERT INTO daily_rollup(day, revenue, visits)
+            SELECT ?, COALESCE(SUM(sum), 0), COUNT(*)
+            FROM contractor_shipments
+            WHERE moment >= ? AND moment < ?
+            ON CONFLICT(day) DO UPDATE SET
+                revenue = excluded.revenue, visits = excluded.visits, updated_at = CURRENT_TIMESTAMP
+            """,
+            (day, day, next_day)
+        )
+    db.commit()
+
+
+def record_accrual_rollup(demand_id: str, day: str, accrued: int) -> bool:
+    """Учитывает начисление по отгрузке в сводке дня один раз (для событий outbox)"""
+    cursor = conn.execute(
+        "INSERT INTO daily_rollup_demands(demand_id, day) VALUES (?, ?) ON CONFLICT(demand_id) DO NOTHING",
+        (demand_id, day)
+    )
+    if cursor.rowcount:
+        add_to_daily_rollup(day, accrued=accrued)
+    conn.commit()
+    return True
+
+
+def sync_rollup_snapshots(connection=None):
+    """Выравнивает bonus_totals и сегодняшние снимки уровней по исходным таблицам"""
+    db = connection or conn
+    db.execute(
+        "INSERT OR REPLACE INTO bonus_totals(id, clients, balance) "
+        "SELECT 1, COUNT(*), COALESCE(SUM(balance), 0) FROM bonuses"
+    )
+    # Уровни, клиентов в которых не осталось, получают нулевой снимок
+    db.execute(
+        """
+        INSERT OR REPLACE INTO daily_level_rollup(level_id, day, clients, total_spent)
+        SELECT level_id, ?, 0, 0 FROM daily_level_rollup
+        WHERE level_id NOT IN (SELECT DISTINCT level_id FROM loyalty_levels)
+        GROUP BY level_id
+        """,
+        (_today(),)
+    )
+    db.execute(
+        """
+        INSERT OR REPLACE INTO daily_level_rollup(level_id, day, clients, total_spent)
+        SELECT level_id, ?, COUNT(*), SUM(total_spent) FROM loyalty_levels GROUP BY level_id
+        """,
+        (_today(),)
+    )
+    db.commit()
+
+
+def rebuild_daily_rollup(connection=None):
+    """
+    Заполняет daily_rollup по истории отгрузок и транзакций бонусов
+
+    Регистрации за прошлые дни не восстанавливаются: в user_map нет даты.
+    """
+    db = connection or conn
+    db.execute("UPDATE daily_rollup SET revenue = 0, visits = 0, accrued = 0, redeemed = 0")
+    db.execute(
+        """
+        INSERT INTO daily_rollup(day, revenue, visits)
+        SELECT substr(moment, 1, 10), SUM(sum), COUNT(*)
+        FROM contractor_shipments
+        WHERE moment IS NOT NULL
+        GROUP BY substr(moment, 1, 10)
+        ON CONFLICT(day) DO UPDATE SET revenue = excluded.revenue, visits = excluded.visits
+        """
+    )
+    db.execute(
+        """
+        INSERT INTO daily_rollup(day, accrued, redeemed)
+        SELECT date(created_at, 'localtime'),
+               SUM(CASE WHEN transaction_type = 'accrual' THEN ABS(amount) ELSE 0 END),
+               SUM(CASE WHEN transaction_type = 'redemption' THEN ABS(amount) ELSE 0 END)
+        FROM bonus_transactions
+        GROUP BY date(created_at, 'localtime')
+        ON CONFLICT(day) DO UPDATE SET accrued = excluded.accrued, redeemed = excluded.redeemed
+        """
+    )
+    sync_rollup_snapshots(db)
+
+
+def get_period_rollup(date_from: str, date_to: str) -> dict:
+    """Суммы сводок за дни с date_from по date_to включительно (YYYY-MM-DD)"""
+    row = conn.execute(
+        f"""
+        SELECT {", ".join(f"COALESCE(SUM({name}), 0)" for name in ROLLUP_COLUMNS)}, COUNT(*)
+        FROM daily_rollup
+        WHERE day >= ? AND day <= ?
+        """,
+        (date_from[:10], date_to[:10])
+    ).fetchone()
+    result = dict(zip(ROLLUP_COLUMNS, row))
+    result["days"] = row[-1]
+    return result
+
+
+def get_level_rollup(day: str = None) -> dict:
+    """Клиенты и сумма трат по уровням на конец дня day (по умолчанию — сейчас)"""
+    rows = conn.execute(
+        """
+        SELECT r.level_id, r.clients, r.total_spent
+        FROM daily_level_rollup r
+        WHERE r.day = (SELECT MAX(day) FROM daily_level_rollup
+                       WHERE level_id = r.level_id AND day <= ?)
+        ORDER BY r.level_id
+        """,
+        (day or _today(),)
+    ).fetchall()
+    return {row[0]: {"clients": row[1], "total_spent": row[2]} for row in rows if row[1] > 0}
+
+
+def get_bonus_totals() -> dict:
+    """Число клиентов и сумма балансов бонусов"""
+    row = conn.execute("SELECT clients, balance FROM bonus_totals WHERE id = 1").fetchone()
+    return {"clients": row[0], "balance": row[1]} if row else {"clients": 0, "balance": 0}
+
+
 # Импортируем функцию расчета уровня в конце, чтобы избежать циклических импортов
 from .loyalty import calculate_level_by_spent
 from datetime import datetime, timedelta
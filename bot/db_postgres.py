@@ -3,11 +3,17 @@
 Заменяет функциональность исходного db.py.
 """
 import os
+import gzip
+import time
+import asyncio
 import logging
+import threading
 from typing import Optional, Tuple, List, Dict, Any
 from datetime import datetime, timedelta
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2 import errors as pg_errors
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import DictCursor, RealDictCursor, Json
 from dotenv import load_dotenv
 
 # Настройка логирования
@@ -23,13 +29,11 @@ POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 
-# Проверка настроек
-if not all([POSTGRES_HOST, POSTGRES_PORT, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB]):
-    raise RuntimeError("Необходимо указать настройки PostgreSQL в файле .env или переменных окружения")
-
 # Создание соединения с PostgreSQL
 def get_connection():
-    """Возвращает соединение с базой данных PostgreSQL"""
+    """Возвращает новое соединение с базой данных PostgreSQL"""
+    if not all([POSTGRES_HOST, POSTGRES_PORT, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB]):
+        raise RuntimeError("Необходимо указать настройки PostgreSQL в файле .env или переменных окружения")
     try:
         conn = psycopg2.connect(
             host=POSTGRES_HOST,
@@ -43,15 +47,184 @@ def get_connection():
         log.error(f"Ошибка подключения к PostgreSQL: {e}")
         raise
 
-# Глобальное соединение для использования в функциях
-try:
-    conn = get_connection()
-    # Настройка для автоматического коммита транзакций
-    conn.autocommit = False
-    log.info(f"Успешное подключение к PostgreSQL ({POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB})")
-except Exception as e:
-    log.error(f"Не удалось подключиться к PostgreSQL: {e}")
-    raise
+# Глобальное соединение открывается при первом обращении, а не при импорте
+_connection = None
+
+
+def get_shared_connection():
+    """Возвращает общее соединение модуля, открывая его при первом вызове"""
+    global _connection
+    session = getattr(_local, "session", None)
+    if session is not None:
+        return session.connection
+    if _connection is None or _connection.closed:
+        _connection = get_connection()
+        # Транзакции коммитятся явно
+        _connection.autocommit = False
+        # Подготовленные запросы живут в рамках сессии
+        _prepared.clear()
+        log.info(f"Успешное подключение к PostgreSQL ({POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB})")
+    return _connection
+
+
+def close_connection():
+    """Закрывает общее соединение (вызывается при остановке бота)"""
+    global _connection
+    if _connection is not None and not _connection.closed:
+        _connection.close()
+    _connection = None
+
+
+# Соединение WorkerConnection, активное в текущем потоке
+_local = threading.local()
+
+
+class WorkerConnection:
+    """
+    Собственное соединение для запросов из рабочего потока
+
+    Внутри `with` функции модуля в текущем потоке работают через это
+    соединение (со своими подготовленными запросами), а не через общее,
+    поэтому транзакции потока не смешиваются с транзакциями бота.
+    Соединение открывается при первом входе и заново после обрыва.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.prepared: set = set()
+
+    def __enter__(self):
+        if self.connection is None or self.connection.closed:
+            self.connection = get_connection()
+            self.prepared = set()
+        _local.session = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.session = None
+
+    def close(self):
+        if self.connection is not None and not self.connection.closed:
+            self.connection.close()
+        self.connection = None
+
+
+class _LazyConnection:
+    """Прокси для глобального `conn`: все обращения идут к get_shared_connection()"""
+
+    def __getattr__(self, name):
+        return getattr(get_shared_connection(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_shared_connection(), name, value)
+
+
+conn = _LazyConnection()
+
+# Партиционируемые таблицы: имя -> колонка ключа партиционирования
+PARTITIONED_TABLES = {
+    "bonus_transactions": "created_at",
+    "maintenance_history": "performed_date",
+}
+
+# Сколько месяцев партиции остаются «горячими» до архивации
+PARTITION_KEEP_MONTHS = int(os.getenv("PARTITION_KEEP_MONTHS", "12"))
+# Табличное пространство для архивных партиций (необязательно)
+ARCHIVE_TABLESPACE = os.getenv("ARCHIVE_TABLESPACE") or None
+# Через сколько месяцев партиция выгружается в сжатый файл и удаляется (0 — никогда)
+PARTITION_EXPORT_MONTHS = int(os.getenv("PARTITION_EXPORT_MONTHS", "36"))
+# Каталог сжатых выгрузок партиций
+PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "archive/partitions")
+
+# Функции обслуживания партиций (те же, что в scripts/create_postgres_schema.py):
+# init_database ставит их сам, чтобы бот не зависел от запуска скрипта схемы
+PARTITION_FUNCTIONS = r"""
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(
+    parent TEXT, from_date DATE, months_ahead INTEGER DEFAULT 3
+) RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_date)::date;
+    month_end DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+    partition_name TEXT;
+    default_part REGCLASS;
+    key_column TEXT;
+    moved BIGINT;
+    created INTEGER := 0;
+BEGIN
+    SELECT NULLIF(p.partdefid, 0)::regclass, a.attname
+    INTO default_part, key_column
+    FROM pg_partitioned_table p
+    JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+    WHERE p.partrelid = parent::regclass;
+
+    WHILE month_start <= last_month LOOP
+        month_end := (month_start + INTERVAL '1 month')::date;
+        partition_name := format('%s_y%sm%s', parent, to_char(month_start, 'YYYY'), to_char(month_start, 'MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Строки месяца, попавшие в DEFAULT до создания партиции, не дают
+            -- её подключить: переносим их во временную таблицу и обратно
+            moved := 0;
+            IF default_part IS NOT NULL THEN
+                EXECUTE format('CREATE TEMP TABLE partition_rows (LIKE %I)', parent);
+                EXECUTE format('WITH moved_rows AS (DELETE FROM %s WHERE %I >= %L AND %I < %L RETURNING *) '
+                               'INSERT INTO partition_rows SELECT * FROM moved_rows',
+                               default_part, key_column, month_start, key_column, month_end);
+                GET DIAGNOSTICS moved = ROW_COUNT;
+            END IF;
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, parent, month_start, month_end);
+            IF default_part IS NOT NULL THEN
+                IF moved > 0 THEN
+                    EXECUTE format('INSERT INTO %I SELECT * FROM partition_rows', parent);
+                END IF;
+                DROP TABLE partition_rows;
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION old_partitions(parent TEXT, keep_months INTEGER)
+RETURNS SETOF TEXT AS $$
+    SELECT c.relname::text
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent::regclass
+      AND c.relname ~ '_y\d{4}m\d{2}$'
+      AND to_date(substring(c.relname FROM '(\d{4}m\d{2})$'), 'YYYY"m"MM')
+          < (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date
+    ORDER BY 1
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION archive_old_partitions(
+    parent TEXT, keep_months INTEGER DEFAULT 12, archive_tablespace TEXT DEFAULT NULL
+) RETURNS SETOF TEXT AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT p FROM old_partitions(parent, keep_months) p
+        WHERE COALESCE(obj_description(p::regclass, 'pg_class'), '') <> 'archived'
+    LOOP
+        IF archive_tablespace IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %I SET TABLESPACE %I', partition_name, archive_tablespace);
+        END IF;
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mark_partition_archived(partition_name TEXT) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('ALTER TABLE %I SET (autovacuum_enabled = false)', partition_name);
+    EXECUTE format('COMMENT ON TABLE %I IS %L', partition_name, 'archived');
+END;
+$$ LANGUAGE plpgsql;
+"""
 
 # Создание таблиц, если они не существуют
 def init_database():
@@ -84,6 +257,37 @@ def init_database():
             )
             """)
             
+            # Outbox побочных эффектов начисления: пишется в той же транзакции
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS accrual_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                event_type TEXT NOT NULL,
+                demand_id TEXT NOT NULL,
+                agent_id TEXT NOT NULL,
+                payload JSONB NOT NULL DEFAULT '{}',
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP,
+                UNIQUE (event_type, demand_id)
+            )
+            """)
+            cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_accrual_outbox_pending
+            ON accrual_outbox(next_attempt_at) WHERE status = 'pending'
+            """)
+            
+            # Курсоры сканера начислений (последний полностью обработанный moment)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS accrual_cursor (
+                name TEXT PRIMARY KEY,
+                moment TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            
             # Таблица loyalty_levels
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS loyalty_levels (
@@ -98,24 +302,25 @@ def init_database():
             )
             """)
             
-            # Таблица bonus_transactions
+            # Таблица bonus_transactions (помесячные партиции по created_at)
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS bonus_transactions (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 agent_id TEXT NOT NULL,
                 transaction_type TEXT NOT NULL,
                 amount INTEGER NOT NULL,
                 description TEXT NOT NULL,
                 related_demand_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at),
                 FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
-            )
+            ) PARTITION BY RANGE (created_at)
             """)
             
-            # Таблица maintenance_history
+            # Таблица maintenance_history (помесячные партиции по performed_date)
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS maintenance_history (
-                id SERIAL PRIMARY KEY,
+                id SERIAL,
                 agent_id TEXT NOT NULL,
                 work_id INTEGER NOT NULL,
                 performed_date DATE NOT NULL,
@@ -124,10 +329,25 @@ def init_database():
                 demand_id TEXT,
                 notes TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, performed_date),
                 FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
-            )
+            ) PARTITION BY RANGE (performed_date)
             """)
             
+            # Партиции — только для партиционированных таблиц
+            # (старые базы переводятся на партиции scripts/create_postgres_schema.py)
+            cursor.execute(PARTITION_FUNCTIONS)
+            for table_name in PARTITIONED_TABLES:
+                cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table_name,))
+                row = cursor.fetchone()
+                if row and row[0] == 'p':
+                    cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table_name}_default
+                        PARTITION OF {table_name} DEFAULT
+                    """)
+                    # Текущий и ближайшие месяцы пишутся в свои партиции, а не в DEFAULT
+                    cursor.execute("SELECT ensure_monthly_partitions(%s, CURRENT_DATE)", (table_name,))
+            
             # Таблица maintenance_settings
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS maintenance_settings (
@@ -146,7 +366,8 @@ def init_database():
             CREATE TABLE IF NOT EXISTS maintenance_service_mapping (
                 moysklad_service_name TEXT PRIMARY KEY,
                 work_id INTEGER NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE
+                is_active BOOLEAN DEFAULT TRUE,
+                match_type TEXT NOT NULL DEFAULT 'exact'
             )
             """)
             
@@ -169,6 +390,10 @@ def init_database():
             CREATE INDEX IF NOT EXISTS idx_maintenance_history_date 
                 ON maintenance_history(performed_date)
             """)
+            cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_bonus_transactions_agent_date
+                ON bonus_transactions(agent_id, created_at DESC)
+            """)
             
             conn.commit()
             log.info("База данных PostgreSQL успешно инициализирована")
@@ -177,17 +402,279 @@ def init_database():
         log.error(f"Ошибка инициализации базы данных: {e}")
         raise
 
-# Инициализируем базу данных при импорте модуля
-init_database()
+# ─── обслуживание партиций ──────────────────────────────────────────
+def export_partition(connection, table_name: str, partition: str) -> str:
+    """
+    Выгружает партицию в сжатый CSV и удаляет её из базы, возвращает путь к файлу
+
+    Файл <PARTITION_ARCHIVE_DIR>/<таблица>/<партиция>.csv.gz записывается на диск
+    до DROP, поэтому сбой на любом шаге оставляет данные в базе. Запись в
+    партицию заблокирована на время выгрузки, родительская таблица — только на
+    время DROP. Восстановление:
+        gunzip -c <файл> | psql -c "\\copy <таблица> FROM STDIN WITH (FORMAT csv, HEADER)"
+    """
+    directory = os.path.join(PARTITION_ARCHIVE_DIR, table_name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{partition}.csv.gz")
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {partition} IN SHARE MODE")
+        with open(path + ".tmp", "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+                cursor.copy_expert(f"COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + ".tmp", path)
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        cursor.execute(f"DROP TABLE {partition}")
+    connection.commit()
+    return path
+
+
+def maintain_partitions() -> Dict[str, Any]:
+    """
+    Создаёт партиции на ближайшие месяцы, архивирует старые и выгружает самые старые
+
+    Использует функции из PARTITION_FUNCTIONS (их ставит init_database).
+    Работает на собственном соединении: выгрузка, перенос в табличное
+    пространство и VACUUM идут долго и держат блокировки, поэтому вызывается из
+    отдельного потока. Партиции старше PARTITION_EXPORT_MONTHS уходят в сжатые
+    файлы (export_partition). Партиция отмечается архивной (автовакуум отключён)
+    только после успешного VACUUM FREEZE, иначе попытка повторится при следующем
+    обслуживании.
+    """
+    result = {"created": 0, "archived": [], "exported": []}
+    connection = get_connection()
+    try:
+        try:
+            with connection.cursor() as cursor:
+                for table_name in PARTITIONED_TABLES:
+                    cursor.execute("SELECT ensure_monthly_partitions(%s, CURRENT_DATE)", (table_name,))
+                    result["created"] += cursor.fetchone()[0]
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            log.error(f"Ошибка обслуживания партиций: {e}")
+            return result
+
+        if PARTITION_EXPORT_MONTHS:
+            for table_name in PARTITIONED_TABLES:
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT old_partitions(%s, %s)", (table_name, PARTITION_EXPORT_MONTHS))
+                        expired = [row[0] for row in cursor.fetchall()]
+                    connection.commit()
+                except Exception as e:
+                    connection.rollback()
+                    log.error(f"Ошибка поиска партиций для выгрузки {table_name}: {e}")
+                    continue
+                for partition in expired:
+                    try:
+                        result["exported"].append(export_partition(connection, table_name, partition))
+                    except Exception as e:
+                        connection.rollback()
+                        log.error(f"Ошибка выгрузки партиции {partition}: {e}")
+
+        candidates = []
+        try:
+            with connection.cursor() as cursor:
+                for table_name in PARTITIONED_TABLES:
+                    cursor.execute(
+                        "SELECT archive_old_partitions(%s, %s, %s)",
+                        (table_name, PARTITION_KEEP_MONTHS, ARCHIVE_TABLESPACE)
+                    )
+                    candidates.extend(row[0] for row in cursor.fetchall())
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            log.error(f"Ошибка обслуживания партиций: {e}")
+            return result
+
+        # VACUUM нельзя выполнять внутри транзакции
+        connection.autocommit = True
+        for partition in candidates:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"VACUUM (FREEZE, ANALYZE) {partition}")
+                    cursor.execute("SELECT mark_partition_archived(%s)", (partition,))
+                result["archived"].append(partition)
+            except Exception as e:
+                log.error(f"Ошибка заморозки партиции {partition}: {e}")
+    finally:
+        connection.close()
+
+    log.info(
+        f"Партиции: создано {result['created']}, архивировано {len(result['archived'])}, "
+        f"выгружено {len(result['exported'])}"
+    )
+    return result
+
+
+# Первый проход — не сразу при старте: партиции текущих месяцев создаёт init_database
+PARTITION_MAINTENANCE_DELAY = 10 * 60
+PARTITION_MAINTENANCE_INTERVAL = 24 * 60 * 60
+
+
+async def partition_maintenance_loop():
+    """Фоновое обслуживание партиций раз в сутки, в отдельном потоке"""
+    await asyncio.sleep(PARTITION_MAINTENANCE_DELAY)
+    while True:
+        try:
+            await asyncio.to_thread(maintain_partitions)
+        except Exception as e:
+            log.error(f"Ошибка обслуживания партиций: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+
+# ─── подготовленные запросы для горячих путей ───────────────────────
+# Самые частые запросы бота готовятся на сервере один раз за сессию,
+# чтобы PostgreSQL не разбирал и не планировал их заново при каждом вызове.
+# Формат: имя -> (типы параметров, текст запроса)
+HOT_STATEMENTS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "agent_by_tg": (
+        ("BIGINT",),
+        "SELECT agent_id FROM user_map WHERE tg_id = $1",
+    ),
+    "balance_by_agent": (
+        ("TEXT",),
+        "SELECT balance FROM bonuses WHERE agent_id = $1",
+    ),
+    "tg_by_agent": (
+        ("TEXT",),
+        "SELECT tg_id FROM user_map WHERE agent_id = $1",
+    ),
+    "level_by_agent": (
+        ("TEXT",),
+        "SELECT level_id, total_spent, total_earned, total_redeemed "
+        "FROM loyalty_levels WHERE agent_id = $1",
+    ),
+    "demand_processed": (
+        ("TEXT",),
+        "SELECT 1 FROM accrual_log WHERE demand_id = $1",
+    ),
+    "demands_processed": (
+        ("TEXT[]",),
+        "SELECT demand_id FROM accrual_log WHERE demand_id = ANY($1)",
+    ),
+}
+
+# Имена запросов, уже подготовленных в текущей сессии
+_prepared: set = set()
+
+# Статистика выполнения: имя -> {"calls", "total_ms", "max_ms"}
+_statement_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _prepared_names() -> set:
+    """Запросы, подготовленные в сессии, с которой работает текущий поток"""
+    session = getattr(_local, "session", None)
+    return _prepared if session is None else session.prepared
+
+
+def _prepare(name: str):
+    """Готовит запрос на сервере (PREPARE), если он ещё не подготовлен"""
+    prepared = _prepared_names()
+    if name in prepared:
+        return
+    param_types, sql = HOT_STATEMENTS[name]
+    # PREPARE не транзакционен, поэтому транзакцию вызывающего не коммитим
+    with conn.cursor() as cursor:
+        cursor.execute(f"PREPARE {name}({', '.join(param_types)}) AS {sql}")
+    prepared.add(name)
+
+
+def prepare_hot_statements():
+    """Готовит все горячие запросы заранее"""
+    try:
+        for name in HOT_STATEMENTS:
+            _prepare(name)
+        conn.commit()
+        log.info(f"Подготовлено запросов: {len(_prepared)}")
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка подготовки запросов: {e}")
+
+
+def _record_timing(name: str, elapsed_ms: float):
+    stats = _statement_stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["calls"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def _undo_execute(savepoint: Optional[str]):
+    """Откатывает неудачный EXECUTE: до точки сохранения или транзакцию, открытую самим запросом"""
+    if savepoint:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}; RELEASE SAVEPOINT {savepoint}")
+    else:
+        conn.rollback()
+
+
+def execute_prepared(name: str, params: tuple, cursor_factory=None) -> list:
+    """
+    Выполняет подготовленный запрос (EXECUTE) и возвращает все строки
+
+    Если сервер потерял подготовленный запрос (например, после переподключения),
+    запрос готовится заново и выполняется повторно. Транзакцией управляет
+    вызывающий, как и при обычном cursor.execute: запрос её не коммитит, а при
+    ошибке внутри открытой транзакции откатывается только до своей точки
+    сохранения, не отменяя изменений вызывающего.
+    """
+    # Точка сохранения нужна, только если транзакция вызывающего уже открыта:
+    # иначе откатывать нечего, и лишний запрос на горячем пути ни к чему
+    savepoint = f"{name}_exec" if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE else None
+    _prepare(name)
+    statement = f"EXECUTE {name}({', '.join(['%s'] * len(params))})"
+    if savepoint:
+        statement = f"SAVEPOINT {savepoint}; {statement}"
+    started = time.perf_counter()
+    try:
+        for attempt in range(2):
+            try:
+                with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                    cursor.execute(statement, params)
+                    rows = cursor.fetchall()
+                    if savepoint:
+                        cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+                return rows
+            except pg_errors.InvalidSqlStatementName:
+                if attempt:
+                    raise
+                _undo_execute(savepoint)
+                _prepared_names().discard(name)
+                _prepare(name)
+    except Exception:
+        _undo_execute(savepoint)
+        raise
+    finally:
+        _record_timing(name, (time.perf_counter() - started) * 1000)
+
+
+def get_statement_stats() -> Dict[str, Dict[str, float]]:
+    """Возвращает статистику выполнения подготовленных запросов"""
+    return {
+        name: {
+            "calls": stats["calls"],
+            "total_ms": round(stats["total_ms"], 3),
+            "avg_ms": round(stats["total_ms"] / stats["calls"], 3) if stats["calls"] else 0.0,
+            "max_ms": round(stats["max_ms"], 3),
+        }
+        for name, stats in _statement_stats.items()
+    }
+
+
+
+def startup():
+    """Создаёт таблицы и готовит горячие запросы (вызывается при запуске бота)"""
+    init_database()
+    prepare_hot_statements()
 
 # ─── функции для работы с пользователями ───────────────────────────────
 def get_agent_id(tg_id: int) -> Optional[str]:
     """Получает ID агента (контрагента) по ID пользователя Telegram"""
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT agent_id FROM user_map WHERE tg_id=%s", (tg_id,))
-            row = cursor.fetchone()
-            return row[0] if row else None
+        rows = execute_prepared("agent_by_tg", (tg_id,))
+        return rows[0][0] if rows else None
     except Exception as e:
         log.error(f"Ошибка получения agent_id: {e}")
         return None
@@ -239,10 +726,8 @@ def user_contact(tg_id: int) -> Tuple[str, str]:
 def get_balance(agent_id: str) -> int:
     """Получает текущий баланс бонусов"""
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT balance FROM bonuses WHERE agent_id=%s", (agent_id,))
-            row = cursor.fetchone()
-            return row[0] if row else 0
+        rows = execute_prepared("balance_by_agent", (agent_id,))
+        return rows[0][0] if rows else 0
     except Exception as e:
         log.error(f"Ошибка получения баланса: {e}")
         return 0
@@ -266,15 +751,268 @@ def change_balance(agent_id: str, delta: int):
 def get_tg_id_by_agent(agent_id: str) -> Optional[int]:
     """Получает Telegram ID пользователя по его agent_id"""
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT tg_id FROM user_map WHERE agent_id=%s", (agent_id,))
-            row = cursor.fetchone()
-            return row[0] if row else None
+        rows = execute_prepared("tg_by_agent", (agent_id,))
+        return rows[0][0] if rows else None
     except Exception as e:
         log.error(f"Ошибка получения tg_id: {e}")
         return None
 
 
+def is_demand_processed(demand_id: str) -> bool:
+    """Проверяет, начислены ли уже бонусы за отгрузку"""
+    try:
+        return bool(execute_prepared("demand_processed", (demand_id,)))
+    except Exception as e:
+        log.error(f"Ошибка проверки журнала начислений: {e}")
+        return False
+
+
+def filter_processed_demands(demand_ids: List[str]) -> set:
+    """Возвращает те из demand_ids, что уже есть в журнале начислений (один запрос)"""
+    if not demand_ids:
+        return set()
+    rows = execute_prepared("demands_processed", (list(demand_ids),))
+    return {row[0] for row in rows}
+
+
+def load_recent_processed_demands(days: int = 30) -> set:
+    """Загружает ID отгрузок, обработанных за последние дни (для проверки в памяти)"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT demand_id FROM accrual_log WHERE processed_at >= %s",
+                (datetime.now() - timedelta(days=days),)
+            )
+            rows = cursor.fetchall()
+        conn.commit()
+        return {row[0] for row in rows}
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка загрузки журнала начислений: {e}")
+        return set()
+
+
+def get_accrual_cursor(name: str) -> Optional[datetime]:
+    """Возвращает moment, до которого отгрузки уже просканированы"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT moment FROM accrual_cursor WHERE name = %s", (name,))
+            row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка чтения курсора начислений {name}: {e}")
+        raise
+
+
+def set_accrual_cursor(name: str, moment: datetime):
+    """Сохраняет позицию сканера начислений"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            INSERT INTO accrual_cursor(name, moment, updated_at)
+            VALUES(%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT(name) DO UPDATE SET moment = EXCLUDED.moment, updated_at = CURRENT_TIMESTAMP
+            """, (name, moment))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка сохранения курсора начислений {name}: {e}")
+        raise
+
+
+def _insert_outbox_events(cursor, agent_id: str, demand_id: str, events: List[Tuple[str, dict]]):
+    """Добавляет события в outbox (в транзакции вызывающего)"""
+    for event_type, payload in events:
+        cursor.execute("""
+        INSERT INTO accrual_outbox(event_type, demand_id, agent_id, payload)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT(event_type, demand_id) DO NOTHING
+        """, (event_type, demand_id, agent_id, Json(payload)))
+
+
+def record_accrual(agent_id: str, demand_id: str, bonus_amount: int,
+                   purchase_amount: int, description: str,
+                   events: Optional[List[Tuple[str, dict]]] = None,
+                   notify: bool = True, rules=None) -> Optional[Dict[str, Any]]:
+    """
+    Записывает начисление за отгрузку одной транзакцией
+    
+    Запись в accrual_log, изменение баланса, транзакция бонусов,
+    обновление суммы трат и события outbox (events и level_up при
+    повышении уровня, если notify) фиксируются вместе. Вставка в accrual_log
+    служит «захватом» отгрузки: если отгрузка уже обработана,
+    ничего не меняется и возвращается None. rules — правила уровней
+    (TierRules), если их уже получил вызывающий, иначе текущие.
+    
+    Returns:
+        dict: данные об изменении уровня (как update_total_spent) или None
+    """
+    from .loyalty import get_rules
+    
+    rules = rules or get_rules()
+    
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            INSERT INTO accrual_log(demand_id) VALUES(%s)
+            ON CONFLICT(demand_id) DO NOTHING
+            RETURNING demand_id
+            """, (demand_id,))
+            if cursor.fetchone() is None:
+                conn.rollback()
+                return None
+            
+            _insert_outbox_events(cursor, agent_id, demand_id, events or [])
+            
+            if bonus_amount <= 0:
+                conn.commit()
+                return {"old_level": None, "new_level": None, "total_spent": None, "level_changed": False}
+            
+            cursor.execute("""
+            INSERT INTO bonuses(agent_id, balance) VALUES(%s, %s)
+            ON CONFLICT(agent_id) DO UPDATE SET balance = bonuses.balance + %s
+            """, (agent_id, bonus_amount, bonus_amount))
+            
+            cursor.execute("""
+            INSERT INTO loyalty_levels(agent_id, level_id, total_spent)
+            VALUES (%s, 1, 0)
+            ON CONFLICT(agent_id) DO NOTHING
+            """, (agent_id,))
+            cursor.execute(
+                "SELECT level_id, total_spent FROM loyalty_levels WHERE agent_id = %s FOR UPDATE",
+                (agent_id,)
+            )
+            old_level, total_spent = cursor.fetchone()
+            new_total = total_spent + purchase_amount
+            new_level = rules.level_for(new_total)
+            
+            cursor.execute("""
+            UPDATE loyalty_levels
+            SET total_spent = %s, level_id = %s, total_earned = total_earned + %s,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE agent_id = %s
+            """, (new_total, new_level, bonus_amount, agent_id))
+            
+            cursor.execute("""
+            INSERT INTO bonus_transactions
+            (agent_id, transaction_type, amount, description, related_demand_id)
+            VALUES (%s, 'accrual', %s, %s, %s)
+            """, (agent_id, bonus_amount, description, demand_id))
+            
+            if notify and new_level > old_level:
+                _insert_outbox_events(cursor, agent_id, demand_id, [
+                    ("level_up", {"old_level": old_level, "new_level": new_level})
+                ])
+        
+        conn.commit()
+        log.info(f"Начисление записано: agent_id={agent_id}, demand_id={demand_id}, amount={bonus_amount}")
+        return {
+            "old_level": old_level,
+            "new_level": new_level,
+            "total_spent": new_total,
+            "level_changed": new_level > old_level
+        }
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка записи начисления: {e}")
+        raise
+
+
+# ─── Outbox ───
+
+OUTBOX_MAX_ATTEMPTS = 10
+
+
+def claim_outbox_events(limit: int = 50, lease_seconds: int = 300,
+                        demand_ids: Optional[List[str]] = None,
+                        event_types: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Забирает готовые к отправке события outbox
+    
+    Событие «арендуется» на lease_seconds: если процесс упадёт до
+    подтверждения, после истечения аренды событие будет выдано снова
+    (доставка at-least-once). demand_ids и event_types — забрать только
+    события этих отгрузок и типов, не трогая очередь остальных.
+    """
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+            UPDATE accrual_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT id FROM accrual_outbox
+                WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                  AND (%s::text[] IS NULL OR demand_id = ANY(%s::text[]))
+                  AND (%s::text[] IS NULL OR event_type = ANY(%s::text[]))
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, event_type, demand_id, agent_id, payload, attempts
+            """, (lease_seconds, demand_ids, demand_ids, event_types, event_types, limit))
+            rows = cursor.fetchall()
+        conn.commit()
+        return sorted((dict(row) for row in rows), key=lambda row: row["id"])
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка выборки событий outbox: {e}")
+        raise
+
+
+def complete_outbox_event(event_id: int):
+    """Отмечает событие outbox как доставленное"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            UPDATE accrual_outbox
+            SET status = 'done', processed_at = CURRENT_TIMESTAMP, last_error = NULL
+            WHERE id = %s
+            """, (event_id,))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка подтверждения события outbox {event_id}: {e}")
+        raise
+
+
+def fail_outbox_event(event_id: int, attempts: int, error: str):
+    """Откладывает событие с экспоненциальной задержкой или помечает его dead"""
+    status = "dead" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+    retry_in = min(30 * 2 ** (attempts - 1), 3600)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            UPDATE accrual_outbox
+            SET status = %s, last_error = %s,
+                next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+            WHERE id = %s
+            """, (status, error[:1000], retry_in, event_id))
+        conn.commit()
+        if status == "dead":
+            log.error(f"Событие outbox {event_id} не доставлено после {attempts} попыток: {error}")
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка обновления события outbox {event_id}: {e}")
+        raise
+
+
+def mark_demand_processed(demand_id: str):
+    """Отмечает отгрузку как обработанную в журнале начислений"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            INSERT INTO accrual_log(demand_id) VALUES(%s)
+            ON CONFLICT(demand_id) DO NOTHING
+            """, (demand_id,))
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка записи в журнал начислений: {e}")
+
+
 # ─── функции для работы с уровнями лояльности ───────────────────────
 def init_loyalty_level(agent_id: str):
     """Инициализирует уровень лояльности для нового клиента"""
@@ -295,18 +1033,13 @@ def init_loyalty_level(agent_id: str):
 def get_loyalty_level(agent_id: str) -> Dict[str, int]:
     """Получает информацию об уровне лояльности клиента"""
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("""
-            SELECT level_id, total_spent, total_earned, total_redeemed
-            FROM loyalty_levels WHERE agent_id=%s
-            """, (agent_id,))
-            row = cursor.fetchone()
-            
-            if not row:
-                init_loyalty_level(agent_id)
-                return {"level_id": 1, "total_spent": 0, "total_earned": 0, "total_redeemed": 0}
-            
-            return dict(row)
+        rows = execute_prepared("level_by_agent", (agent_id,), cursor_factory=DictCursor)
+        
+        if not rows:
+            init_loyalty_level(agent_id)
+            return {"level_id": 1, "total_spent": 0, "total_earned": 0, "total_redeemed": 0}
+        
+        return dict(rows[0])
     except Exception as e:
         log.error(f"Ошибка получения уровня лояльности: {e}")
         return {"level_id": 1, "total_spent": 0, "total_earned": 0, "total_redeemed": 0}
@@ -405,3 +1138,72 @@ def get_bonus_transactions(agent_id: str, days: int = 30) -> List[Dict[str, Any]
     except Exception as e:
         log.error(f"Ошибка получения истории транзакций: {e}")
         return []
+
+
+def get_bonus_transactions_page(agent_id: str, limit: int = 10,
+                                cursor: Optional[tuple] = None, direction: str = "next") -> Dict[str, Any]:
+    """
+    Получает одну страницу истории транзакций (keyset-пагинация)
+
+    Args:
+        agent_id: ID агента
+        limit: размер страницы
+        cursor: (created_at, id) граничной записи предыдущей страницы
+        direction: "next" — более старые записи, "prev" — более новые
+
+    Returns:
+        dict: {"items": [...], "next_cursor": ..., "prev_cursor": ...}
+    """
+    params: list = [agent_id]
+    where = "agent_id = %s"
+    order = "DESC"
+    if cursor:
+        if direction == "prev":
+            where += " AND (created_at, id) > (%s::timestamp, %s)"
+            order = "ASC"
+        else:
+            where += " AND (created_at, id) < (%s::timestamp, %s)"
+        params.extend(cursor)
+
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(f"""
+            SELECT id, transaction_type, amount, description, related_demand_id, created_at
+            FROM bonus_transactions
+            WHERE {where}
+            ORDER BY created_at {order}, id {order}
+            LIMIT %s
+            """, (*params, limit + 1))
+            rows = cur.fetchall()
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Ошибка получения страницы транзакций: {e}")
+        return {"items": [], "next_cursor": None, "prev_cursor": None}
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+
+    items = [
+        {
+            "id": row["id"],
+            "type": row["transaction_type"],
+            "amount": row["amount"],
+            "description": row["description"],
+            "related_demand_id": row["related_demand_id"],
+            "date": row["created_at"],
+            "cursor": (row["created_at"].isoformat(), row["id"])
+        }
+        for row in rows
+    ]
+
+    # Есть ли страницы в каждую сторону от текущей
+    has_older = has_more if direction == "next" or not cursor else True
+    has_newer = bool(cursor) and (direction == "next" or has_more)
+
+    return {
+        "items": items,
+        "next_cursor": items[-1]["cursor"] if items and has_older else None,
+        "prev_cursor": items[0]["cursor"] if items and has_newer else None
+    }
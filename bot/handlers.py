@@ -11,16 +11,14 @@ from bot.yclients import services, staff, free_slots, book_dates, create_record,
 from bot.keyboards import shipments_kb, main_menu_premium, balance_detail_kb, profile_menu_kb, support_menu_kb, start_choice_kb, mini_app_menu_kb
 from bot.db import register_mapping, user_contact
 from bot.config import REDEEM_CAP, MINIAPP_URL
-from bot.db import (get_agent_id, register_mapping, get_balance, change_balance, conn, get_loyalty_level, init_loyalty_level)
-from bot.moysklad import (find_agent_by_phone, fetch_shipments, fetch_demand_full, apply_discount)
+from bot.db import (get_agent_id, register_mapping, get_balance, change_balance, conn, get_loyalty_level, init_loyalty_level,
+                    get_bonus_transactions_page)
+from bot.moysklad import (find_agent_by_phone, fetch_shipments, fetch_shipments_page, fetch_demand_full, apply_discount)
 from bot.moysklad import MS_BASE, HEADERS
 from bot.formatting import fmt_money, fmt_date_local, render_positions
 # from bot.accrual import doc_age_seconds, accrue_for_demand
 from bot.loyalty import get_redeem_cap, format_level_status, format_level_benefits
-from bot.analytics import (
-    get_client_statistics, get_client_ranking, get_bonus_history,
-    format_client_statistics, format_client_ranking, format_bonus_history
-)
+from bot.analytics import render_analytics_view, get_cached_view
 from bot.maintenance import (
     get_all_maintenance_status, format_maintenance_summary, format_maintenance_status,
     add_manual_maintenance, MAINTENANCE_WORKS
@@ -51,18 +49,82 @@ def confirm_redeem_kb() -> types.InlineKeyboardMarkup:
     kb.adjust(1)
     return kb.as_markup()
 
-def list_visits_kb(rows: list[dict]) -> types.InlineKeyboardMarkup:
+# Размеры страниц истории
+VISITS_PAGE_SIZE = 10
+TRANSACTIONS_PAGE_SIZE = 10
+
+
+def visits_cursor_data(direction: str, cursor: tuple) -> str:
+    """
+    callback_data листания визитов по курсору (moment, id)
+
+    moment пишется одними цифрами, чтобы вместе с id отгрузки уложиться
+    в 64 байта callback_data.
+    """
+    moment, demand_id = cursor
+    return f"vh_{direction}_{''.join(ch for ch in moment if ch.isdigit())}_{demand_id}"
+
+
+def parse_visits_cursor(value: str):
+    """Курсор из callback_data; кнопки старого формата содержат только moment"""
+    if "_" not in value:
+        return value
+    digits, demand_id = value.split("_", 1)
+    moment = f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:14]}"
+    if len(digits) > 14:
+        moment += f".{digits[14:]}"
+    return moment, demand_id
+
+
+def list_visits_kb(page: dict) -> types.InlineKeyboardMarkup:
+    """Список визитов одной страницы с кнопками листания (курсор — moment и id отгрузки)"""
     kb = InlineKeyboardBuilder()
-    for d in rows:
+    for d in page["items"]:
         kb.button(
             text=f"Чек №{d.get('name') or d['id'][:8]} · {fmt_date_local(d['moment'])}",
             callback_data=f"visit_{d['id']}",
         )
-    kb.button(text="◀️ Назад", callback_data="back_main")
     kb.adjust(1)
+    nav = []
+    if page["prev_cursor"]:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Новее", callback_data=visits_cursor_data("prev", page["prev_cursor"])))
+    if page["next_cursor"]:
+        nav.append(types.InlineKeyboardButton(text="Старее ➡️", callback_data=visits_cursor_data("next", page["next_cursor"])))
+    if nav:
+        kb.row(*nav)
+    kb.row(types.InlineKeyboardButton(text="◀️ Назад", callback_data="back_main"))
+    return kb.as_markup()
+
+
+def transactions_page_kb(page: dict) -> types.InlineKeyboardMarkup:
+    """Кнопки листания истории операций (курсор — created_at и id транзакции)"""
+    kb = InlineKeyboardBuilder()
+    nav = []
+    if page["prev_cursor"]:
+        created_at, tx_id = page["prev_cursor"]
+        nav.append(types.InlineKeyboardButton(text="⬅️ Новее", callback_data=f"tx_prev_{tx_id}_{created_at}"))
+    if page["next_cursor"]:
+        created_at, tx_id = page["next_cursor"]
+        nav.append(types.InlineKeyboardButton(text="Старее ➡️", callback_data=f"tx_next_{tx_id}_{created_at}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(types.InlineKeyboardButton(text="◀️ Назад к балансу", callback_data="back_to_balance"))
     return kb.as_markup()
 
 
+def format_transactions_page(page: dict) -> str:
+    """Форматирует страницу истории операций"""
+    if not page["items"]:
+        return "📝 <b>История операций</b>\n\nПока нет операций"
+    
+    message = "📝 <b>История операций</b>\n\n"
+    for tx in page["items"]:
+        date = tx["date"].strftime("%d.%m.%Y %H:%M")
+        icon = "➕" if tx["type"] == "accrual" else "➖"
+        message += f"{icon} {fmt_money(tx['amount'])} - {tx['description']}\n<i>{date}</i>\n\n"
+    return message
+
+
 def visit_detail_kb() -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.button(text="◀️ К списку", callback_data="back_history")
@@ -530,8 +592,8 @@ def register(dp):
                 "Пожалуйста, выполните /start"
             )
 
-        visits = fetch_shipments(aid, limit=20)
-        if not visits:
+        page = fetch_shipments_page(aid, limit=VISITS_PAGE_SIZE)
+        if not page["items"]:
             return await m.answer(
                 "📝 История посещений пока пуста",
                 reply_markup=MAIN_MENU_KB
@@ -539,8 +601,26 @@ def register(dp):
 
         await m.answer(
             "📋 Выберите визит для просмотра деталей:",
-            reply_markup=list_visits_kb(visits)
+            reply_markup=list_visits_kb(page)
+        )
+
+    # листание истории посещений
+    @dp.callback_query(F.data.startswith("vh_"))
+    async def cb_visits_page(cq: types.CallbackQuery):
+        aid = get_agent_id(cq.from_user.id)
+        if not aid:
+            return await cq.answer()
+        _, direction, cursor = cq.data.split("_", 2)
+        page = fetch_shipments_page(
+            aid, limit=VISITS_PAGE_SIZE, cursor=parse_visits_cursor(cursor), direction=direction
+        )
+        if not page["items"]:
+            return await cq.answer("Больше визитов нет.", show_alert=True)
+        await cq.message.edit_text(
+            "📋 Выберите визит для просмотра деталей:",
+            reply_markup=list_visits_kb(page)
         )
+        await cq.answer()
 
     # просмотр чека
     @dp.callback_query(lambda c: c.data.startswith("visit_"))
@@ -589,10 +669,10 @@ def register(dp):
         aid = get_agent_id(cq.from_user.id)
         if not aid:
             return await cq.answer()
-        visits = fetch_shipments(aid, limit=20)
-        if not visits:
+        page = fetch_shipments_page(aid, limit=VISITS_PAGE_SIZE)
+        if not page["items"]:
             return await cq.answer("История пуста.", show_alert=True)
-        await cq.message.edit_text("Недавние посещения:", reply_markup=list_visits_kb(visits))
+        await cq.message.edit_text("Недавние посещения:", reply_markup=list_visits_kb(page))
         await cq.answer()
 
     # показать статус лояльности
@@ -683,32 +763,11 @@ def register(dp):
             return
         
         try:
-            # Получаем последние 10 транзакций
-            transactions = conn.execute("""
-                SELECT operation_type, amount, description, created_at 
-                FROM bonus_transactions 
-                WHERE agent_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT 10
-            """, (aid,)).fetchall()
-            
-            if not transactions:
-                message = "📝 <b>История операций</b>\n\nПока нет операций"
-            else:
-                message = "📝 <b>История операций</b>\n\n"
-                for tx in transactions:
-                    op_type, amount, desc, created_at = tx
-                    date = datetime.fromisoformat(created_at).strftime("%d.%m.%Y %H:%M")
-                    icon = "➕" if op_type == "accrual" else "➖"
-                    message += f"{icon} {fmt_money(amount)} - {desc}\n<i>{date}</i>\n\n"
-            
-            kb = InlineKeyboardBuilder()
-            kb.button(text="◀️ Назад к балансу", callback_data="back_to_balance")
-            kb.adjust(1)
-            
+            # Первая страница: последние операции
+            page = get_bonus_transactions_page(aid, limit=TRANSACTIONS_PAGE_SIZE)
             await cq.message.edit_text(
-                message,
-                reply_markup=kb.as_markup(),
+                format_transactions_page(page),
+                reply_markup=transactions_page_kb(page),
                 parse_mode="HTML"
             )
         except Exception as e:
@@ -717,6 +776,32 @@ def register(dp):
         
         await cq.answer()
     
+    # листание истории операций
+    @dp.callback_query(F.data.startswith("tx_"))
+    async def cb_transactions_page(cq: types.CallbackQuery):
+        aid = get_agent_id(cq.from_user.id)
+        if not aid:
+            await cq.answer("⚠️ Необходима авторизация", show_alert=True)
+            return
+        
+        try:
+            _, direction, tx_id, created_at = cq.data.split("_", 3)
+            page = get_bonus_transactions_page(
+                aid, limit=TRANSACTIONS_PAGE_SIZE, cursor=(created_at, int(tx_id)), direction=direction
+            )
+            if not page["items"]:
+                return await cq.answer("Больше операций нет.", show_alert=True)
+            await cq.message.edit_text(
+                format_transactions_page(page),
+                reply_markup=transactions_page_kb(page),
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            log.error(f"Ошибка при листании истории транзакций: {e}")
+            await cq.answer("❌ Ошибка при загрузке истории", show_alert=True)
+        
+        await cq.answer()
+    
     @dp.callback_query(F.data == "show_achievements")
     async def cb_show_achievements(cq: types.CallbackQuery):
         aid = get_agent_id(cq.from_user.id)
@@ -1003,11 +1088,12 @@ def register(dp):
             await cq.answer("⚠️ Необходима авторизация", show_alert=True)
             return
         
-        await cq.message.edit_text("⏳ Загрузка статистики...")
+        # Из кэша экран показывается сразу, без промежуточного сообщения
+        if get_cached_view(aid, "stats") is None:
+            await cq.message.edit_text("⏳ Загрузка статистики...")
         
         try:
-            stats = get_client_statistics(aid)
-            message = format_client_statistics(stats)
+            message = render_analytics_view(aid, "stats")
             
             kb = InlineKeyboardBuilder()
             kb.button(text="◀️ Назад к аналитике", callback_data="back_analytics")
@@ -1035,11 +1121,12 @@ def register(dp):
             await cq.answer("⚠️ Необходима авторизация", show_alert=True)
             return
         
-        await cq.message.edit_text("⏳ Загрузка рейтинга...")
+        # Из кэша экран показывается сразу, без промежуточного сообщения
+        if get_cached_view(aid, "ranking") is None:
+            await cq.message.edit_text("⏳ Загрузка рейтинга...")
         
         try:
-            ranking = get_client_ranking(aid)
-            message = format_client_ranking(ranking, aid)
+            message = render_analytics_view(aid, "ranking")
             
             kb = InlineKeyboardBuilder()
             kb.button(text="◀️ Назад к аналитике", callback_data="back_analytics")
@@ -1067,11 +1154,12 @@ def register(dp):
             await cq.answer("⚠️ Необходима авторизация", show_alert=True)
             return
         
-        await cq.message.edit_text("⏳ Загрузка истории...")
+        # Из кэша экран показывается сразу, без промежуточного сообщения
+        if get_cached_view(aid, "history") is None:
+            await cq.message.edit_text("⏳ Загрузка истории...")
         
         try:
-            history = get_bonus_history(aid)
-            message = format_bonus_history(history)
+            message = render_analytics_view(aid, "history")
             
             kb = InlineKeyboardBuilder()
             kb.button(text="◀️ Назад к аналитике", callback_data="back_analytics")
@@ -1299,13 +1387,19 @@ def register(dp):
         await state.set_state(MaintenanceAdd.wait_mileage)
         
         aid = get_agent_id(m.from_user.id)
-        from bot.maintenance import get_current_mileage
-        current_mileage = get_current_mileage(aid)
+        from bot.maintenance import get_mileage_estimate
+        estimate = get_mileage_estimate(aid)
+        if estimate is None:
+            mileage_line = "Текущий пробег неизвестен"
+        elif estimate["fresh"] and not estimate["estimated"]:
+            mileage_line = f"Текущий пробег: {estimate['mileage']:,} км"
+        else:
+            mileage_line = f"Текущий пробег: ≈{estimate['mileage']:,} км (оценка)"
         
         await m.answer(
             f"🛣️ <b>Пробег при выполнении работы</b>\n\n"
             f"Введите пробег в километрах (только цифры)\n"
-            f"Текущий пробег: {current_mileage:,} км",
+            f"{mileage_line}",
             parse_mode="HTML"
         )
     
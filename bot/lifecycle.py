@@ -0,0 +1,94 @@
+# loyalty-bot/bot/lifecycle.py
+"""
+Жизненный цикл бота: явные хуки запуска и остановки и отчёт о времени старта
+"""
+
+import sys
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import List, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """Замеры этапов запуска бота"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    def record(self, name: str, started_at: float):
+        """Записывает этап, начавшийся в started_at (perf_counter)"""
+        self.phases.append((name, (time.perf_counter() - started_at) * 1000))
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замеряет этап запуска"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started_at)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started_at) * 1000
+
+    def summary(self) -> str:
+        parts = ", ".join(f"{name} {ms:.0f} мс" for name, ms in self.phases)
+        return f"Запуск за {self.total_ms():.0f} мс ({parts})"
+
+
+startup_report = StartupReport()
+
+# Фоновые задачи, запущенные при старте и останавливаемые при завершении
+_background_tasks: List[asyncio.Task] = []
+
+
+def mark_process_start(started_at: float):
+    """Переносит начало отсчёта на момент запуска главного модуля"""
+    startup_report.started_at = started_at
+
+
+async def on_startup():
+    """Инициализация хранилищ перед началом polling"""
+    from .db import init_db
+    from .maintenance import init_maintenance_tables, mileage_refresh_loop
+
+    with startup_report.phase("sqlite"):
+        init_db()
+    with startup_report.phase("maintenance"):
+        init_maintenance_tables()
+
+    # PostgreSQL инициализируется, только если модуль уже используется
+    if "bot.db_postgres" in sys.modules:
+        db_postgres = sys.modules["bot.db_postgres"]
+        with startup_report.phase("postgres"):
+            db_postgres.startup()
+        # Партиции на ближайшие месяцы создаются заранее, старые архивируются
+        _background_tasks.append(asyncio.create_task(db_postgres.partition_maintenance_loop()))
+
+    # Пробег обновляется в фоне, а не в запросе пользователя
+    _background_tasks.append(asyncio.create_task(mileage_refresh_loop()))
+
+    log.info(startup_report.summary())
+
+
+async def on_shutdown():
+    """Закрытие соединений при остановке бота"""
+    from .db import close_connection
+    from .messenger import messenger
+
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+    # Сначала дожидаемся исходящих сообщений, затем закрываем базы
+    await messenger.stop()
+    close_connection()
+    if "bot.db_postgres" in sys.modules:
+        sys.modules["bot.db_postgres"].close_connection()
+    log.info("Соединения с базами данных закрыты")
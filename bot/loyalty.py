@@ -3,9 +3,25 @@
 Система уровней лояльности для автосервиса
 """
 
-from typing import Dict, Any
+import os
+import copy
+import json
+import time
+import bisect
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Dict, Any, List, Optional
 from .formatting import fmt_money
 
+log = logging.getLogger(__name__)
+
+# Правила уровней загружаются из таблицы loyalty_rules (SQLite) или JSON-файла,
+# при их отсутствии действуют уровни по умолчанию (LOYALTY_LEVELS ниже)
+LOYALTY_RULES_PATH = os.getenv("LOYALTY_RULES_PATH", "loyalty_rules.json")
+# Как часто проверять, не изменились ли правила, сек
+RULES_CHECK_INTERVAL = 30
+
 # Конфигурация уровней лояльности
 LOYALTY_LEVELS = {
     1: {
@@ -65,27 +81,240 @@ LOYALTY_LEVELS = {
 }
 
 
+_DEFAULT_LEVELS = copy.deepcopy(LOYALTY_LEVELS)
+
+
+# ─── Скомпилированные правила ───
+
+def _parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+class TierRules:
+    """
+    Правила уровней, скомпилированные для быстрого поиска
+    
+    Пороги хранятся отсортированным списком, уровень по сумме трат
+    находится через bisect. Ставка бонусов = ставка уровня (или ставка
+    категории товара, если она задана для уровня) × множители активных акций.
+    
+    Формат документа правил (JSON):
+        {
+          "levels": {"2": {"min_spent": 1500000, "bonus_rate": 0.07,
+                           "category_rates": {"Масла": 0.10}}},
+          "promotions": [{"name": "Декабрь x2", "start": "2024-12-01", "end": "2025-01-01",
+                          "multiplier": 2.0, "categories": ["Масла"], "levels": [1, 2]}]
+        }
+    Поля уровней накладываются на уровни по умолчанию.
+    """
+    
+    def __init__(self, levels: Dict[int, Dict[str, Any]], promotions: Optional[List[dict]] = None,
+                 version: Any = None):
+        self.version = version
+        self.levels = levels
+        ordered = sorted(levels, key=lambda lid: levels[lid]["min_spent"])
+        self.level_ids: List[int] = ordered
+        self.thresholds: List[int] = [levels[lid]["min_spent"] for lid in ordered]
+        self.rates: Dict[int, float] = {lid: levels[lid]["bonus_rate"] for lid in ordered}
+        self.caps: Dict[int, float] = {lid: levels[lid]["redeem_cap"] for lid in ordered}
+        self.category_rates: Dict[int, Dict[str, float]] = {
+            lid: dict(levels[lid].get("category_rates") or {}) for lid in ordered
+        }
+        self.default_level = ordered[0]
+        self.promotions = [
+            (
+                _parse_date(promo["start"]),
+                _parse_date(promo["end"]),
+                float(promo["multiplier"]),
+                frozenset(promo["categories"]) if promo.get("categories") else None,
+                frozenset(int(lid) for lid in promo["levels"]) if promo.get("levels") else None,
+            )
+            for promo in promotions or []
+        ]
+    
+    @classmethod
+    def from_document(cls, document: Dict[str, Any], version: Any = None) -> "TierRules":
+        """Собирает правила из документа, накладывая его на уровни по умолчанию"""
+        levels = copy.deepcopy(_DEFAULT_LEVELS)
+        for level_id, overrides in (document.get("levels") or {}).items():
+            level_id = int(level_id)
+            levels[level_id] = {**levels.get(level_id, _DEFAULT_LEVELS[1]), **overrides}
+        return cls(levels, document.get("promotions"), version)
+    
+    def level_for(self, total_spent: int) -> int:
+        """Уровень клиента по общей сумме трат"""
+        index = bisect.bisect_right(self.thresholds, total_spent) - 1
+        return self.level_ids[index] if index >= 0 else self.default_level
+    
+    def info(self, level_id: int) -> Dict[str, Any]:
+        return self.levels.get(level_id) or self.levels[self.default_level]
+    
+    def multiplier(self, level_id: int, category: Optional[str] = None,
+                   at: Optional[datetime] = None) -> float:
+        """Произведение множителей акций, действующих на момент at"""
+        if not self.promotions:
+            return 1.0
+        at = at or datetime.now()
+        result = 1.0
+        for start, end, factor, categories, levels in self.promotions:
+            if start <= at < end and (categories is None or category in categories) \
+                    and (levels is None or level_id in levels):
+                result *= factor
+        return result
+    
+    def bonus_rate(self, level_id: int, category: Optional[str] = None,
+                   at: Optional[datetime] = None) -> float:
+        """Ставка бонусов с учётом категории товара и акций"""
+        if level_id not in self.rates:
+            level_id = self.default_level
+        rate = self.category_rates[level_id].get(category, self.rates[level_id]) if category else self.rates[level_id]
+        return rate * self.multiplier(level_id, category, at)
+    
+    def redeem_cap(self, level_id: int) -> float:
+        return self.caps.get(level_id, self.caps[self.default_level])
+    
+    # ─── Векторные варианты для пакетных задач (numpy) ───
+    
+    def levels_for(self, total_spent):
+        """Уровни для массива сумм трат"""
+        import numpy as np
+        
+        index = np.searchsorted(np.asarray(self.thresholds), np.asarray(total_spent), side="right") - 1
+        return np.asarray(self.level_ids)[np.maximum(index, 0)]
+    
+    def rates_for(self, level_ids, categories=None, at=None):
+        """
+        Ставки бонусов для массивов уровней (и категорий, моментов покупки)
+        
+        at — массив datetime64 или None (акции на текущий момент).
+        """
+        import numpy as np
+        
+        level_ids = np.asarray(level_ids)
+        lookup = np.zeros(max(self.level_ids) + 1)
+        for lid, rate in self.rates.items():
+            lookup[lid] = rate
+        rates = lookup[level_ids]
+        
+        if categories is not None:
+            categories = np.asarray(categories, dtype=object)
+            for lid, by_category in self.category_rates.items():
+                for category, rate in by_category.items():
+                    rates[(level_ids == lid) & (categories == category)] = rate
+        
+        if self.promotions:
+            moments = np.full(len(level_ids), np.datetime64(datetime.now())) if at is None \
+                else np.asarray(at, dtype="datetime64[ns]")
+            for start, end, factor, promo_categories, promo_levels in self.promotions:
+                mask = (moments >= np.datetime64(start)) & (moments < np.datetime64(end))
+                if promo_levels is not None:
+                    mask &= np.isin(level_ids, list(promo_levels))
+                if promo_categories is not None:
+                    if categories is None:
+                        continue
+                    mask &= np.isin(categories, list(promo_categories))
+                rates[mask] *= factor
+        return rates
+
+
+# ─── Загрузка и горячая перезагрузка ───
+
+_rules: Optional[TierRules] = None
+_checked_at = 0.0
+
+
+def _db_rules_version(connection=None) -> Optional[int]:
+    from .db import conn
+    try:
+        row = (connection or conn).execute("SELECT MAX(id) FROM loyalty_rules").fetchone()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+def _file_rules_version() -> Optional[float]:
+    try:
+        return os.path.getmtime(LOYALTY_RULES_PATH)
+    except OSError:
+        return None
+
+
+def _source_version(connection=None) -> tuple:
+    return (_db_rules_version(connection), _file_rules_version())
+
+
+def _load_document(version: tuple, connection=None) -> Dict[str, Any]:
+    db_version, file_version = version
+    if db_version is not None:
+        from .db import conn
+        row = (connection or conn).execute("SELECT rules FROM loyalty_rules WHERE id = ?", (db_version,)).fetchone()
+        return json.loads(row[0])
+    if file_version is not None:
+        with open(LOYALTY_RULES_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def reload_rules() -> TierRules:
+    """Перечитывает и компилирует правила; при ошибке остаются прежние"""
+    global _rules
+    version = _source_version()
+    try:
+        rules = TierRules.from_document(_load_document(version), version)
+    except Exception as e:
+        log.error(f"Ошибка загрузки правил уровней, используются прежние: {e}")
+        if _rules is None:
+            _rules = TierRules(copy.deepcopy(_DEFAULT_LEVELS), version=version)
+        return _rules
+    
+    _rules = rules
+    # Модули, читающие LOYALTY_LEVELS напрямую, видят актуальные уровни
+    LOYALTY_LEVELS.clear()
+    LOYALTY_LEVELS.update(rules.levels)
+    log.info(f"Правила уровней загружены (версия {version})")
+    return rules
+
+
+def load_rules(connection) -> TierRules:
+    """
+    Правила из сторонней базы SQLite (скрипты обслуживания)
+    
+    Источник тот же, что у бота (loyalty_rules, затем файл правил), но
+    текущие правила бота не заменяются.
+    """
+    version = _source_version(connection)
+    return TierRules.from_document(_load_document(version, connection), version)
+
+
+def get_rules() -> TierRules:
+    """Текущие правила; источник проверяется не чаще раза в RULES_CHECK_INTERVAL"""
+    global _checked_at
+    now = time.monotonic()
+    if _rules is None or now - _checked_at >= RULES_CHECK_INTERVAL:
+        _checked_at = now
+        if _rules is None or _source_version() != _rules.version:
+            reload_rules()
+    return _rules
+
+
 def calculate_level_by_spent(total_spent: int) -> int:
     """Определяет уровень клиента по общей сумме трат"""
-    for level_id in sorted(LOYALTY_LEVELS.keys(), reverse=True):
-        if total_spent >= LOYALTY_LEVELS[level_id]["min_spent"]:
-            return level_id
-    return 1
+    return get_rules().level_for(total_spent)
 
 
 def get_level_info(level_id: int) -> Dict[str, Any]:
     """Возвращает информацию об уровне лояльности"""
-    return LOYALTY_LEVELS.get(level_id, LOYALTY_LEVELS[1])
+    return get_rules().info(level_id)
 
 
-def get_bonus_rate(level_id: int) -> float:
-    """Возвращает процент начисления бонусов для уровня"""
-    return get_level_info(level_id)["bonus_rate"]
+def get_bonus_rate(level_id: int, category: Optional[str] = None, at: Optional[datetime] = None) -> float:
+    """Возвращает процент начисления бонусов для уровня (с учётом категории и акций)"""
+    return get_rules().bonus_rate(level_id, category, at)
 
 
 def get_redeem_cap(level_id: int) -> float:
     """Возвращает максимальный процент списания для уровня"""
-    return get_level_info(level_id)["redeem_cap"]
+    return get_rules().redeem_cap(level_id)
 
 
 def format_level_status(level_id: int, total_spent: int) -> str:
@@ -1,4 +1,8 @@
 # loyalty-bot/bot/main.py
+import time
+
+_STARTED_AT = time.perf_counter()
+
 import asyncio
 import logging
 
@@ -8,8 +12,13 @@ from aiogram.fsm.storage.memory import MemoryStorage
 
 from bot.config import BOT_TOKEN
 from bot.handlers import register as register_handlers
+from bot.lifecycle import on_startup, on_shutdown, startup_report, mark_process_start
+from bot.messenger import messenger
 # from bot.accrual import accrual_loop
 
+mark_process_start(_STARTED_AT)
+startup_report.record("imports", _STARTED_AT)
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(levelname)s:%(name)s: %(message)s",
@@ -26,8 +35,16 @@ async def main() -> None:
     )
     dp = Dispatcher(storage=MemoryStorage())
 
+    # Background tasks send through the same Bot and its HTTP session
+    messenger.attach(bot)
+
     # Register standard handlers
-    register_handlers(dp)
+    with startup_report.phase("handlers"):
+        register_handlers(dp)
+
+    # Explicit lifecycle hooks: storage is initialised right before polling
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     async with bot:
         # Временно отключаем accrual_loop
@@ -38,7 +55,8 @@ async def main() -> None:
         #     logging.error(f"Error in accrual_loop: {e}")
 
         # Remove old updates and start polling
-        await bot.delete_webhook(drop_pending_updates=True)
+        with startup_report.phase("webhook"):
+            await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -4,6 +4,10 @@
 Управление регламентными работами и их отслеживание
 """
 
+import re
+import math
+import time
+import asyncio
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from .db import conn
@@ -76,11 +80,11 @@ MAINTENANCE_WORKS = {
     }
 }
 
-# Соответствие услуг МойСклад и работ ТО
+# Соответствие услуг МойСклад и работ ТО по умолчанию
 MOYSKLAD_SERVICE_MAPPING = {
-    # Здесь будут ID услуг из МойСклад, которые соответствуют работам ТО
-    # Пример: "service_id_from_moysklad": work_id_from_MAINTENANCE_WORKS
-    # Эта таблица будет настраиваться администратором
+    # Название услуги из МойСклад → work_id из MAINTENANCE_WORKS
+    # Пример: "Замена масла ДВС": 1
+    # Основные соответствия настраиваются администратором в maintenance_service_mapping
 }
 
 
@@ -123,9 +127,16 @@ def init_maintenance_tables():
         CREATE TABLE IF NOT EXISTS maintenance_service_mapping (
             moysklad_service_name TEXT PRIMARY KEY,
             work_id INTEGER NOT NULL,
-            is_active BOOLEAN DEFAULT TRUE
+            is_active BOOLEAN DEFAULT TRUE,
+            match_type TEXT NOT NULL DEFAULT 'exact' -- 'exact', 'contains' или 'regex'
         )
         """)
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(maintenance_service_mapping)")}
+        if "match_type" not in columns:
+            cursor.execute(
+                "ALTER TABLE maintenance_service_mapping ADD COLUMN match_type TEXT NOT NULL DEFAULT 'exact'"
+            )
+        cursor.executescript(SERVICE_MAPPING_VERSION_DDL)
         
         # Индексы для быстрого поиска
         cursor.execute("""
@@ -136,6 +147,9 @@ def init_maintenance_tables():
         )
         """)
 
+        cursor.executescript(MILEAGE_HISTORY_DDL)
+        cursor.executescript(MAINTENANCE_DUE_DDL)
+
         cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_maintenance_history_agent_work 
             ON maintenance_history(agent_id, work_id)
@@ -147,6 +161,10 @@ def init_maintenance_tables():
         """)
         
         conn.commit()
+        
+        # Первичное заполнение индекса сроков ТО
+        if not cursor.execute("SELECT 1 FROM maintenance_due LIMIT 1").fetchone():
+            rebuild_maintenance_due()
         cursor.close()
     except Exception as e:
         print(f"Ошибка при инициализации таблиц ТО: {e}")
@@ -205,26 +223,202 @@ def get_last_maintenance(agent_id: str, work_id: int) -> Optional[Dict]:
     }
 
 
+# ─── Пробег ───
+# Показания пробега копятся в mileage_history при синхронизации отгрузок
+# и начислениях; текущий пробег между визитами оценивается по средней
+# скорости (км/день) автомобиля клиента, без запросов к API
+
+MILEAGE_HISTORY_DDL = """
+CREATE TABLE IF NOT EXISTS mileage_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent_id TEXT NOT NULL,
+    demand_id TEXT UNIQUE, -- отгрузка МойСклад, из которой взято показание
+    recorded_date DATE NOT NULL,
+    mileage INTEGER NOT NULL,
+    source TEXT NOT NULL DEFAULT 'sync', -- 'sync', 'accrual', 'api', 'manual'
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_mileage_history_agent_date
+    ON mileage_history(agent_id, recorded_date);
+"""
+
+MILEAGE_CACHE_HOURS = 24            # сколько часов проверка пробега считается свежей
+MILEAGE_REFRESH_AHEAD_HOURS = 4     # за сколько часов до устаревания обновлять в фоне
+MILEAGE_REFRESH_INTERVAL = 600      # секунд между проходами фонового обновления
+MILEAGE_REFRESH_BATCH = 100         # клиентов за проход
+
+DEFAULT_KM_PER_DAY = 40     # ~15 000 км в год, если истории недостаточно
+MAX_KM_PER_DAY = 500        # выше — скорее ошибка ввода пробега
+MIN_SPAN_DAYS = 14          # минимальный разброс дат показаний для оценки скорости
+HISTORY_POINTS = 12         # сколько последних показаний учитывать
+
+
+def extract_mileage(demand: Dict) -> int:
+    """Извлекает пробег из атрибутов отгрузки МойСклад (0, если не указан)"""
+    for attr in demand.get('attributes', []):
+        if attr.get('name') == 'Пробег':
+            mileage_str = str(attr.get('value', '0'))
+            # Очищаем от нечисловых символов
+            mileage_clean = ''.join(filter(str.isdigit, mileage_str))
+            return int(mileage_clean) if mileage_clean else 0
+    return 0
+
+
+def save_mileage_readings(readings: List[Tuple[str, Optional[str], str, int]],
+                          source: str = "sync", connection=None) -> int:
+    """
+    Сохраняет показания пробега (agent_id, demand_id, дата, пробег)
+    
+    Показания без пробега пропускаются, повторное показание той же
+    отгрузки перезаписывается. connection позволяет скриптам синхронизации
+    писать через своё соединение; коммит остаётся за вызывающим.
+    Возвращает число сохранённых показаний.
+    """
+    rows = [
+        (agent_id, demand_id, str(date)[:10], int(mileage), source)
+        for agent_id, demand_id, date, mileage in readings
+        if agent_id and date and mileage and mileage > 0
+    ]
+    if rows:
+        (connection or conn).executemany("""
+            INSERT INTO mileage_history (agent_id, demand_id, recorded_date, mileage, source)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(demand_id) DO UPDATE SET
+                mileage = excluded.mileage, recorded_date = excluded.recorded_date
+        """, rows)
+    return len(rows)
+
+
+def record_mileage(agent_id: str, mileage: int, date: str, demand_id: Optional[str] = None,
+                   source: str = "sync") -> bool:
+    """Сохраняет одно показание пробега"""
+    try:
+        saved = save_mileage_readings([(agent_id, demand_id, date, mileage)], source)
+        if saved:
+            refresh_maintenance_due(agent_id)
+        conn.commit()
+        return saved > 0
+    except Exception as e:
+        print(f"Ошибка при сохранении пробега: {e}")
+        return False
+
+
+def _load_mileage_data(agent_id: str, connection=None) -> Tuple[List[Tuple[datetime, int]], Optional[datetime]]:
+    """
+    Показания пробега клиента по возрастанию даты и время последней
+    проверки в МойСклад (один запрос)
+    
+    Кроме mileage_history учитываются пробеги из истории ТО. Значение
+    mileage_cache используется, только если других показаний нет.
+    updated_at в mileage_cache пишется datetime('now') в UTC и переводится
+    в местное время, как у datetime.now() при сравнении.
+    """
+    cursor = (connection or conn).cursor()
+    cursor.execute("""
+        SELECT recorded_date, mileage, 0, NULL FROM mileage_history
+        WHERE agent_id = ? AND mileage > 0
+        UNION ALL
+        SELECT performed_date, mileage, 0, NULL FROM maintenance_history
+        WHERE agent_id = ? AND mileage > 0
+        UNION ALL
+        SELECT date(updated_at, 'localtime'), current_mileage, 1, datetime(updated_at, 'localtime')
+        FROM mileage_cache
+        WHERE agent_id = ?
+    """, (agent_id, agent_id, agent_id))
+    rows = cursor.fetchall()
+    
+    checked_at = next((datetime.fromisoformat(row[3]) for row in rows if row[2] and row[3]), None)
+    readings = [row for row in rows if not row[2]] or [row for row in rows if row[1] > 0]
+    by_date: Dict[str, int] = {}
+    for date, mileage, _, _ in readings:
+        day = str(date)[:10]
+        by_date[day] = max(by_date.get(day, 0), mileage)
+    return [(datetime.fromisoformat(day), mileage) for day, mileage in sorted(by_date.items())], checked_at
+
+
+def _load_mileage_readings(agent_id: str, connection=None) -> List[Tuple[datetime, int]]:
+    """Показания пробега клиента по возрастанию даты (один запрос)"""
+    return _load_mileage_data(agent_id, connection)[0]
+
+
+def estimate_km_per_day(readings: List[Tuple[datetime, int]]) -> Optional[float]:
+    """
+    Средний пробег в день по последним показаниям (метод наименьших квадратов)
+    
+    Учитываются только показания после последнего «сброса» — места, где
+    пробег уменьшился (опечатка, смена автомобиля или одометра).
+    Возвращает None, если показаний мало, они слишком близки по датам
+    или скорость неправдоподобна.
+    """
+    start = len(readings) - 1
+    while start > 0 and readings[start - 1][1] <= readings[start][1]:
+        start -= 1
+    points = readings[start:][-HISTORY_POINTS:]
+    if len(points) < 2 or (points[-1][0] - points[0][0]).days < MIN_SPAN_DAYS:
+        return None
+    
+    origin = points[0][0]
+    xs = [(date - origin).days for date, _ in points]
+    ys = [mileage for _, mileage in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return slope if slope <= MAX_KM_PER_DAY else None
+
+
+def project_mileage(readings: List[Tuple[datetime, int]], at: Optional[datetime] = None) -> Optional[Dict]:
+    """Оценка пробега на дату at по последнему показанию и средней скорости"""
+    if not readings:
+        return None
+    at = at or datetime.now()
+    last_date, last_mileage = readings[-1]
+    km_per_day = estimate_km_per_day(readings)
+    rate = km_per_day if km_per_day is not None else DEFAULT_KM_PER_DAY
+    days = max((at - last_date).days, 0)
+    return {
+        "mileage": last_mileage + int(rate * days),
+        "last_mileage": last_mileage,
+        "last_date": last_date,
+        "km_per_day": km_per_day,
+        "estimated": days > 0,
+    }
+
+
+def get_mileage_estimate(agent_id: str, at: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    Оценка текущего пробега клиента по локальной истории (None, если показаний нет)
+    
+    fresh — показание проверено в МойСклад за последние MILEAGE_CACHE_HOURS
+    часов (фоновым обновлением или синхронизацией) или получено сегодня.
+    """
+    readings, checked_at = _load_mileage_data(agent_id)
+    estimate = project_mileage(readings, at)
+    if estimate:
+        now = datetime.now()
+        estimate["checked_at"] = checked_at
+        estimate["fresh"] = (
+            estimate["last_date"].date() >= now.date()
+            or (checked_at is not None and now - checked_at < timedelta(hours=MILEAGE_CACHE_HOURS))
+        )
+    return estimate
+
+
 def get_current_mileage(agent_id: str, force_update: bool = False) -> int:
-    """Получает текущий пробег клиента с использованием кэша
+    """Получает текущий пробег клиента по истории показаний
+    
+    Показания обновляет фоновая задача mileage_refresh_loop, поэтому
+    запрос пользователя не обращается к API.
     
     Args:
         agent_id: ID агента
-        force_update: Принудительно обновить кэш из API
+        force_update: Перед оценкой запросить последнее показание из API
     """
-    # Если не принудительное обновление, проверяем кэш
-    if not force_update:
-        cached_mileage = get_cached_mileage(agent_id)
-        if cached_mileage is not None:
-            return cached_mileage
-    
-    # Получаем актуальный пробег из API
-    mileage = fetch_current_mileage_from_api(agent_id)
+    if force_update:
+        fetch_current_mileage_from_api(agent_id)
     
-    # Сохраняем в кэш
-    update_mileage_cache(agent_id, mileage)
-    
-    return mileage
+    estimate = get_mileage_estimate(agent_id)
+    return estimate["mileage"] if estimate else 0
 
 
 def get_cached_mileage(agent_id: str, cache_hours: int = 24) -> Optional[int]:
@@ -269,52 +463,107 @@ def update_mileage_cache(agent_id: str, mileage: int) -> bool:
         return False
 
 
-def fetch_current_mileage_from_api(agent_id: str) -> int:
-    """Получает текущий пробег клиента из API МойСклад"""
-    from .moysklad import fetch_shipments
+def fetch_latest_mileage_reading(agent_id: str) -> Optional[Tuple[str, str, int]]:
+    """
+    Последнее показание пробега клиента в МойСклад: (demand_id, moment, пробег)
     
+    Один запрос к API без обращения к базе, поэтому безопасен для вызова
+    из другого потока. None, если отгрузок нет.
+    """
+    from .moysklad import fetch_shipments_page
+    
+    shipments = fetch_shipments_page(agent_id, limit=1)["items"]
+    if not shipments:
+        return None
+    demand = shipments[0]
+    return demand["id"], demand["moment"], extract_mileage(demand)
+
+
+def save_mileage_check(agent_id: str, reading: Optional[Tuple[str, str, int]]) -> int:
+    """Сохраняет результат проверки пробега в МойСклад и отмечает время проверки"""
+    mileage = reading[2] if reading else 0
+    if mileage:
+        demand_id, moment, _ = reading
+        record_mileage(agent_id, mileage, moment, demand_id, source="api")
+        update_mileage_cache(agent_id, mileage)
+    else:
+        # Пробега нет: отмечаем проверку, не затирая последнее значение
+        conn.execute("""
+            INSERT INTO mileage_cache (agent_id, current_mileage, updated_at)
+            VALUES (?, 0, datetime('now'))
+            ON CONFLICT(agent_id) DO UPDATE SET updated_at = excluded.updated_at
+        """, (agent_id,))
+        conn.commit()
+    return mileage
+
+
+def fetch_current_mileage_from_api(agent_id: str) -> int:
+    """Получает пробег из последней отгрузки клиента в МойСклад и сохраняет показание"""
     try:
-        shipments = fetch_shipments(agent_id, limit=1)
-        if not shipments:
-            return 0
-        
-        from .moysklad import fetch_demand_full
-        demand = fetch_demand_full(shipments[0]["id"])
-        
-        # Извлекаем пробег из атрибутов
-        attributes = demand.get('attributes', [])
-        for attr in attributes:
-            if attr.get('name') == 'Пробег':
-                mileage_str = str(attr.get('value', '0'))
-                # Очищаем от нечисловых символов
-                mileage_clean = ''.join(filter(str.isdigit, mileage_str))
-                return int(mileage_clean) if mileage_clean else 0
+        return save_mileage_check(agent_id, fetch_latest_mileage_reading(agent_id))
     except Exception as e:
         print(f"Ошибка при получении пробега из API: {e}")
     
     return 0
 
 
-def calculate_maintenance_status(agent_id: str, work_id: int) -> Dict:
-    """
-    Рассчитывает статус работы ТО:
-    - когда была выполнена последний раз
-    - когда нужно выполнить следующий раз
-    - сколько осталось (пробег/время)
-    - статус (ОК, Скоро, Просрочено)
+def _agents_due_for_mileage_refresh(limit: int) -> List[str]:
     """
-    work_info = get_work_info(work_id)
-    if not work_info:
-        return {"status": "error", "message": "Работа не найдена"}
-    
-    # Получаем интервалы
-    mileage_interval, time_interval = get_work_intervals(agent_id, work_id)
+    Клиенты бота, у которых проверка пробега скоро устареет
     
-    # Получаем последнее выполнение
-    last_maintenance = get_last_maintenance(agent_id, work_id)
+    Сначала те, кто недавно и часто приезжал в сервис: их пробег меняется
+    быстрее и чаще нужен на экранах ТО.
+    """
+    rows = conn.execute("""
+        SELECT u.agent_id
+        FROM user_map u
+        LEFT JOIN mileage_cache c ON c.agent_id = u.agent_id
+        LEFT JOIN (
+            SELECT agent_id, MAX(moment) AS last_visit, COUNT(*) AS visits
+            FROM contractor_shipments
+            WHERE moment >= date('now', '-365 days')
+            GROUP BY agent_id
+        ) s ON s.agent_id = u.agent_id
+        WHERE c.updated_at IS NULL
+           -- updated_at и datetime('now') оба в UTC
+           OR datetime(c.updated_at, ?) <= datetime('now')
+        GROUP BY u.agent_id
+        ORDER BY s.last_visit IS NULL, s.last_visit DESC, s.visits DESC
+        LIMIT ?
+    """, (f"+{MILEAGE_CACHE_HOURS - MILEAGE_REFRESH_AHEAD_HOURS} hours", limit)).fetchall()
+    return [row[0] for row in rows]
+
+
+async def mileage_refresh_loop(interval: int = MILEAGE_REFRESH_INTERVAL, batch_size: int = MILEAGE_REFRESH_BATCH):
+    """
+    Фоновое обновление пробега клиентов, у которых проверка скоро устареет
     
-    # Получаем текущий пробег
-    current_mileage = get_current_mileage(agent_id)
+    Запросы к МойСклад выполняются в потоках (общий лимит соблюдается
+    в bot.moysklad), запись в базу — в цикле событий.
+    """
+    while True:
+        try:
+            agent_ids = _agents_due_for_mileage_refresh(batch_size)
+            refreshed = 0
+            for agent_id in agent_ids:
+                try:
+                    reading = await asyncio.to_thread(fetch_latest_mileage_reading, agent_id)
+                    save_mileage_check(agent_id, reading)
+                    refreshed += 1
+                except Exception as e:
+                    print(f"Ошибка фонового обновления пробега {agent_id}: {e}")
+            if agent_ids:
+                print(f"Обновлён пробег клиентов: {refreshed} из {len(agent_ids)}")
+        except Exception as e:
+            print(f"Ошибка фонового обновления пробега: {e}")
+        await asyncio.sleep(interval)
+
+
+def _build_status(work_info: Dict, mileage_interval: int, time_interval: int,
+                  last_maintenance: Optional[Dict], current_mileage: int,
+                  now: Optional[datetime] = None) -> Dict:
+    """Рассчитывает статус работы ТО по уже загруженным данным (без запросов)"""
+    now = now or datetime.now()
     
     # Если работа никогда не выполнялась
     if not last_maintenance:
@@ -338,7 +587,7 @@ def calculate_maintenance_status(agent_id: str, work_id: int) -> Dict:
     
     # По времени
     next_date = last_date + timedelta(days=time_interval * 30)  # приблизительно
-    days_remaining = (next_date - datetime.now()).days
+    days_remaining = (next_date - now).days
     
     # Определяем статус
     mileage_overdue = mileage_remaining <= 0
@@ -386,12 +635,91 @@ def calculate_maintenance_status(agent_id: str, work_id: int) -> Dict:
     }
 
 
+def calculate_maintenance_status(agent_id: str, work_id: int) -> Dict:
+    """
+    Рассчитывает статус работы ТО:
+    - когда была выполнена последний раз
+    - когда нужно выполнить следующий раз
+    - сколько осталось (пробег/время)
+    - статус (ОК, Скоро, Просрочено)
+    """
+    work_info = get_work_info(work_id)
+    if not work_info:
+        return {"status": "error", "message": "Работа не найдена"}
+    
+    # Получаем интервалы
+    mileage_interval, time_interval = get_work_intervals(agent_id, work_id)
+    
+    # Получаем последнее выполнение
+    last_maintenance = get_last_maintenance(agent_id, work_id)
+    
+    # Получаем текущий пробег
+    current_mileage = get_current_mileage(agent_id)
+    
+    return _build_status(work_info, mileage_interval, time_interval, last_maintenance, current_mileage)
+
+
+def _load_custom_intervals(agent_id: str, connection=None) -> Dict[int, Tuple[Optional[int], Optional[int]]]:
+    """Персональные интервалы клиента по всем работам (один запрос)"""
+    cursor = (connection or conn).cursor()
+    cursor.execute(
+        "SELECT work_id, custom_mileage_interval, custom_time_interval FROM maintenance_settings WHERE agent_id = ?",
+        (agent_id,)
+    )
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
+def _load_last_maintenance_by_work(agent_id: str, connection=None) -> Dict[int, Dict]:
+    """Последнее выполнение каждой работы клиента (один запрос с оконной функцией)"""
+    cursor = (connection or conn).cursor()
+    cursor.execute("""
+        SELECT work_id, performed_date, mileage, source, notes, created_at
+        FROM (
+            SELECT work_id, performed_date, mileage, source, notes, created_at,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY work_id
+                       ORDER BY performed_date DESC, created_at DESC
+                   ) AS rn
+            FROM maintenance_history
+            WHERE agent_id = ?
+        )
+        WHERE rn = 1
+    """, (agent_id,))
+    return {
+        row[0]: {
+            "date": datetime.fromisoformat(row[1]),
+            "mileage": row[2],
+            "source": row[3],
+            "notes": row[4] or "",
+            "created_at": datetime.fromisoformat(row[5])
+        }
+        for row in cursor.fetchall()
+    }
+
+
 def get_all_maintenance_status(agent_id: str) -> List[Dict]:
-    """Получает статус всех работ ТО для клиента"""
-    statuses = []
+    """
+    Получает статус всех работ ТО для клиента
     
-    for work_id in MAINTENANCE_WORKS.keys():
-        status = calculate_maintenance_status(agent_id, work_id)
+    Настройки, последние выполнения и пробег загружаются один раз
+    (не больше трёх запросов), статусы считаются в памяти.
+    """
+    custom_intervals = _load_custom_intervals(agent_id)
+    last_by_work = _load_last_maintenance_by_work(agent_id)
+    current_mileage = get_current_mileage(agent_id)
+    now = datetime.now()
+    
+    statuses = []
+    for work_id, work_info in MAINTENANCE_WORKS.items():
+        custom_mileage, custom_time = custom_intervals.get(work_id, (None, None))
+        status = _build_status(
+            work_info,
+            custom_mileage or work_info["mileage_interval"],
+            custom_time or work_info["time_interval"],
+            last_by_work.get(work_id),
+            current_mileage,
+            now,
+        )
         status["work_id"] = work_id
         statuses.append(status)
     
@@ -405,6 +733,193 @@ def get_all_maintenance_status(agent_id: str) -> List[Dict]:
     return statuses
 
 
+# ─── Индекс сроков ТО ───
+# maintenance_due хранит ближайший срок каждой выполнявшейся работы
+# клиента. Строки пересчитываются при изменении истории ТО, настроек
+# или показаний пробега, поэтому поиск клиентов, которым скоро ТО,
+# — один запрос по индексу due_date без расчёта статусов.
+
+MAINTENANCE_DUE_DDL = """
+CREATE TABLE IF NOT EXISTS maintenance_due (
+    agent_id TEXT NOT NULL,
+    work_id INTEGER NOT NULL,
+    last_date DATE NOT NULL,
+    last_mileage INTEGER NOT NULL,
+    next_due_date DATE NOT NULL, -- срок по времени
+    next_due_mileage INTEGER NOT NULL, -- срок по пробегу
+    mileage_due_date DATE, -- прогноз даты, когда будет достигнут next_due_mileage
+    due_date DATE NOT NULL, -- ближайший из двух сроков
+    reading_date DATE, -- последнее показание пробега для оценки остатка
+    reading_mileage INTEGER,
+    km_per_day REAL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (agent_id, work_id)
+);
+CREATE INDEX IF NOT EXISTS idx_maintenance_due_date ON maintenance_due(due_date);
+"""
+
+DEFAULT_DUE_WINDOW_DAYS = 14
+
+
+def _build_due(work_id: int, last_maintenance: Dict, mileage_interval: int, time_interval: int,
+               estimate: Optional[Dict]) -> Tuple:
+    """Строка maintenance_due для работы по уже загруженным данным (без запросов)"""
+    next_due_date = last_maintenance["date"] + timedelta(days=time_interval * 30)  # как в _build_status
+    next_due_mileage = last_maintenance["mileage"] + mileage_interval
+    
+    mileage_due_date = reading_date = reading_mileage = km_per_day = None
+    if estimate:
+        reading_date, reading_mileage = estimate["last_date"], estimate["last_mileage"]
+        km_per_day = estimate["km_per_day"] if estimate["km_per_day"] is not None else DEFAULT_KM_PER_DAY
+        if km_per_day > 0:
+            days_left = math.ceil(max(next_due_mileage - reading_mileage, 0) / km_per_day)
+            mileage_due_date = reading_date + timedelta(days=min(days_left, 365 * 50))
+    
+    due_date = min(next_due_date, mileage_due_date) if mileage_due_date else next_due_date
+    return (
+        work_id,
+        last_maintenance["date"].strftime("%Y-%m-%d"),
+        last_maintenance["mileage"],
+        next_due_date.strftime("%Y-%m-%d"),
+        next_due_mileage,
+        mileage_due_date.strftime("%Y-%m-%d") if mileage_due_date else None,
+        due_date.strftime("%Y-%m-%d"),
+        reading_date.strftime("%Y-%m-%d") if reading_date else None,
+        reading_mileage,
+        km_per_day,
+    )
+
+
+def refresh_maintenance_due(agent_id: str, connection=None):
+    """
+    Пересчитывает строки maintenance_due клиента
+    
+    Вызывается после изменения истории ТО, настроек или пробега.
+    Коммит остаётся за вызывающим.
+    """
+    db = connection or conn
+    custom_intervals = _load_custom_intervals(agent_id, db)
+    last_by_work = _load_last_maintenance_by_work(agent_id, db)
+    estimate = project_mileage(_load_mileage_readings(agent_id, db))
+    inactive = {
+        row[0] for row in db.execute(
+            "SELECT work_id FROM maintenance_settings WHERE agent_id = ? AND NOT is_active", (agent_id,)
+        )
+    }
+    
+    rows = []
+    for work_id, last_maintenance in last_by_work.items():
+        work_info = MAINTENANCE_WORKS.get(work_id)
+        if not work_info or work_id in inactive:
+            continue
+        custom_mileage, custom_time = custom_intervals.get(work_id, (None, None))
+        rows.append((agent_id,) + _build_due(
+            work_id, last_maintenance,
+            custom_mileage or work_info["mileage_interval"],
+            custom_time or work_info["time_interval"],
+            estimate,
+        ))
+    
+    db.execute("DELETE FROM maintenance_due WHERE agent_id = ?", (agent_id,))
+    db.executemany("""
+        INSERT INTO maintenance_due (
+            agent_id, work_id, last_date, last_mileage, next_due_date, next_due_mileage,
+            mileage_due_date, due_date, reading_date, reading_mileage, km_per_day
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def refresh_maintenance_due_for(agent_ids, connection=None) -> int:
+    """Пересчитывает maintenance_due для набора клиентов одной транзакцией"""
+    db = connection or conn
+    agent_ids = sorted(set(agent_ids))
+    try:
+        for agent_id in agent_ids:
+            refresh_maintenance_due(agent_id, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(agent_ids)
+
+
+def rebuild_maintenance_due(connection=None) -> int:
+    """Полностью пересобирает maintenance_due по истории ТО"""
+    db = connection or conn
+    agent_ids = [row[0] for row in db.execute("SELECT DISTINCT agent_id FROM maintenance_history")]
+    try:
+        db.execute("DELETE FROM maintenance_due")
+        for agent_id in agent_ids:
+            refresh_maintenance_due(agent_id, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(agent_ids)
+
+
+def get_due_maintenance(within_days: int = DEFAULT_DUE_WINDOW_DAYS, at: Optional[datetime] = None,
+                        limit: Optional[int] = None) -> List[Dict]:
+    """
+    Работы ТО со сроком в ближайшие within_days дней, включая просроченные
+    
+    Один запрос по индексу due_date; остаток пробега оценивается
+    по сохранённому показанию и скорости.
+    """
+    at = at or datetime.now()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT agent_id, work_id, last_date, last_mileage, next_due_date, next_due_mileage,
+               mileage_due_date, due_date, reading_date, reading_mileage, km_per_day
+        FROM maintenance_due
+        WHERE due_date <= ?
+        ORDER BY due_date
+        LIMIT ?
+    """, ((at + timedelta(days=within_days)).strftime("%Y-%m-%d"), limit if limit is not None else -1))
+    
+    result = []
+    for row in cursor.fetchall():
+        next_due_date = datetime.fromisoformat(row[4])
+        item = {
+            "agent_id": row[0],
+            "work_id": row[1],
+            "work_info": MAINTENANCE_WORKS.get(row[1], {}),
+            "last_date": datetime.fromisoformat(row[2]),
+            "last_mileage": row[3],
+            "next_due_date": next_due_date,
+            "next_due_mileage": row[5],
+            "mileage_due_date": datetime.fromisoformat(row[6]) if row[6] else None,
+            "due_date": datetime.fromisoformat(row[7]),
+            "days_remaining": (next_due_date - at).days,
+            "mileage_remaining": None,
+        }
+        if row[8]:
+            days = max((at - datetime.fromisoformat(row[8])).days, 0)
+            item["mileage_remaining"] = row[5] - (row[9] + int((row[10] or 0) * days))
+        result.append(item)
+    return result
+
+
+def update_maintenance_settings(agent_id: str, work_id: int, mileage_interval: Optional[int] = None,
+                                time_interval: Optional[int] = None, is_active: bool = True) -> bool:
+    """Сохраняет персональные интервалы работы ТО и пересчитывает её срок"""
+    try:
+        if work_id not in MAINTENANCE_WORKS:
+            return False
+        conn.execute("""
+            INSERT OR REPLACE INTO maintenance_settings
+                (agent_id, work_id, custom_mileage_interval, custom_time_interval, is_active)
+            VALUES (?, ?, ?, ?, ?)
+        """, (agent_id, work_id, mileage_interval, time_interval, is_active))
+        refresh_maintenance_due(agent_id)
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Ошибка при сохранении настроек ТО: {e}")
+        conn.rollback()
+        return False
+
+
 def add_manual_maintenance(agent_id: str, work_id: int, date: str, mileage: int, notes: str = "") -> bool:
     """Добавляет ручную запись о выполненной работе ТО"""
     try:
@@ -427,6 +942,7 @@ def add_manual_maintenance(agent_id: str, work_id: int, date: str, mileage: int,
             INSERT INTO maintenance_history (agent_id, work_id, performed_date, mileage, source, notes)
             VALUES (?, ?, ?, ?, 'manual', ?)
         """, (agent_id, work_id, date, mileage, notes))
+        refresh_maintenance_due(agent_id)
         conn.commit()
         
         return True
@@ -440,7 +956,7 @@ def add_auto_maintenance(agent_id: str, work_id: int, demand_id: str, date: str,
         # Проверяем, не добавлена ли уже запись для этой отгрузки
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT 1 FROM maintenance_history WHERE demand_id = %s AND work_id = %s",
+            "SELECT 1 FROM maintenance_history WHERE demand_id = ? AND work_id = ?",
             (demand_id, work_id)
         )
         existing = cursor.fetchone()
@@ -450,8 +966,9 @@ def add_auto_maintenance(agent_id: str, work_id: int, demand_id: str, date: str,
         
         cursor.execute("""
             INSERT INTO maintenance_history (agent_id, work_id, performed_date, mileage, source, demand_id)
-            VALUES (%s, %s, %s, %s, 'auto', %s)
+            VALUES (?, ?, ?, ?, 'auto', ?)
         """, (agent_id, work_id, date, mileage, demand_id))
+        refresh_maintenance_due(agent_id)
         conn.commit()
         
         return True
@@ -459,22 +976,162 @@ def add_auto_maintenance(agent_id: str, work_id: int, demand_id: str, date: str,
         return False
 
 
-def process_moysklad_services(agent_id: str, demand_id: str, services: List[Dict], mileage: int, date: str):
-    """Обрабатывает услуги из МойСклад и автоматически добавляет записи ТО"""
-    for service in services:
-        service_name = service.get("assortment", {}).get("name", "")
+# ─── Сопоставление услуг и работ ТО ───
+# Таблица maintenance_service_mapping загружается один раз в ServiceMatcher.
+# Названия услуг нормализуются (регистр, пробелы, объём, вязкость масла),
+# поэтому «Замена масла 4л 5W-30» и «замена  масла» совпадают с одной
+# записью. Триггеры увеличивают версию при любом изменении таблицы, и
+# сопоставитель пересобирается при следующей проверке версии.
+
+SERVICE_MAPPING_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS maintenance_mapping_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO maintenance_mapping_version (id, version) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS trg_service_mapping_insert AFTER INSERT ON maintenance_service_mapping
+BEGIN UPDATE maintenance_mapping_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS trg_service_mapping_update AFTER UPDATE ON maintenance_service_mapping
+BEGIN UPDATE maintenance_mapping_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER IF NOT EXISTS trg_service_mapping_delete AFTER DELETE ON maintenance_service_mapping
+BEGIN UPDATE maintenance_mapping_version SET version = version + 1 WHERE id = 1; END;
+"""
+
+MAPPING_CHECK_INTERVAL = 30  # секунд между проверками версии таблицы
+
+_VOLUME_RE = re.compile(r"\b\d+(?:[.,]\d+)?\s*(?:л|литр(?:а|ов)?|мл|l|ml)\b")
+_VISCOSITY_RE = re.compile(r"\b(?:sae\s*)?\d{1,2}\s*w\s*-?\s*\d{2}\b")
+_NON_WORD_RE = re.compile(r"[^\w]+")
+
+
+def normalize_service_name(name: str) -> str:
+    """Приводит название услуги к виду для сопоставления"""
+    text = (name or "").lower().replace("ё", "е")
+    text = _VISCOSITY_RE.sub(" ", text)
+    text = _VOLUME_RE.sub(" ", text)
+    return _NON_WORD_RE.sub(" ", text).strip()
+
+
+class ServiceMatcher:
+    """Сопоставление названий услуг МойСклад с работами ТО без запросов к базе"""
+    
+    def __init__(self, rules: List[Tuple[str, int, str]], version: Optional[int] = None):
+        """rules — (название или шаблон, work_id, тип: exact/contains/regex) в порядке приоритета"""
+        self.version = version
+        self.exact: Dict[str, int] = {}
+        self.patterns: List[Tuple[re.Pattern, int]] = []
+        self._cache: Dict[str, Optional[int]] = {}
         
-        # Ищем соответствие в настройках
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT work_id FROM maintenance_service_mapping WHERE moysklad_service_name = %s AND is_active = TRUE",
-            (service_name,)
-        )
-        mapping = cursor.fetchone()
+        for pattern, work_id, match_type in rules:
+            if work_id not in MAINTENANCE_WORKS:
+                continue
+            if match_type == "regex":
+                try:
+                    self.patterns.append((re.compile(pattern, re.IGNORECASE), work_id))
+                except re.error as e:
+                    print(f"Неверный шаблон услуги ТО {pattern!r}: {e}")
+            elif match_type == "contains":
+                normalized = normalize_service_name(pattern)
+                if normalized:
+                    # Граница слова только в начале слов: «фильтр» находит и «фильтра»,
+                    # «фильтров», «замена свеч» — «замена свечей»
+                    words = r"\w*\s+".join(re.escape(word) for word in normalized.split())
+                    self.patterns.append((re.compile(r"\b" + words), work_id))
+            else:
+                self.exact.setdefault(normalize_service_name(pattern), work_id)
+    
+    def match(self, service_name: str) -> Optional[int]:
+        """work_id для названия услуги или None"""
+        if service_name in self._cache:
+            return self._cache[service_name]
+        
+        normalized = normalize_service_name(service_name)
+        work_id = self.exact.get(normalized)
+        if work_id is None:
+            for pattern, pattern_work_id in self.patterns:
+                if pattern.search(normalized) or pattern.search(service_name):
+                    work_id = pattern_work_id
+                    break
         
-        if mapping:
-            work_id = mapping[0]
-            add_auto_maintenance(agent_id, work_id, demand_id, date, mileage)
+        self._cache[service_name] = work_id
+        return work_id
+    
+    def works_for(self, services: List[Dict]) -> List[int]:
+        """Работы ТО по позициям-услугам отгрузки, без повторов и в порядке позиций"""
+        work_ids = []
+        for service in services:
+            work_id = self.match(service.get("assortment", {}).get("name", ""))
+            if work_id is not None and work_id not in work_ids:
+                work_ids.append(work_id)
+        return work_ids
+
+
+_matcher: Optional[ServiceMatcher] = None
+_matcher_checked_at = 0.0
+
+
+def _service_mapping_version() -> Optional[int]:
+    try:
+        row = conn.execute("SELECT version FROM maintenance_mapping_version WHERE id = 1").fetchone()
+        return row[0] if row else None
+    except Exception:
+        return None
+
+
+def _load_service_matcher() -> ServiceMatcher:
+    """Собирает сопоставитель из таблицы и MOYSKLAD_SERVICE_MAPPING (один запрос)"""
+    version = _service_mapping_version()
+    rows = conn.execute("""
+        SELECT moysklad_service_name, work_id, match_type
+        FROM maintenance_service_mapping
+        WHERE is_active
+        ORDER BY CASE match_type WHEN 'exact' THEN 0 ELSE 1 END, length(moysklad_service_name) DESC
+    """).fetchall()
+    rules = [(name, work_id, match_type or "exact") for name, work_id, match_type in rows]
+    rules += [(name, work_id, "exact") for name, work_id in MOYSKLAD_SERVICE_MAPPING.items()]
+    return ServiceMatcher(rules, version)
+
+
+def get_service_matcher() -> ServiceMatcher:
+    """Текущий сопоставитель; версия таблицы проверяется не чаще раза в MAPPING_CHECK_INTERVAL"""
+    global _matcher, _matcher_checked_at
+    now = time.monotonic()
+    if _matcher is None or now - _matcher_checked_at >= MAPPING_CHECK_INTERVAL:
+        _matcher_checked_at = now
+        if _matcher is None or _service_mapping_version() != _matcher.version:
+            _matcher = _load_service_matcher()
+    return _matcher
+
+
+def invalidate_service_matcher():
+    """Сбрасывает сопоставитель: следующий вызов перечитает таблицу"""
+    global _matcher
+    _matcher = None
+
+
+def set_service_mapping(service_name: str, work_id: int, match_type: str = "exact",
+                        is_active: bool = True) -> bool:
+    """Добавляет или обновляет соответствие услуги и работы ТО"""
+    if work_id not in MAINTENANCE_WORKS or match_type not in ("exact", "contains", "regex"):
+        return False
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO maintenance_service_mapping
+                (moysklad_service_name, work_id, is_active, match_type)
+            VALUES (?, ?, ?, ?)
+        """, (service_name, work_id, is_active, match_type))
+        conn.commit()
+        invalidate_service_matcher()
+        return True
+    except Exception as e:
+        print(f"Ошибка при сохранении соответствия услуги ТО: {e}")
+        return False
+
+
+def process_moysklad_services(agent_id: str, demand_id: str, services: List[Dict], mileage: int, date: str):
+    """Обрабатывает услуги из МойСклад и автоматически добавляет записи ТО"""
+    for work_id in get_service_matcher().works_for(services):
+        add_auto_maintenance(agent_id, work_id, demand_id, date, mileage)
 
 
 def format_maintenance_status(status: Dict) -> str:
@@ -550,7 +1207,3 @@ def format_maintenance_summary(statuses: List[Dict]) -> str:
             text += f"• {work['work_info']['emoji']} {work['work_info']['name'][:30]}...\n"
     
     return text
-
-
-# Инициализируем таблицы при импорте модуля
-init_maintenance_tables()
@@ -0,0 +1,227 @@
+# loyalty-bot/bot/messenger.py
+"""
+Исходящие сообщения Telegram: один общий Bot и очередь отправки
+
+Все фоновые задачи (начисления, уведомления) отправляют сообщения через
+общий экземпляр Messenger. Очередь соблюдает лимиты Telegram — общий
+(~30 сообщений в секунду) и на один чат (~1 сообщение в секунду) — и
+повторяет отправку после 429 через указанный в ответе retry_after.
+"""
+
+import heapq
+import asyncio
+import logging
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramAPIError
+
+from .config import BOT_TOKEN
+
+log = logging.getLogger(__name__)
+
+GLOBAL_RATE = 25          # сообщений в секунду на бота (лимит Telegram — 30)
+PER_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+MAX_CONCURRENT_SENDS = 10
+MAX_ATTEMPTS = 5
+
+
+@dataclass(order=True)
+class _Outgoing:
+    ready_at: float
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: dict = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class Messenger:
+    """Очередь исходящих сообщений поверх одного долгоживущего Bot"""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 max_concurrent: int = MAX_CONCURRENT_SENDS):
+        self.global_interval = 1.0 / global_rate
+        self.per_chat_interval = per_chat_interval
+        self.max_concurrent = max_concurrent
+        self._bot: Optional[Bot] = None
+        self._owns_bot = False
+        self._incoming: Optional[asyncio.Queue] = None
+        self._heap: List[_Outgoing] = []
+        self._chat_next: Dict[int, float] = {}
+        self._global_next = 0.0
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set = set()
+        self._pending: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    # ─── Bot ───
+
+    def attach(self, bot: Bot):
+        """Использует Bot, созданный в main.py, вместо собственного"""
+        self._bot = bot
+        self._owns_bot = False
+
+    @property
+    def bot(self) -> Bot:
+        if self._bot is None:
+            self._bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+            self._owns_bot = True
+        return self._bot
+
+    # ─── Запуск и остановка ───
+
+    def start(self):
+        """Запускает диспетчер очереди в текущем event loop"""
+        if self._task is not None and not self._task.done():
+            return
+        self._incoming = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает диспетчер"""
+        if self._task is not None:
+            if self._pending:
+                await asyncio.wait(set(self._pending), timeout=timeout)
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            for task in list(self._sends):
+                task.cancel()
+            for future in list(self._pending):
+                if not future.done():
+                    future.set_result(False)
+            self._pending.clear()
+            self._heap.clear()
+        if self._owns_bot and self._bot is not None:
+            await self._bot.session.close()
+            self._bot = None
+            self._owns_bot = False
+
+    # ─── Отправка ───
+
+    def submit(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """
+        Ставит сообщение в очередь, не дожидаясь отправки
+
+        Возвращает future, который завершится True после доставки
+        или False, если сообщение отправить не удалось.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        item = _Outgoing(
+            ready_at=loop.time(), seq=next(self._seq), chat_id=chat_id,
+            text=text, kwargs=kwargs, future=loop.create_future(),
+        )
+        self._pending.add(item.future)
+        item.future.add_done_callback(self._pending.discard)
+        self._incoming.put_nowait(item)
+        return item.future
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Ставит сообщение в очередь и дожидается результата отправки"""
+        return await self.submit(chat_id, text, **kwargs)
+
+    # ─── Диспетчер ───
+
+    def _schedule(self, item: _Outgoing, now: float):
+        """Назначает сообщению ближайший свободный слот его чата"""
+        if item.attempts:
+            self._reschedule_after_retry(item, now)
+            return
+        ready_at = max(now, item.ready_at, self._chat_next.get(item.chat_id, 0.0))
+        self._chat_next[item.chat_id] = ready_at + self.per_chat_interval
+        item.ready_at = ready_at
+        heapq.heappush(self._heap, item)
+
+    def _reschedule_after_retry(self, item: _Outgoing, now: float):
+        """Повтор встаёт перед остальными сообщениями своего чата, сохраняя их порядок"""
+        same_chat = [queued for queued in self._heap if queued.chat_id == item.chat_id]
+        if same_chat:
+            self._heap = [queued for queued in self._heap if queued.chat_id != item.chat_id]
+            heapq.heapify(self._heap)
+        self._chat_next[item.chat_id] = item.ready_at
+        for queued in [item, *sorted(same_chat, key=lambda q: q.seq)]:
+            ready_at = max(now, queued.ready_at, self._chat_next[item.chat_id])
+            self._chat_next[item.chat_id] = ready_at + self.per_chat_interval
+            queued.ready_at = ready_at
+            heapq.heappush(self._heap, queued)
+
+    async def _dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._incoming.empty():
+                item = self._incoming.get_nowait()
+                self._schedule(item, loop.time())
+
+            if not self._heap:
+                item = await self._incoming.get()
+                self._schedule(item, loop.time())
+                continue
+
+            now = loop.time()
+            delay = max(self._heap[0].ready_at, self._global_next) - now
+            if delay > 0:
+                # Ждём слот, но просыпаемся раньше, если пришло новое сообщение
+                try:
+                    item = await asyncio.wait_for(self._incoming.get(), timeout=delay)
+                    self._schedule(item, loop.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._semaphore.acquire()
+            item = heapq.heappop(self._heap)
+            self._global_next = max(self._global_next, now) + self.global_interval
+            task = asyncio.create_task(self._send(item))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, item: _Outgoing):
+        loop = asyncio.get_running_loop()
+        try:
+            item.attempts += 1
+            await self.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+            if not item.future.done():
+                item.future.set_result(True)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль действует на весь бот: приостанавливаем всю очередь
+            log.warning(f"Telegram flood control, retry after {e.retry_after}s (chat {item.chat_id})")
+            resume_at = loop.time() + e.retry_after
+            self._global_next = max(self._global_next, resume_at)
+            self._retry(item, resume_at)
+        except TelegramNetworkError as e:
+            log.warning(f"Network error sending to {item.chat_id}: {e}")
+            self._retry(item, loop.time() + 2 ** item.attempts)
+        except TelegramAPIError as e:
+            log.error(f"Failed to send message to {item.chat_id}: {e}")
+            if not item.future.done():
+                item.future.set_result(False)
+        except Exception as e:
+            log.error(f"Unexpected error sending message to {item.chat_id}: {e}")
+            if not item.future.done():
+                item.future.set_result(False)
+        finally:
+            self._semaphore.release()
+
+    def _retry(self, item: _Outgoing, not_before: float):
+        if item.attempts >= MAX_ATTEMPTS:
+            log.error(f"Giving up on message to {item.chat_id} after {item.attempts} attempts")
+            if not item.future.done():
+                item.future.set_result(False)
+            return
+        # Через входную очередь, чтобы разбудить ожидающий диспетчер
+        item.ready_at = not_before
+        self._incoming.put_nowait(item)
+
+
+messenger = Messenger()
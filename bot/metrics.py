@@ -0,0 +1,192 @@
+# loyalty-bot/bot/metrics.py
+"""
+Метрики начисления бонусов: счётчики, длительности этапов, отставание
+
+Метрики копятся в памяти процесса, отдаются локальным HTTP-эндпоинтом
+(/metrics в формате Prometheus, /metrics.json) и периодически
+сводкой пишутся в лог.
+"""
+
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from .config import METRICS_HOST, METRICS_PORT
+
+log = logging.getLogger(__name__)
+
+# Сколько последних замеров хранить для перцентилей
+WINDOW = 1000
+
+
+class _Timing:
+    """Статистика длительностей (или отставаний) в секундах"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(int(len(values) * q), len(values) - 1)]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
+
+
+class AccrualMetrics:
+    """Метрики конвейера начисления"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.stages: Dict[str, _Timing] = {}
+        self.lag = _Timing()
+        self.gauges: Dict[str, float] = {}
+        self.gauge_fns: Dict[str, Callable[[], float]] = {}
+        self._last_summary: Counter = Counter()
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def error(self, stage: str, exc):
+        """Считает ошибку по этапу и типу (исключение или строка с типом)"""
+        kind = exc if isinstance(exc, str) else type(exc).__name__
+        self.errors[(stage, kind)] += 1
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def register_gauge(self, name: str, fn: Callable[[], float]):
+        """Гейдж, значение которого вычисляется в момент чтения"""
+        self.gauge_fns[name] = fn
+
+    def observe_lag(self, seconds: float):
+        """Отставание начисления от moment отгрузки"""
+        self.lag.observe(max(seconds, 0.0))
+
+    def observe(self, stage: str, seconds: float):
+        self.stages.setdefault(stage, _Timing()).observe(seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет длительность этапа; исключения считаются в errors"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(name, e)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def _all_gauges(self) -> Dict[str, float]:
+        gauges = dict(self.gauges)
+        for name, fn in self.gauge_fns.items():
+            try:
+                gauges[name] = float(fn())
+            except Exception:
+                pass
+        return gauges
+
+    def snapshot(self) -> dict:
+        return {
+            "uptime_seconds": time.time() - self.started_at,
+            "counters": dict(self.counters),
+            "errors": {f"{stage}:{kind}": n for (stage, kind), n in self.errors.items()},
+            "stages": {name: timing.snapshot() for name, timing in self.stages.items()},
+            "accrual_lag_seconds": self.lag.snapshot(),
+            "gauges": self._all_gauges(),
+        }
+
+    def render_prometheus(self) -> str:
+        """Текст в формате Prometheus exposition"""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"loyalty_accrual_{name}_total {value}")
+        for (stage, kind), value in sorted(self.errors.items()):
+            lines.append(f'loyalty_accrual_errors_total{{stage="{stage}",type="{kind}"}} {value}')
+        for name, timing in sorted(self.stages.items()):
+            snap = timing.snapshot()
+            lines.append(f'loyalty_accrual_stage_seconds_count{{stage="{name}"}} {snap["count"]}')
+            lines.append(f'loyalty_accrual_stage_seconds_sum{{stage="{name}"}} {timing.total:.6f}')
+            for q in ("p50", "p95", "max"):
+                lines.append(f'loyalty_accrual_stage_seconds{{stage="{name}",stat="{q}"}} {snap[q]:.6f}')
+        lag = self.lag.snapshot()
+        lines.append(f"loyalty_accrual_lag_seconds_count {lag['count']}")
+        for q in ("avg", "p50", "p95", "max"):
+            lines.append(f'loyalty_accrual_lag_seconds{{stat="{q}"}} {lag[q]:.3f}')
+        for name, value in sorted(self._all_gauges().items()):
+            lines.append(f"loyalty_accrual_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Строка для лога: счётчики за интервал и текущие показатели"""
+        delta = self.counters - self._last_summary
+        self._last_summary = Counter(self.counters)
+        stages = ", ".join(
+            f"{name} p95 {timing.percentile(0.95) * 1000:.0f} мс"
+            for name, timing in sorted(self.stages.items())
+        )
+        gauges = self._all_gauges()
+        return (
+            f"Начисления: просмотрено {delta['seen']}, начислено {delta['accrued']}, "
+            f"пропущено {delta['skipped']}, ошибок всего {sum(self.errors.values())}; "
+            f"отставание p95 {self.lag.percentile(0.95):.0f} с, "
+            f"курсор {gauges.get('cursor_lag_seconds', 0):.0f} с; {stages}"
+        )
+
+
+accrual_metrics = AccrualMetrics()
+
+
+async def serve_metrics(metrics: AccrualMetrics = accrual_metrics,
+                        host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Локальный HTTP-эндпоинт: /metrics (Prometheus) и /metrics.json"""
+    from aiohttp import web
+
+    async def prometheus(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    async def as_json(request):
+        return web.json_response(metrics.snapshot())
+
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus)
+    app.router.add_get("/metrics.json", as_json)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        log.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def metrics_log_loop(metrics: AccrualMetrics = accrual_metrics, interval: int = 300):
+    """Периодически пишет сводку метрик в лог"""
+    while True:
+        await asyncio.sleep(interval)
+        log.info(metrics.summary())
@@ -1,5 +1,8 @@
+import time
 import requests
 import logging
+import threading
+from collections import deque
 from typing import Optional
 from datetime import datetime, timedelta
 from requests.exceptions import ConnectionError, Timeout, HTTPError
@@ -13,6 +16,48 @@ MS_BASE = "https://api.moysklad.ru/api/remap/1.2"
 # Настройка логирования
 log = logging.getLogger(__name__)
 
+# Лимиты API МойСклад: не больше 45 запросов за 3 секунды
+# и не больше 5 параллельных запросов на пользователя
+MS_MAX_REQUESTS = 45
+MS_WINDOW_SECONDS = 3.0
+MS_MAX_PARALLEL = 5
+# Максимальный размер страницы отгрузок с expand
+MS_DEMANDS_PAGE_LIMIT = 100
+
+
+class _RateLimiter:
+    """Общий для всех потоков процесса лимит запросов к МойСклад"""
+    
+    def __init__(self, max_requests: int, window: float, max_parallel: int):
+        self.max_requests = max_requests
+        self.window = window
+        self.parallel = threading.BoundedSemaphore(max_parallel)
+        self._sent = deque()
+        self._lock = threading.Lock()
+    
+    def _wait_slot(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= self.window:
+                    self._sent.popleft()
+                if len(self._sent) < self.max_requests:
+                    self._sent.append(now)
+                    return
+                delay = self.window - (now - self._sent[0])
+            time.sleep(delay)
+    
+    def __enter__(self):
+        self.parallel.acquire()
+        self._wait_slot()
+        return self
+    
+    def __exit__(self, *exc):
+        self.parallel.release()
+
+
+rate_limiter = _RateLimiter(MS_MAX_REQUESTS, MS_WINDOW_SECONDS, MS_MAX_PARALLEL)
+
 @retry_on_failure(retries=3, wait_time=1.0, exceptions=(ConnectionError, Timeout, RetryableError))
 def _get(path: str, params: dict | None = None) -> dict:
     """
@@ -33,12 +78,13 @@ def _get(path: str, params: dict | None = None) -> dict:
     
     try:
         log.debug(f"Making request to MoySklad: {url}")
-        response = requests.get(
-            url,
-            headers=HEADERS,
-            params=params or {},
-            timeout=10
-        )
+        with rate_limiter:
+            response = requests.get(
+                url,
+                headers=HEADERS,
+                params=params or {},
+                timeout=10
+            )
         
         return handle_api_response(response, "MoySklad")
         
@@ -150,6 +196,84 @@ def fetch_shipments(agent_id: str, limit: int = 20, order: str = "desc") -> list
         log.error(f"Error fetching shipments for agent {agent_id}: {e}")
         raise MoySkladError(f"Failed to fetch shipments: {e}")
 
+def fetch_shipments_page(agent_id: str, limit: int = 10, cursor: tuple | str | None = None,
+                         direction: str = "next") -> dict:
+    """
+    Получает одну страницу отгрузок контрагента (keyset-пагинация по moment и id)
+    
+    В отличие от fetch_shipments, делает ровно один запрос к API и не
+    перепроверяет каждую отгрузку отдельным запросом.
+    
+    Args:
+        agent_id: ID контрагента
+        limit: размер страницы
+        cursor: (moment, id) граничной отгрузки предыдущей страницы;
+            строка moment — отгрузки строго старее (новее) этого момента
+        direction: "next" — более старые отгрузки, "prev" — более новые
+    
+    Returns:
+        dict: {"items": [...], "next_cursor": (moment, id), "prev_cursor": (moment, id)}
+    
+    Raises:
+        MoySkladError: при ошибках API
+    """
+    if not agent_id:
+        raise ValidationError("Agent ID не может быть пустым")
+    
+    cursor_moment, cursor_id = (cursor, None) if isinstance(cursor, str) else (cursor or (None, None))
+    filters = [f"agent={MS_BASE}/entity/counterparty/{agent_id}"]
+    order = "desc"
+    if cursor:
+        if direction == "prev":
+            order = "asc"
+        # moment не уникален: секунда граничной отгрузки запрашивается целиком,
+        # а уже показанные в ней отгрузки отсекаются по id
+        op = ">" if direction == "prev" else "<"
+        filters.append(f"moment{op}{'=' if cursor_id else ''}{cursor_moment}")
+    
+    def shown(row: dict) -> bool:
+        if not cursor_id or row.get("moment") != cursor_moment:
+            return False
+        return row["id"] <= cursor_id if order == "asc" else row["id"] >= cursor_id
+    
+    # Запас на граничную отгрузку, которая придёт повторно
+    page_limit = limit + (2 if cursor_id else 1)
+    params = {
+        "filter": ";".join(filters),
+        "order": f"moment,{order};id,{order}",
+        "limit": page_limit,
+        "expand": "state"
+    }
+    
+    rows = []
+    try:
+        log.debug(f"Fetching shipments page for agent {agent_id}, cursor={cursor}, direction={direction}")
+        while True:
+            batch = safe_get_nested(_get("entity/demand", params), "rows", default=[])
+            rows.extend(row for row in batch if not shown(row))
+            # Дозапрос нужен, только если отсеянных отгрузок в секунде курсора больше одной
+            if len(rows) > limit or len(batch) < page_limit:
+                break
+            params["offset"] = params.get("offset", 0) + len(batch)
+    except Exception as e:
+        log.error(f"Error fetching shipments page for agent {agent_id}: {e}")
+        raise MoySkladError(f"Failed to fetch shipments page: {e}")
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "asc":
+        rows.reverse()
+    
+    # Есть ли страницы в каждую сторону от текущей
+    has_older = has_more if direction == "next" or not cursor else True
+    has_newer = bool(cursor) and (direction == "next" or has_more)
+    
+    return {
+        "items": rows,
+        "next_cursor": (rows[-1]["moment"], rows[-1]["id"]) if rows and has_older else None,
+        "prev_cursor": (rows[0]["moment"], rows[0]["id"]) if rows and has_newer else None
+    }
+
 def fetch_demand_full(did: str) -> Optional[dict]:
     """
     Получает полную информацию об отгрузке с улучшенной обработкой ошибок
@@ -291,3 +415,51 @@ def fetch_demands(limit: int = 10) -> list[dict]:
     except Exception as e:
         log.error(f"Error fetching demands: {e}")
         raise MoySkladError(f"Failed to fetch demands: {e}")
+
+
+def fetch_demands_page(moment_from: str, moment_to: str | None = None,
+                       limit: int = 100, offset: int = 0,
+                       state: str | None = "Отгружен", field: str = "moment") -> list[dict]:
+    """
+    Получает отгруженные документы начиная с moment_from, от старых к новым
+    
+    Используется сканером начислений: страницы идут вперёд по field,
+    offset нужен только чтобы пройти больше limit отгрузок с одинаковым значением.
+    
+    Args:
+        moment_from: нижняя граница field включительно ("YYYY-MM-DD HH:MM:SS")
+        moment_to: верхняя граница field включительно
+        limit: размер страницы (не больше 100 из-за expand)
+        offset: смещение внутри выборки
+        state: статус отгрузки (None — любые статусы)
+        field: "moment" — дата документа, "updated" — время последнего изменения
+            (отгрузка, переведённая в статус позже своей даты, попадает в выборку
+            по updated в момент смены статуса)
+    
+    Returns:
+        list[dict]: отгрузки, отсортированные по field по возрастанию
+    
+    Raises:
+        MoySkladError: при ошибках API
+    """
+    filters = [f"{field}>={moment_from}"]
+    if state:
+        filters.insert(0, f"state.name={state}")
+    if moment_to:
+        filters.append(f"{field}<={moment_to}")
+    
+    params = {
+        "filter": ";".join(filters),
+        "order": f"{field},asc",
+        "limit": min(limit, MS_DEMANDS_PAGE_LIMIT),
+        "offset": offset,
+        "expand": "agent,positions,positions.assortment"
+    }
+    
+    try:
+        log.debug(f"Fetching demands from {moment_from} (offset {offset})")
+        result = _get("entity/demand", params)
+        return safe_get_nested(result, "rows", default=[])
+    except Exception as e:
+        log.error(f"Error fetching demands page: {e}")
+        raise MoySkladError(f"Failed to fetch demands page: {e}")
@@ -10,6 +10,7 @@ from typing import Dict, List, Optional
 from dataclasses import dataclass
 from aiogram import Bot
 from bot.db import get_agent_id, get_balance, conn
+from bot.messenger import messenger
 from bot.loyalty import get_level_info, calculate_level_by_spent
 from bot.ux_keyboards import get_user_profile
 from ux_copy_texts import (
@@ -368,18 +369,10 @@ class SmartNotificationSystem:
         if not message:
             return
         
-        try:
-            await self.bot.send_message(
-                chat_id=user_id,
-                text=message,
-                parse_mode='HTML'
-            )
-            
+        # Отправка через общую очередь с учётом лимитов Telegram
+        if await messenger.send(user_id, message, parse_mode='HTML'):
             # Записываем факт отправки
             self._record_notification(user_id, notification_type)
-            
-        except Exception as e:
-            log.error(f"Error sending notification to {user_id}: {e}")
     
     def _generate_notification_message(self, notification_type: str, **kwargs) -> Optional[str]:
         """Генерирует текст уведомления"""
@@ -9,7 +9,9 @@ from datetime import datetime, timedelta
 from typing import List
 
 from aiogram import Bot
-from bot.db import conn, get_agent_id
+from bot.db import conn, get_agent_id, get_tg_id_by_agent
+from bot.maintenance import get_due_maintenance
+from bot.messenger import messenger
 from bot.ux_keyboards import get_user_profile
 from bot.smart_features import SmartNotificationSystem, PersonalAssistant, AchievementSystem
 
@@ -44,6 +46,9 @@ class SmartNotificationScheduler:
         """Обработка всех типов уведомлений"""
         log.info("🔄 Проверка уведомлений...")
         
+        # Напоминания о ТО: один запрос по индексу сроков для всех клиентов
+        await self._send_maintenance_reminders()
+        
         # Получаем всех активных пользователей
         active_users = self._get_active_users()
         
@@ -84,10 +89,7 @@ class SmartNotificationScheduler:
         # 2. Проверяем бонусы с истекающим сроком
         await self._check_bonus_expiry(user_id, profile)
         
-        # 3. Проверяем рекомендации по обслуживанию
-        await self._check_maintenance_reminders(user_id, agent_id)
-        
-        # 4. Отправляем мотивационные уведомления
+        # 3. Отправляем мотивационные уведомления
         await self._send_motivational_notifications(user_id, profile)
     
     async def _check_achievements(self, user_id: int):
@@ -127,25 +129,29 @@ class SmartNotificationScheduler:
         except Exception as e:
             log.error(f"Ошибка проверки срока бонусов для {user_id}: {e}")
     
-    async def _check_maintenance_reminders(self, user_id: int, agent_id: str):
-        """Проверка напоминаний о техобслуживании"""
+    async def _send_maintenance_reminders(self):
+        """Напоминания о ТО клиентам, у которых срок работы в ближайшие 14 дней"""
         try:
-            # Получаем инсайты от персонального помощника
-            insights = await self.personal_assistant.get_smart_insights(user_id)
-            maintenance_insights = [i for i in insights if i.type == 'maintenance']
+            # Самая срочная работа каждого клиента (строки отсортированы по сроку)
+            most_urgent = {}
+            for item in get_due_maintenance(within_days=14):
+                most_urgent.setdefault(item["agent_id"], item)
             
-            if maintenance_insights:
-                insight = maintenance_insights[0]
+            for agent_id, item in most_urgent.items():
+                user_id = get_tg_id_by_agent(agent_id)
+                if not user_id:
+                    continue
                 
+                mileage_remaining = item["mileage_remaining"]
                 await self.notification_system.send_smart_notification(
                     user_id=user_id,
                     notification_type='maintenance_due',
-                    service='ТО',
-                    km_left=5000  # Примерное значение
+                    service=item["work_info"].get("name", "ТО"),
+                    km_left=max(mileage_remaining, 0) if mileage_remaining is not None else 0
                 )
                 
         except Exception as e:
-            log.error(f"Ошибка проверки напоминаний ТО для {user_id}: {e}")
+            log.error(f"Ошибка отправки напоминаний ТО: {e}")
     
     async def _send_motivational_notifications(self, user_id: int, profile: dict):
         """Отправка мотивационных уведомлений"""
@@ -198,12 +204,8 @@ class SmartNotificationScheduler:
                             f"💪 Хорошего дня!"
                         )
                         
-                        await self.bot.send_message(
-                            chat_id=user_id,
-                            text=message
-                        )
-                        
-                        log.info(f"📨 Отправлен утренний инсайт пользователю {user_id}")
+                        if await messenger.send(user_id, message):
+                            log.info(f"📨 Отправлен утренний инсайт пользователю {user_id}")
                         
                 except Exception as e:
                     log.error(f"Ошибка отправки утреннего инсайта {user_id}: {e}")
@@ -29,7 +29,7 @@ from bot.smart_features import (
 )
 from bot.db import register_mapping, user_contact, get_agent_id, get_balance, change_balance, conn
 from bot.config import REDEEM_CAP
-from bot.moysklad import find_agent_by_phone, fetch_shipments, fetch_demand_full, apply_discount
+from bot.moysklad import find_agent_by_phone, fetch_shipments, fetch_shipments_page, fetch_demand_full, apply_discount
 from bot.formatting import fmt_money, fmt_date_local, render_positions
 from bot.accrual import doc_age_seconds, accrue_for_demand
 from bot.loyalty import get_redeem_cap, format_level_status, format_level_benefits, get_level_info, calculate_level_by_spent
@@ -541,7 +541,8 @@ def register_ux_copy_handlers(dp):
             return await m.answer(ErrorTexts.auth_required())
 
         # Получаем историю из МойСклад
-        shipments = fetch_shipments(agent_id, limit=10)
+        page = fetch_shipments_page(agent_id, limit=10)
+        shipments = page["items"]
         
         if not shipments:
             return await m.answer(AnalyticsTexts.visit_history_empty())
@@ -559,7 +560,7 @@ def register_ux_copy_handlers(dp):
         message += "\n\n💡 Нажмите на любой визит для подробностей"
         
         from bot.handlers import list_visits_kb
-        await m.answer(message, reply_markup=list_visits_kb(shipments))
+        await m.answer(message, reply_markup=list_visits_kb(page))
 
     # ═══════════════════════════════════════════════════════════════════
     # 💬 ПОДДЕРЖКА С ПЕРСОНАЛИЗАЦИЕЙ
@@ -9,6 +9,8 @@ import logging
 from datetime import datetime
 from typing import List, Tuple
 
+from bot.db import init_db, add_to_daily_rollup, sync_rollup_snapshots
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -68,6 +70,7 @@ def add_bonus_to_contractor(agent_id: str, bonus_amount: int, description: str)
             """,
             (agent_id, "accrual", bonus_amount, description)
         )
+        add_to_daily_rollup(datetime.now().strftime("%Y-%m-%d"), connection=conn, accrued=bonus_amount)
         
         conn.commit()
         conn.close()
@@ -135,6 +138,9 @@ def bulk_accrual(bonus_amount: int = 20000):  # 200 рублей = 20000 коп
             print(f" ✗ ОШИБКА")
             log.error(f"Ошибка начисления для {fullname} ({agent_id})")
     
+    # Балансы менялись в обход bot.db: выравниваем итоги для отчётов
+    sync_rollup_snapshots()
+    
     # Итоговый отчет
     print("\n" + "="*60)
     print("ИТОГОВЫЙ ОТЧЕТ:")
@@ -188,6 +194,8 @@ def main():
     choice = input("\nВыберите действие (1-3): ").strip()
     
     if choice == "1":
+        # Таблицы сводок создаёт init_db: импорт bot.db схему не трогает
+        init_db()
         bulk_accrual()
     elif choice == "2":
         export_contractors_to_csv()
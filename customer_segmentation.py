@@ -11,6 +11,7 @@ from datetime import datetime, timedelta
 import logging
 from pathlib import Path
 import json
+import argparse
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,11 +21,16 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class CustomerSegmentation:
-    def __init__(self, db_path='loyalty.db'):
+    def __init__(self, db_path='loyalty.db', export_dir=None):
         """
         Инициализация системы сегментации
+
+        export_dir — каталог колоночной выгрузки (bot/analytics_export.py):
+        отгрузки читаются из него через mmap, а не из SQLite, и туда же
+        выгружается снимок сегментов
         """
         self.db_path = db_path
+        self.export_dir = export_dir
         self.segments_config = {
             # RFM сегменты
             'Champions': {'R': [4, 5], 'F': [4, 5], 'M': [4, 5]},
@@ -45,6 +51,9 @@ class CustomerSegmentation:
         """
         logger.info("Получение данных для RFM-анализа...")
         
+        if self.export_dir:
+            return self._get_rfm_data_from_export()
+        
         conn = sqlite3.connect(self.db_path)
         
         # Основной запрос для RFM-данных
@@ -97,6 +106,66 @@ class CustomerSegmentation:
         logger.info(f"Загружено {len(df)} записей клиентов")
         return df
     
+    def _get_rfm_data_from_export(self):
+        """
+        То же, что get_rfm_data, но агрегаты по отгрузкам считаются по
+        колоночной выгрузке; из SQLite читаются только справочные таблицы
+        """
+        import pyarrow.dataset as ds
+        from bot.analytics_export import export_tables, load_table
+        
+        # Дописываем в выгрузку отгрузки, появившиеся после прошлого запуска
+        export_tables(self.db_path, self.export_dir, ["contractor_shipments"])
+        shipments = load_table(
+            "contractor_shipments", self.export_dir,
+            columns=["agent_id", "demand_id", "moment", "sum", "state_name"],
+            filter=ds.field("state_name") == "Оплачено"
+        )
+        shipments = shipments[shipments["moment"].notna()]
+        
+        moments = shipments["moment"].str[:10]
+        grouped = shipments.assign(day=moments).groupby("agent_id")
+        stats = pd.DataFrame({
+            "frequency": grouped["demand_id"].count(),
+            "monetary_total": grouped["sum"].sum(),
+            "avg_order_value": grouped["sum"].mean(),
+            "first_purchase_date": grouped["moment"].min(),
+            "last_purchase_date": grouped["moment"].max(),
+            "purchase_days_count": grouped["day"].nunique(),
+        })
+        
+        conn = sqlite3.connect(self.db_path)
+        clients = pd.read_sql_query("""
+        SELECT 
+            c.agent_id,
+            c.name as customer_name,
+            c.phone,
+            c.email,
+            COALESCE(b.balance, 0) as bonus_balance,
+            COALESCE(l.level_id, 1) as loyalty_level,
+            CASE WHEN EXISTS (SELECT 1 FROM user_map u WHERE u.agent_id = c.agent_id)
+                 THEN 1 ELSE 0 END as is_registered
+        FROM contractors_data c
+        LEFT JOIN bonuses b ON c.agent_id = b.agent_id
+        LEFT JOIN loyalty_levels l ON c.agent_id = l.agent_id
+        """, conn)
+        conn.close()
+        
+        df = clients.merge(stats, left_on="agent_id", right_index=True, how="left")
+        
+        # julianday('now') в SQLite — UTC, дни усекаются как CAST(... AS INTEGER)
+        now = pd.Timestamp.now(tz="UTC").tz_localize(None)
+        last = pd.to_datetime(df["last_purchase_date"], errors="coerce")
+        recency = ((now - last).dt.total_seconds() / 86400).fillna(999)
+        df.insert(df.columns.get_loc("frequency"), "recency_days", np.trunc(recency).astype(int))
+        
+        for column in ("frequency", "monetary_total", "purchase_days_count"):
+            df[column] = df[column].fillna(0).astype(int)
+        
+        df = df.sort_values("monetary_total", ascending=False, kind="mergesort").reset_index(drop=True)
+        logger.info(f"Загружено {len(df)} записей клиентов (из выгрузки {self.export_dir})")
+        return df
+    
     def calculate_rfm_scores(self, df):
         """
         Расчет RFM-скоров (1-5 для каждой метрики)
@@ -154,20 +223,23 @@ class CustomerSegmentation:
     def assign_segments(self, df):
         """
         Присвоение сегментов на основе RFM-скоров
+        
+        Сегмент — первый подходящий по порядку segments_config, иначе 'Other'
         """
         logger.info("Присвоение сегментов...")
         
-        def get_segment(r, f, m):
-            for segment, criteria in self.segments_config.items():
-                if (criteria['R'][0] <= r <= criteria['R'][1] and
-                    criteria['F'][0] <= f <= criteria['F'][1] and
-                    criteria['M'][0] <= m <= criteria['M'][1]):
-                    return segment
-            return 'Other'
-        
-        df['segment'] = df.apply(
-            lambda row: get_segment(row['R_score'], row['F_score'], row['M_score']), 
-            axis=1
+        r, f, m = (df[f'{name}_score'].to_numpy() for name in ('R', 'F', 'M'))
+        conditions = [
+            (r >= c['R'][0]) & (r <= c['R'][1]) &
+            (f >= c['F'][0]) & (f <= c['F'][1]) &
+            (m >= c['M'][0]) & (m <= c['M'][1])
+            for c in self.segments_config.values()
+        ]
+        segments = np.select(conditions, list(self.segments_config), default='Other')
+        
+        # Категории по алфавиту: группировка в отчете идет в том же порядке, что и для строк
+        df['segment'] = pd.Categorical(
+            segments, categories=sorted([*self.segments_config, 'Other'])
         )
         
         logger.info("Сегменты присвоены")
@@ -183,49 +255,49 @@ class CustomerSegmentation:
         df['clv_estimate'] = df['avg_order_value'] * df['frequency'] * 2  # умножаем на 2 как прогноз
         
         # Активность (покупок в месяц)
-        df['purchase_frequency_monthly'] = df.apply(
-            lambda row: self._calculate_monthly_frequency(row), axis=1
-        )
+        df['purchase_frequency_monthly'] = self._calculate_monthly_frequency(df)
         
         # Статус активности
-        df['activity_status'] = df['recency_days'].apply(
-            lambda x: 'Active' if x <= 30 else 
-                     'Declining' if x <= 90 else 
-                     'Inactive' if x <= 365 else 'Lost'
+        recency = df['recency_days'].to_numpy()
+        df['activity_status'] = pd.Categorical(
+            np.select(
+                [recency <= 30, recency <= 90, recency <= 365],
+                ['Active', 'Declining', 'Inactive'],
+                default='Lost'
+            ),
+            categories=['Active', 'Declining', 'Inactive', 'Lost']
         )
         
         # Потенциал роста
-        df['growth_potential'] = df.apply(
-            lambda row: self._calculate_growth_potential(row), axis=1
-        )
+        df['growth_potential'] = self._calculate_growth_potential(df)
         
         return df
     
-    def _calculate_monthly_frequency(self, row):
+    def _calculate_monthly_frequency(self, df):
         """Расчет частоты покупок в месяц"""
-        if row['frequency'] == 0 or pd.isna(row['first_purchase_date']):
-            return 0
-        
-        try:
-            first_date = datetime.strptime(row['first_purchase_date'], '%Y-%m-%d %H:%M:%S.%f')
-            months_active = max(1, (datetime.now() - first_date).days / 30.44)  # среднее дней в месяце
-            return round(row['frequency'] / months_active, 2)
-        except:
-            return 0
+        # Даты в другом формате, как и пропуски, дают 0
+        first_date = pd.to_datetime(df['first_purchase_date'], format='%Y-%m-%d %H:%M:%S.%f', errors='coerce')
+        days_active = (pd.Timestamp(datetime.now()) - first_date).dt.days
+        months_active = np.maximum(1, days_active / 30.44)  # среднее дней в месяце
+        # Встроенный round, а не np.round: половинки округляются так же, как раньше
+        rate = (df['frequency'] / months_active).to_numpy(dtype=float)
+        frequency = pd.Series([round(v, 2) for v in rate.tolist()], index=df.index, dtype=float)
+        return frequency.where((df['frequency'] != 0) & first_date.notna(), 0.0)
     
-    def _calculate_growth_potential(self, row):
+    def _calculate_growth_potential(self, df):
         """Расчет потенциала роста клиента"""
-        if row['frequency'] == 0:
-            return 'Unknown'
-        
-        if row['R_score'] >= 4 and row['F_score'] <= 2:
-            return 'High'  # недавно покупал, но редко
-        elif row['R_score'] >= 3 and row['M_score'] <= 2:
-            return 'Medium'  # относительно недавно, но мало тратит
-        elif row['R_score'] <= 2 and row['F_score'] >= 3:
-            return 'Low'   # давно не покупал, но раньше был активен
-        else:
-            return 'Stable'
+        r, f, m = (df[f'{name}_score'].to_numpy() for name in ('R', 'F', 'M'))
+        potential = np.select(
+            [
+                df['frequency'].to_numpy() == 0,
+                (r >= 4) & (f <= 2),  # недавно покупал, но редко
+                (r >= 3) & (m <= 2),  # относительно недавно, но мало тратит
+                (r <= 2) & (f >= 3),  # давно не покупал, но раньше был активен
+            ],
+            ['Unknown', 'High', 'Medium', 'Low'],
+            default='Stable'
+        )
+        return pd.Categorical(potential, categories=['High', 'Medium', 'Low', 'Stable', 'Unknown'])
     
     def save_segmentation_results(self, df):
         """
@@ -293,7 +365,7 @@ class CustomerSegmentation:
         total_revenue = df['monetary_total'].sum()
         
         # Статистика по сегментам
-        segment_stats = df.groupby('segment').agg({
+        segment_stats = df.groupby('segment', observed=True).agg({
             'agent_id': 'count',
             'monetary_total': ['sum', 'mean'],
             'frequency': 'mean',
@@ -310,11 +382,13 @@ class CustomerSegmentation:
         # Добавляем процент от общего числа клиентов
         segment_stats['percentage'] = (segment_stats['customers_count'] / total_customers * 100).round(1)
         
-        # Статистика по активности
+        # Статистика по активности (категории без клиентов не выводятся)
         activity_stats = df['activity_status'].value_counts()
+        activity_stats = activity_stats[activity_stats > 0]
         
         # Статистика по потенциалу роста
         growth_stats = df['growth_potential'].value_counts()
+        growth_stats = growth_stats[growth_stats > 0]
         
         report = {
             'generated_at': datetime.now().isoformat(),
@@ -376,6 +450,9 @@ class CustomerSegmentation:
             
             # 5. Сохранение результатов
             self.save_segmentation_results(df)
+            if self.export_dir:
+                from bot.analytics_export import export_tables
+                export_tables(self.db_path, self.export_dir, ["customer_segments"])
             
             # 6. Генерация отчета
             report = self.generate_segment_report(df)
@@ -391,10 +468,14 @@ def main():
     """
     Главная функция
     """
+    parser = argparse.ArgumentParser(description="Сегментация клиентов")
+    parser.add_argument("--export-dir", help="каталог колоночной выгрузки (export_analytics.py)")
+    args = parser.parse_args()
+    
     print("🔄 Система сегментации клиентов")
     print("="*50)
     
-    segmentator = CustomerSegmentation()
+    segmentator = CustomerSegmentation(export_dir=args.export_dir)
     df, report = segmentator.run_full_segmentation()
     
     print("\n🎉 Сегментация завершена!")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Скрипт для колоночной выгрузки данных для аналитики
+Дописывает в каталог выгрузки новые строки contractor_shipments,
+bonus_transactions, loyalty_levels и снимок customer_segments
+(формат и устройство каталога описаны в bot/analytics_export.py)
+
+Использование:
+    python export_analytics.py                                   # все таблицы в ./exports
+    python export_analytics.py --tables contractor_shipments     # только отгрузки
+    python export_analytics.py --dir /data/exports --format parquet
+
+Чтение в pandas:
+    from bot.analytics_export import load_table
+    shipments = load_table("contractor_shipments", columns=["agent_id", "moment", "sum"])
+"""
+
+import time
+import logging
+import argparse
+
+from bot.analytics_export import export_tables, SPECS, DB_PATH, EXPORT_DIR, FORMATS
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Колоночная выгрузка данных для аналитики")
+    parser.add_argument("--tables", nargs="+", choices=list(SPECS), help="таблицы (по умолчанию все)")
+    parser.add_argument("--dir", default=EXPORT_DIR, help="каталог выгрузки")
+    parser.add_argument("--format", default="arrow", choices=list(FORMATS),
+                        help="arrow — для чтения через mmap, parquet — компактнее")
+    parser.add_argument("--db", default=DB_PATH, help="путь к базе SQLite")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    try:
+        exported = export_tables(args.db, args.dir, args.tables, args.format)
+    except (RuntimeError, ValueError) as e:
+        print(f"❌ {e}")
+        return
+
+    print(f"\n✅ Выгрузка в {args.dir} за {time.perf_counter() - started:.2f} с")
+    for table, rows in exported.items():
+        print(f"   • {table}: {rows} новых строк")
+
+
+if __name__ == "__main__":
+    main()
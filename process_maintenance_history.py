@@ -1,104 +1,229 @@
 #!/usr/bin/env python3
 """
 Скрипт для ретроспективной обработки истории ТО
-Анализирует все отгрузки в МойСклад и обновляет историю техобслуживания
+Проходит все отгрузки МойСклад помесячно и обновляет историю
+техобслуживания и пробега
+
+Месяцы загружаются параллельно (не больше --workers потоков, общий лимит
+запросов МойСклад соблюдается в bot.moysklad), а записываются в базу
+в основном потоке. Обработанные месяцы сохраняются в
+maintenance_backfill_progress, поэтому после сбоя скрипт продолжает
+с места остановки.
+
+Использование:
+    python process_maintenance_history.py                     # с первой отгрузки в базе
+    python process_maintenance_history.py --since 2023-01    # с января 2023
+    python process_maintenance_history.py --restart           # забыть прогресс и начать заново
 """
 
+import time
 import sqlite3
-from datetime import datetime
-from bot.moysklad import fetch_demand_full
-from bot.maintenance import process_moysklad_services
 import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from dateutil.relativedelta import relativedelta
+
+from bot.db import init_db
+from bot.moysklad import fetch_demands_page, MS_MAX_PARALLEL
+from bot.maintenance import (
+    init_maintenance_tables, process_moysklad_services, extract_mileage,
+    save_mileage_readings, refresh_maintenance_due_for
+)
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
-def process_all_maintenance_history():
-    """Обрабатывает всю историю отгрузок для обновления данных ТО"""
-    
-    # Подключаемся к базе данных
-    conn = sqlite3.connect('loyalty.db')
-    
-    # Получаем всех клиентов
-    clients = conn.execute("SELECT DISTINCT agent_id FROM bonuses").fetchall()
-    
-    for (agent_id,) in clients:
-        try:
-            log.info(f"Processing maintenance history for agent: {agent_id}")
-            
-            # Получаем все отгрузки для клиента
+DB_PATH = "loyalty.db"
+PAGE_SIZE = 100
+
+
+def create_progress_table(conn: sqlite3.Connection):
+    """Таблица обработанных месяцев"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_backfill_progress (
+            month TEXT PRIMARY KEY,
+            demands INTEGER NOT NULL DEFAULT 0,
+            agents INTEGER NOT NULL DEFAULT 0,
+            completed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+
+def month_range(since: datetime, until: datetime) -> List[datetime]:
+    """Начала месяцев от since до until включительно"""
+    months = []
+    current = since.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while current <= until:
+        months.append(current)
+        current += relativedelta(months=1)
+    return months
+
+
+def default_since(conn: sqlite3.Connection) -> datetime:
+    """Месяц первой отгрузки в contractor_shipments или три года назад"""
+    try:
+        row = conn.execute("SELECT MIN(moment) FROM contractor_shipments").fetchone()
+        if row and row[0]:
+            return datetime.fromisoformat(row[0][:10])
+    except sqlite3.Error:
+        pass
+    return datetime.now() - relativedelta(years=3)
+
+
+def fetch_month(month: datetime) -> List[dict]:
+    """Все отгрузки месяца с позициями и атрибутами (выполняется в потоке)"""
+    moment_from = month.strftime("%Y-%m-%d %H:%M:%S")
+    moment_to = (month + relativedelta(months=1, seconds=-1)).strftime("%Y-%m-%d %H:%M:%S")
+    demands = []
+    while True:
+        page = fetch_demands_page(moment_from, moment_to, limit=PAGE_SIZE, offset=len(demands), state=None)
+        demands.extend(page)
+        if len(page) < PAGE_SIZE:
+            return demands
+
+
+def demand_agent_id(demand: dict) -> str:
+    href = demand.get("agent", {}).get("meta", {}).get("href", "")
+    return href.split("/")[-1] if href else ""
+
+
+def apply_month(demands: List[dict], known_agents: set) -> Tuple[int, set]:
+    """Записывает пробег и работы ТО по отгрузкам месяца; возвращает (отгрузок, клиенты)"""
+    readings = []
+    touched = set()
+    processed = 0
+
+    for demand in demands:
+        agent_id = demand_agent_id(demand)
+        if agent_id not in known_agents:
+            continue
+        processed += 1
+
+        mileage = extract_mileage(demand)
+        if mileage == 0:
+            continue  # Пропускаем отгрузки без пробега
+
+        readings.append((agent_id, demand["id"], demand["moment"], mileage))
+        touched.add(agent_id)
+
+        services = [
+            p for p in demand.get("positions", {}).get("rows", [])
+            if p.get("assortment", {}).get("meta", {}).get("type") == "service"
+        ]
+        if services:
+            demand_date = datetime.fromisoformat(demand["moment"].replace("Z", "+00:00")).strftime("%Y-%m-%d")
+            process_moysklad_services(agent_id, demand["id"], services, mileage, demand_date)
+
+    save_mileage_readings(readings, source="sync")
+    refresh_maintenance_due_for(touched)
+    return processed, touched
+
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes:02d} мин" if hours else f"{minutes} мин {seconds:02d} с"
+
+
+def process_all_maintenance_history(since: datetime = None, workers: int = MS_MAX_PARALLEL,
+                                    restart: bool = False) -> Dict[str, int]:
+    """Обрабатывает историю отгрузок для обновления данных ТО"""
+
+    # Таблицы создаются явно: модули бота не трогают базу при импорте
+    init_db()
+    init_maintenance_tables()
+
+    conn = sqlite3.connect(DB_PATH)
+    create_progress_table(conn)
+    if restart:
+        conn.execute("DELETE FROM maintenance_backfill_progress")
+        conn.commit()
+
+    known_agents = {row[0] for row in conn.execute("SELECT agent_id FROM bonuses")}
+    done = {row[0] for row in conn.execute("SELECT month FROM maintenance_backfill_progress")}
+    now = datetime.now()
+    months = [m for m in month_range(since or default_since(conn), now) if m.strftime("%Y-%m") not in done]
+
+    log.info(f"Месяцев к обработке: {len(months)} (уже обработано: {len(done)}), клиентов: {len(known_agents)}")
+
+    totals = {"months": 0, "demands": 0, "agents": 0, "failed": 0}
+    all_agents = set()
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, MS_MAX_PARALLEL))) as executor:
+        futures = {executor.submit(fetch_month, month): month for month in months}
+        for future in as_completed(futures):
+            month = futures[future]
+            label = month.strftime("%Y-%m")
             try:
-                from bot.moysklad import fetch_shipments
-                shipments = fetch_shipments(agent_id, limit=100)  # Берем последние 100 отгрузок
-                
-                for shipment in shipments:
-                    try:
-                        # Получаем детали отгрузки
-                        demand = fetch_demand_full(shipment["id"])
-                        
-                        # Извлекаем пробег
-                        mileage = 0
-                        attributes = demand.get('attributes', [])
-                        for attr in attributes:
-                            if attr.get('name') == 'Пробег':
-                                mileage_str = str(attr.get('value', '0'))
-                                mileage_clean = ''.join(filter(str.isdigit, mileage_str))
-                                mileage = int(mileage_clean) if mileage_clean else 0
-                                break
-                        
-                        if mileage == 0:
-                            continue  # Пропускаем отгрузки без пробега
-                        
-                        # Извлекаем услуги
-                        services = []
-                        positions = demand.get("positions", {}).get("rows", [])
-                        for p in positions:
-                            if p["assortment"]["meta"]["type"] == "service":
-                                services.append(p)
-                        
-                        if not services:
-                            continue  # Пропускаем отгрузки без услуг
-                        
-                        # Получаем дату отгрузки
-                        demand_date = datetime.fromisoformat(demand["moment"].replace("Z", "+00:00")).strftime("%Y-%m-%d")
-                        
-                        # Обрабатываем услуги для ТО
-                        process_moysklad_services(agent_id, demand["id"], services, mileage, demand_date)
-                        
-                        log.info(f"Processed demand {demand['id']} with {len(services)} services, mileage: {mileage}")
-                        
-                    except Exception as e:
-                        log.error(f"Error processing demand {shipment['id']}: {e}")
-                        continue
-                        
+                demands = future.result()
+                processed, touched = apply_month(demands, known_agents)
             except Exception as e:
-                log.error(f"Error fetching shipments for agent {agent_id}: {e}")
+                totals["failed"] += 1
+                log.error(f"Error processing {label}: {e}")
                 continue
-                
-        except Exception as e:
-            log.error(f"Error processing agent {agent_id}: {e}")
-            continue
-    
+
+            # Текущий месяц ещё пополняется: его не отмечаем обработанным
+            if month + relativedelta(months=1) <= now:
+                conn.execute(
+                    "INSERT OR REPLACE INTO maintenance_backfill_progress (month, demands, agents) VALUES (?, ?, ?)",
+                    (label, processed, len(touched))
+                )
+                conn.commit()
+
+            totals["months"] += 1
+            totals["demands"] += processed
+            all_agents |= touched
+
+            elapsed = time.perf_counter() - started
+            remaining = len(months) - totals["months"] - totals["failed"]
+            eta = elapsed / (totals["months"] + totals["failed"]) * remaining
+            log.info(
+                f"[{totals['months'] + totals['failed']}/{len(months)}] {label}: "
+                f"{processed} отгрузок, {len(touched)} клиентов с пробегом; "
+                f"всего {totals['demands']} отгрузок за {format_eta(elapsed)}, осталось ~{format_eta(eta)}"
+            )
+
     conn.close()
+    totals["agents"] = len(all_agents)
     log.info("Maintenance history processing completed!")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обработка истории ТО по отгрузкам МойСклад")
+    parser.add_argument("--since", help="первый месяц, YYYY-MM (по умолчанию — первая отгрузка в базе)")
+    parser.add_argument("--workers", type=int, default=MS_MAX_PARALLEL, help="параллельных загрузок месяцев")
+    parser.add_argument("--restart", action="store_true", help="забыть прогресс и обработать всё заново")
+    args = parser.parse_args()
+
+    since = datetime.strptime(args.since, "%Y-%m") if args.since else None
 
-if __name__ == "__main__":
     print("🔧 Обработка истории технического обслуживания...")
-    print("Это может занять несколько минут...")
-    
+
     try:
-        process_all_maintenance_history()
-        print("✅ Обработка завершена успешно!")
-        
+        totals = process_all_maintenance_history(since, args.workers, args.restart)
+        print("✅ Обработка завершена успешно!" if not totals["failed"]
+              else f"⚠️ Обработка завершена, месяцев с ошибками: {totals['failed']} (запустите скрипт ещё раз)")
+
         # Показываем статистику
-        conn = sqlite3.connect('loyalty.db')
+        conn = sqlite3.connect(DB_PATH)
         count = conn.execute("SELECT COUNT(*) FROM maintenance_history").fetchone()[0]
         unique_agents = conn.execute("SELECT COUNT(DISTINCT agent_id) FROM maintenance_history").fetchone()[0]
         conn.close()
-        
+
         print(f"📊 Статистика:")
+        print(f"   • Обработано отгрузок: {totals['demands']}")
         print(f"   • Записей ТО: {count}")
         print(f"   • Клиентов: {unique_agents}")
-        
+
     except Exception as e:
         print(f"❌ Ошибка: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Скрипт для массового пересчёта сумм трат и уровней лояльности
+Пересчитывает total_spent, level_id и total_earned всех клиентов одним
+векторным проходом по contractor_shipments и записывает изменения одним
+set-based UPDATE. По умолчанию работает в режиме dry-run и только
+показывает отчёт о расхождениях.
+
+Использование:
+    python recompute_loyalty_levels.py                    # dry-run, отчёт
+    python recompute_loyalty_levels.py --report diff.csv  # dry-run + CSV с расхождениями
+    python recompute_loyalty_levels.py --apply            # записать total_spent и level_id
+    python recompute_loyalty_levels.py --apply --earned   # ... и total_earned
+"""
+
+import time
+import sqlite3
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from bot.db import init_db, rebuild_client_ranking, sync_rollup_snapshots
+from bot.loyalty import load_rules, TierRules
+
+DB_PATH = "loyalty.db"
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+log = logging.getLogger(__name__)
+
+
+def load_shipments(conn: sqlite3.Connection) -> pd.DataFrame:
+    """Загружает все отгрузки одним запросом"""
+    return pd.read_sql_query(
+        "SELECT agent_id, moment, sum FROM contractor_shipments WHERE moment IS NOT NULL",
+        conn
+    )
+
+
+def compute_levels(shipments: pd.DataFrame, rules: TierRules) -> pd.DataFrame:
+    """
+    Рассчитывает итоги по клиентам
+
+    Бонусы за каждую отгрузку считаются по ставке уровня, который был у
+    клиента на момент покупки (по сумме всех предыдущих отгрузок), с учётом
+    акций, действовавших в момент отгрузки.
+    contractor_shipments хранит только сумму отгрузки без деления на товары
+    и услуги, поэтому total_earned — оценка сверху.
+    """
+    if shipments.empty:
+        return pd.DataFrame(columns=["agent_id", "total_spent", "level_id", "total_earned"])
+
+    df = shipments.sort_values(["agent_id", "moment"], kind="mergesort")
+    amounts = df["sum"].fillna(0).astype(np.int64)
+
+    # Сумма трат до текущей отгрузки → уровень и ставка на момент покупки
+    spent_before = amounts.groupby(df["agent_id"], sort=False).cumsum().to_numpy() - amounts.to_numpy()
+    moments = pd.to_datetime(df["moment"].str[:19], errors="coerce").to_numpy()
+    rates = rules.rates_for(rules.levels_for(spent_before), at=moments)
+    bonuses = np.floor(amounts.to_numpy() * rates).astype(np.int64)
+
+    totals = pd.DataFrame({
+        "agent_id": df["agent_id"].to_numpy(),
+        "total_spent": amounts.to_numpy(),
+        "total_earned": bonuses,
+    }).groupby("agent_id", sort=False, as_index=False).sum()
+
+    totals["level_id"] = rules.levels_for(totals["total_spent"].to_numpy())
+    return totals[["agent_id", "total_spent", "level_id", "total_earned"]]
+
+
+def build_diff(conn: sqlite3.Connection, computed: pd.DataFrame, with_earned: bool) -> pd.DataFrame:
+    """
+    Сравнивает пересчёт с текущими loyalty_levels
+
+    Учитываются только клиенты из bonuses. Клиенты без отгрузок
+    в contractor_shipments не трогаются.
+    """
+    current = pd.read_sql_query("""
+        SELECT b.agent_id,
+               l.total_spent AS old_total_spent,
+               l.level_id AS old_level_id,
+               l.total_earned AS old_total_earned
+        FROM bonuses b
+        LEFT JOIN loyalty_levels l ON l.agent_id = b.agent_id
+    """, conn)
+
+    diff = current.merge(computed, on="agent_id", how="inner")
+    diff["is_new"] = diff["old_level_id"].isna()
+    old_spent = diff["old_total_spent"].fillna(0).astype(np.int64)
+    old_level = diff["old_level_id"].fillna(1).astype(np.int64)
+    old_earned = diff["old_total_earned"].fillna(0).astype(np.int64)
+
+    changed = diff["is_new"] | (old_spent != diff["total_spent"]) | (old_level != diff["level_id"])
+    if with_earned:
+        changed |= old_earned != diff["total_earned"]
+
+    diff = diff.assign(
+        old_total_spent=old_spent, old_level_id=old_level, old_total_earned=old_earned,
+        spent_delta=diff["total_spent"] - old_spent,
+    )
+    return diff[changed].reset_index(drop=True)
+
+
+def print_report(diff: pd.DataFrame, computed: pd.DataFrame):
+    """Печатает сводку расхождений"""
+    print(f"\n📊 Клиентов с отгрузками: {len(computed)}")
+    print(f"   • Расхождений: {len(diff)} (новых строк loyalty_levels: {int(diff['is_new'].sum())})")
+    if diff.empty:
+        return
+
+    ups = int((diff["level_id"] > diff["old_level_id"]).sum())
+    downs = int((diff["level_id"] < diff["old_level_id"]).sum())
+    print(f"   • Повышение уровня: {ups}, понижение: {downs}")
+    print(f"   • Изменение суммы трат: {diff['spent_delta'].sum() / 100:.2f} руб")
+
+    transitions = pd.crosstab(diff["old_level_id"], diff["level_id"],
+                              rownames=["было"], colnames=["стало"])
+    print("\nПереходы между уровнями:")
+    print(transitions.to_string())
+
+    top = diff.reindex(diff["spent_delta"].abs().sort_values(ascending=False).index).head(10)
+    print("\nНаибольшие расхождения по сумме трат:")
+    print(top[["agent_id", "old_total_spent", "total_spent", "old_level_id", "level_id"]].to_string(index=False))
+
+
+def apply_changes(conn: sqlite3.Connection, diff: pd.DataFrame, with_earned: bool):
+    """Записывает изменения одним UPDATE и одним INSERT в одной транзакции"""
+    rows = diff[["agent_id", "total_spent", "level_id", "total_earned"]].itertuples(index=False, name=None)
+
+    earned_set = ", total_earned = r.total_earned" if with_earned else ""
+    earned_insert = "r.total_earned" if with_earned else "0"
+
+    with conn:
+        conn.execute("""
+            CREATE TEMP TABLE recompute_levels (
+                agent_id TEXT PRIMARY KEY,
+                total_spent INTEGER,
+                level_id INTEGER,
+                total_earned INTEGER
+            )
+        """)
+        conn.executemany("INSERT INTO recompute_levels VALUES (?, ?, ?, ?)",
+                         [(a, int(s), int(l), int(e)) for a, s, l, e in rows])
+        conn.execute(f"""
+            UPDATE loyalty_levels
+            SET total_spent = r.total_spent, level_id = r.level_id{earned_set},
+                updated_at = CURRENT_TIMESTAMP
+            FROM recompute_levels r
+            WHERE loyalty_levels.agent_id = r.agent_id
+        """)
+        conn.execute(f"""
+            INSERT INTO loyalty_levels (agent_id, level_id, total_spent, total_earned)
+            SELECT r.agent_id, r.level_id, r.total_spent, {earned_insert}
+            FROM recompute_levels r
+            WHERE NOT EXISTS (SELECT 1 FROM loyalty_levels l WHERE l.agent_id = r.agent_id)
+        """)
+        conn.execute("DROP TABLE recompute_levels")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчёт сумм трат и уровней лояльности")
+    parser.add_argument("--apply", action="store_true", help="записать изменения (по умолчанию dry-run)")
+    parser.add_argument("--earned", action="store_true", help="пересчитать и total_earned")
+    parser.add_argument("--report", help="сохранить расхождения в CSV")
+    parser.add_argument("--db", default=DB_PATH, help="путь к базе SQLite")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    conn = sqlite3.connect(args.db)
+    try:
+        shipments = load_shipments(conn)
+        # Правила уровней — из той же базы, что и отгрузки
+        computed = compute_levels(shipments, load_rules(conn))
+        diff = build_diff(conn, computed, args.earned)
+        log.info(f"Пересчёт {len(shipments)} отгрузок занял {time.perf_counter() - started:.2f} с")
+
+        print_report(diff, computed)
+        if args.report:
+            diff.to_csv(args.report, index=False)
+            print(f"\n💾 Отчёт сохранён в {args.report}")
+
+        if args.apply and not diff.empty:
+            # Рейтинг и сводки пересобираются после записи: в старой базе
+            # их таблиц может ещё не быть
+            init_db(conn)
+            apply_changes(conn, diff, args.earned)
+            rebuild_client_ranking(conn)
+            sync_rollup_snapshots(conn)
+            print(f"\n✅ Обновлено клиентов: {len(diff)}")
+        elif not args.apply:
+            print("\nℹ️ Dry-run: изменения не записаны (используйте --apply)")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -62,6 +62,31 @@ CREATE TABLE IF NOT EXISTS accrual_log (
     processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Outbox побочных эффектов начисления
+CREATE TABLE IF NOT EXISTS accrual_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    demand_id TEXT NOT NULL,
+    agent_id TEXT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP,
+    UNIQUE (event_type, demand_id)
+);
+CREATE INDEX IF NOT EXISTS idx_accrual_outbox_pending
+ON accrual_outbox(next_attempt_at) WHERE status = 'pending';
+
+-- Курсоры сканера начислений
+CREATE TABLE IF NOT EXISTS accrual_cursor (
+    name TEXT PRIMARY KEY,
+    moment TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Уровни лояльности
 CREATE TABLE IF NOT EXISTS loyalty_levels (
     agent_id TEXT PRIMARY KEY,
@@ -74,21 +99,24 @@ CREATE TABLE IF NOT EXISTS loyalty_levels (
     FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
 );
 
--- Транзакции бонусов
+-- Транзакции бонусов (помесячные партиции по created_at)
 CREATE TABLE IF NOT EXISTS bonus_transactions (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     agent_id TEXT NOT NULL,
     transaction_type TEXT NOT NULL, -- 'accrual' или 'redemption'
     amount INTEGER NOT NULL,
     description TEXT NOT NULL,
     related_demand_id TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at),
     FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
-);
+) PARTITION BY RANGE (created_at);
+CREATE TABLE IF NOT EXISTS bonus_transactions_default
+    PARTITION OF bonus_transactions DEFAULT;
 
--- История технического обслуживания
+-- История технического обслуживания (помесячные партиции по performed_date)
 CREATE TABLE IF NOT EXISTS maintenance_history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     agent_id TEXT NOT NULL,
     work_id INTEGER NOT NULL,
     performed_date DATE NOT NULL,
@@ -97,8 +125,11 @@ CREATE TABLE IF NOT EXISTS maintenance_history (
     demand_id TEXT, -- ID отгрузки из МойСклад (если source='auto')
     notes TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, performed_date),
     FOREIGN KEY (agent_id) REFERENCES bonuses(agent_id)
-);
+) PARTITION BY RANGE (performed_date);
+CREATE TABLE IF NOT EXISTS maintenance_history_default
+    PARTITION OF maintenance_history DEFAULT;
 
 -- Настройки ТО
 CREATE TABLE IF NOT EXISTS maintenance_settings (
@@ -115,7 +146,8 @@ CREATE TABLE IF NOT EXISTS maintenance_settings (
 CREATE TABLE IF NOT EXISTS maintenance_service_mapping (
     moysklad_service_name TEXT PRIMARY KEY,
     work_id INTEGER NOT NULL,
-    is_active BOOLEAN DEFAULT TRUE
+    is_active BOOLEAN DEFAULT TRUE,
+    match_type TEXT NOT NULL DEFAULT 'exact'
 );
 
 -- Достижения пользователей
@@ -131,11 +163,171 @@ CREATE INDEX IF NOT EXISTS idx_maintenance_history_agent_work
     ON maintenance_history(agent_id, work_id);
 CREATE INDEX IF NOT EXISTS idx_maintenance_history_date 
     ON maintenance_history(performed_date);
+CREATE INDEX IF NOT EXISTS idx_bonus_transactions_agent_date
+    ON bonus_transactions(agent_id, created_at DESC);
 """
 
+# Функции обслуживания партиций.
+# ensure_monthly_partitions создаёт партиции <таблица>_yYYYYmMM от from_date
+# до текущего месяца + months_ahead и переносит в них строки этих месяцев
+# из партиции DEFAULT. old_partitions перечисляет партиции старше keep_months
+# (самые старые бот выгружает в сжатые файлы и удаляет). archive_old_partitions
+# возвращает ещё не архивные партиции старше keep_months, перенося их в архивное
+# табличное пространство (если задано); mark_partition_archived отключает
+# автовакуум и отмечает партицию архивной — её вызывают только после успешного
+# VACUUM FREEZE.
+partition_functions = r"""
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(
+    parent TEXT, from_date DATE, months_ahead INTEGER DEFAULT 3
+) RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_date)::date;
+    month_end DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+    partition_name TEXT;
+    default_part REGCLASS;
+    key_column TEXT;
+    moved BIGINT;
+    created INTEGER := 0;
+BEGIN
+    SELECT NULLIF(p.partdefid, 0)::regclass, a.attname
+    INTO default_part, key_column
+    FROM pg_partitioned_table p
+    JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+    WHERE p.partrelid = parent::regclass;
+
+    WHILE month_start <= last_month LOOP
+        month_end := (month_start + INTERVAL '1 month')::date;
+        partition_name := format('%s_y%sm%s', parent, to_char(month_start, 'YYYY'), to_char(month_start, 'MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Строки месяца, попавшие в DEFAULT до создания партиции, не дают
+            -- её подключить: переносим их во временную таблицу и обратно
+            moved := 0;
+            IF default_part IS NOT NULL THEN
+                EXECUTE format('CREATE TEMP TABLE partition_rows (LIKE %I)', parent);
+                EXECUTE format('WITH moved_rows AS (DELETE FROM %s WHERE %I >= %L AND %I < %L RETURNING *) '
+                               'INSERT INTO partition_rows SELECT * FROM moved_rows',
+                               default_part, key_column, month_start, key_column, month_end);
+                GET DIAGNOSTICS moved = ROW_COUNT;
+            END IF;
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, parent, month_start, month_end);
+            IF default_part IS NOT NULL THEN
+                IF moved > 0 THEN
+                    EXECUTE format('INSERT INTO %I SELECT * FROM partition_rows', parent);
+                END IF;
+                DROP TABLE partition_rows;
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION old_partitions(parent TEXT, keep_months INTEGER)
+RETURNS SETOF TEXT AS $$
+    SELECT c.relname::text
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent::regclass
+      AND c.relname ~ '_y\d{4}m\d{2}$'
+      AND to_date(substring(c.relname FROM '(\d{4}m\d{2})$'), 'YYYY"m"MM')
+          < (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date
+    ORDER BY 1
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION archive_old_partitions(
+    parent TEXT, keep_months INTEGER DEFAULT 12, archive_tablespace TEXT DEFAULT NULL
+) RETURNS SETOF TEXT AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT p FROM old_partitions(parent, keep_months) p
+        WHERE COALESCE(obj_description(p::regclass, 'pg_class'), '') <> 'archived'
+    LOOP
+        IF archive_tablespace IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %I SET TABLESPACE %I', partition_name, archive_tablespace);
+        END IF;
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mark_partition_archived(partition_name TEXT) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('ALTER TABLE %I SET (autovacuum_enabled = false)', partition_name);
+    EXECUTE format('COMMENT ON TABLE %I IS %L', partition_name, 'archived');
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Партиционируемые таблицы: имя -> колонка ключа партиционирования
+PARTITIONED_TABLES = {
+    "bonus_transactions": "created_at",
+    "maintenance_history": "performed_date",
+}
+
+
+def convert_legacy_table(cursor, table_name):
+    """
+    Переводит существующую обычную таблицу в партиционированную
+
+    Старая таблица переименовывается в <имя>_legacy, данные копируются
+    в новую партиционированную таблицу, после чего старая удаляется вместе
+    со своей последовательностью (<имя>_legacy_id_seq).
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table_name,))
+    row = cursor.fetchone()
+    if not row or row[0] != 'r':
+        return False
+
+    print(f"🔄 Перевод таблицы {table_name} на партиции...")
+    # Имена индексов и последовательностей общие для схемы — освобождаем их
+    cursor.execute("""
+    SELECT indexname FROM pg_indexes
+    WHERE tablename = %s AND indexname <> %s
+    """, (table_name, f"{table_name}_pkey"))
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX {index_name}")
+    cursor.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_legacy")
+    cursor.execute(f"ALTER TABLE {table_name}_legacy RENAME CONSTRAINT {table_name}_pkey TO {table_name}_legacy_pkey")
+    cursor.execute(f"ALTER SEQUENCE IF EXISTS {table_name}_id_seq OWNED BY NONE")
+    cursor.execute(f"ALTER SEQUENCE IF EXISTS {table_name}_id_seq RENAME TO {table_name}_legacy_id_seq")
+    return True
+
 try:
+    # Старые непартиционированные таблицы переименовываем перед созданием новых
+    converted = [
+        table_name for table_name in PARTITIONED_TABLES
+        if convert_legacy_table(cursor, table_name)
+    ]
+
     # Выполняем SQL-скрипт для создания таблиц
     cursor.execute(create_tables)
+    cursor.execute(partition_functions)
+
+    for table_name, column in PARTITIONED_TABLES.items():
+        # Партиции от самой ранней записи (или текущего месяца) на 3 месяца вперёд
+        source = f"{table_name}_legacy" if table_name in converted else table_name
+        cursor.execute(f"SELECT COALESCE(MIN({column})::date, CURRENT_DATE) FROM {source}")
+        from_date = cursor.fetchone()[0]
+        cursor.execute("SELECT ensure_monthly_partitions(%s, %s)", (table_name, from_date))
+        print(f"📅 {table_name}: создано партиций: {cursor.fetchone()[0]}")
+
+        if table_name in converted:
+            cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {table_name}_legacy")
+            cursor.execute(f"""
+            SELECT setval(pg_get_serial_sequence('{table_name}', 'id'),
+                          COALESCE((SELECT MAX(id) FROM {table_name}), 0) + 1, false)
+            """)
+            cursor.execute(f"DROP TABLE {table_name}_legacy")
+            # Последовательность отвязана от старой таблицы и сама с ней не удаляется
+            cursor.execute(f"DROP SEQUENCE IF EXISTS {table_name}_legacy_id_seq")
+            print(f"✅ {table_name}: данные перенесены в партиции")
+
     conn.commit()
     print("✅ Таблицы успешно созданы в PostgreSQL")
 except Exception as e:
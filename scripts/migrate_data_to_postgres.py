@@ -1,12 +1,27 @@
 #!/usr/bin/env python3
 """
 Скрипт для миграции данных из SQLite в PostgreSQL
+
+Данные читаются из SQLite порциями и записываются через COPY.
+Независимые таблицы переносятся параллельно, прогресс по каждой таблице
+сохраняется в PostgreSQL (migration_progress), поэтому после обрыва
+миграция продолжается с места остановки. В конце сверяются количество
+строк и контрольные суммы.
+
+Использование:
+    python migrate_data_to_postgres.py            # перенос / продолжение
+    python migrate_data_to_postgres.py --fresh    # начать заново (репетиция переключения)
+    python migrate_data_to_postgres.py --verify   # только сверка
 """
 import os
+import io
 import sys
+import time
+import hashlib
 import sqlite3
+import argparse
 import psycopg2
-import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из файла .env.postgres
@@ -22,135 +37,307 @@ POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 
-# Проверка существования SQLite базы данных
-if not os.path.exists(SQLITE_DB_PATH):
-    print(f"❌ SQLite база данных не найдена по пути: {SQLITE_DB_PATH}")
-    sys.exit(1)
-
-# Подключение к SQLite
-try:
-    sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
-    sqlite_conn.row_factory = sqlite3.Row  # Это позволит получать результаты в виде словарей
-    print(f"✅ Успешное подключение к SQLite ({SQLITE_DB_PATH})")
-except Exception as e:
-    print(f"❌ Ошибка подключения к SQLite: {e}")
-    sys.exit(1)
-
-# Подключение к PostgreSQL
-try:
-    pg_conn = psycopg2.connect(
+# Размер порции чтения из SQLite
+CHUNK_SIZE = 5000
+
+# Количество параллельных потоков
+MAX_WORKERS = 4
+
+# Таблицы для переноса: имя -> (колонки, первичный ключ, временные колонки).
+# Таблицы разбиты на волны: внутри волны нет внешних ключей друг на друга,
+# поэтому таблицы одной волны переносятся параллельно.
+TABLE_WAVES = [
+    {
+        'user_map': (['tg_id', 'agent_id', 'phone', 'fullname'], ['tg_id'], []),
+        'bonuses': (['agent_id', 'balance'], ['agent_id'], []),
+        'accrual_log': (['demand_id', 'processed_at'], ['demand_id'], ['processed_at']),
+        'maintenance_service_mapping': (
+            ['moysklad_service_name', 'work_id', 'is_active', 'match_type'], ['moysklad_service_name'], []),
+        'user_achievements': (
+            ['user_id', 'achievement_id', 'unlocked_at'], ['user_id', 'achievement_id'], ['unlocked_at']),
+    },
+    {
+        'loyalty_levels': (
+            ['agent_id', 'level_id', 'total_spent', 'total_earned',
+             'total_redeemed', 'created_at', 'updated_at'],
+            ['agent_id'], ['created_at', 'updated_at']),
+        'bonus_transactions': (
+            ['id', 'agent_id', 'transaction_type', 'amount',
+             'description', 'related_demand_id', 'created_at'],
+            ['id'], ['created_at']),
+        'maintenance_history': (
+            ['id', 'agent_id', 'work_id', 'performed_date', 'mileage',
+             'source', 'demand_id', 'notes', 'created_at'],
+            ['id'], ['performed_date', 'created_at']),
+        'maintenance_settings': (
+            ['agent_id', 'work_id', 'custom_mileage_interval',
+             'custom_time_interval', 'is_active'],
+            ['agent_id', 'work_id'], []),
+    },
+]
+
+# Таблицы с SERIAL-ключом: после COPY с явными id нужно сдвинуть последовательность
+SERIAL_TABLES = ['bonus_transactions', 'maintenance_history']
+
+
+def connect_sqlite():
+    """Открывает соединение с SQLite (у каждого потока своё)"""
+    return sqlite3.connect(SQLITE_DB_PATH)
+
+
+def connect_postgres():
+    """Открывает соединение с PostgreSQL (у каждого потока своё)"""
+    return psycopg2.connect(
         host=POSTGRES_HOST,
         port=POSTGRES_PORT,
         user=POSTGRES_USER,
         password=POSTGRES_PASSWORD,
         dbname=POSTGRES_DB
     )
-    print(f"✅ Успешное подключение к PostgreSQL ({POSTGRES_HOST}:{POSTGRES_PORT})")
-except Exception as e:
-    print(f"❌ Ошибка подключения к PostgreSQL: {e}")
-    sqlite_conn.close()
-    sys.exit(1)
-
-# Функция для получения количества записей в таблице
-def count_rows(conn, table_name):
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-    count = cursor.fetchone()[0]
-    cursor.close()
-    return count
-
-# Функция для миграции данных между таблицами
-def migrate_table(table_name, columns, id_column=None):
-    print(f"\n📋 Миграция таблицы {table_name}...")
-    
-    # Получаем данные из SQLite
-    sqlite_cursor = sqlite_conn.cursor()
-    sqlite_cursor.execute(f"SELECT {', '.join(columns)} FROM {table_name}")
-    rows = sqlite_cursor.fetchall()
-    
-    if not rows:
-        print(f"ℹ️ Таблица {table_name} пуста. Пропускаем.")
-        return
-    
-    # Подготавливаем запрос для вставки в PostgreSQL
-    pg_cursor = pg_conn.cursor()
-    
-    # Очищаем таблицу в PostgreSQL перед вставкой (если есть данные)
-    pg_count = count_rows(pg_conn, table_name)
-    if pg_count > 0:
-        print(f"⚠️ В PostgreSQL уже есть {pg_count} записей в таблице {table_name}.")
-        choice = input("Очистить таблицу перед миграцией? (y/n): ").strip().lower()
-        if choice == 'y':
-            pg_cursor.execute(f"DELETE FROM {table_name}")
-            print(f"🗑️ Таблица {table_name} очищена.")
-        else:
-            print(f"⚠️ Возможно дублирование записей!")
-    
-    # Подготавливаем параметры для запроса
-    placeholders = ', '.join(['%s'] * len(columns))
-    insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
-    
-    # Выполняем вставку данных
+
+
+def init_progress_table(pg_conn):
+    """Создаёт таблицу прогресса миграции"""
+    with pg_conn.cursor() as cursor:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS migration_progress (
+            table_name TEXT PRIMARY KEY,
+            last_rowid BIGINT NOT NULL DEFAULT 0,
+            rows_copied BIGINT NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP
+        )
+        """)
+    pg_conn.commit()
+
+
+def reset_migration(pg_conn):
+    """Очищает целевые таблицы и прогресс для повторного прогона"""
+    tables = [name for wave in TABLE_WAVES for name in wave]
+    with pg_conn.cursor() as cursor:
+        cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+        cursor.execute("DELETE FROM migration_progress")
+    pg_conn.commit()
+    print(f"🗑️ Очищено таблиц: {len(tables)}")
+
+
+def _copy_value(value) -> str:
+    """Преобразует значение в текстовый формат COPY"""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def migrate_table(table_name, columns):
+    """
+    Переносит таблицу порциями через COPY
+
+    Каждая порция записывается в одной транзакции вместе с отметкой
+    прогресса, поэтому после обрыва перенос продолжается с последней
+    подтверждённой строки SQLite (rowid).
+    """
+    sqlite_conn = connect_sqlite()
+    pg_conn = connect_postgres()
+    started = time.perf_counter()
+
     try:
-        for row in rows:
-            # Преобразуем объект Row в список значений
-            values = [row[col] for col in columns]
-            pg_cursor.execute(insert_query, values)
-        
+        with pg_conn.cursor() as cursor:
+            cursor.execute("""
+            INSERT INTO migration_progress(table_name) VALUES (%s)
+            ON CONFLICT(table_name) DO NOTHING
+            """, (table_name,))
+            cursor.execute(
+                "SELECT last_rowid, rows_copied, completed_at FROM migration_progress WHERE table_name = %s",
+                (table_name,)
+            )
+            last_rowid, rows_copied, completed_at = cursor.fetchone()
+        pg_conn.commit()
+
+        if completed_at:
+            print(f"⏭️ {table_name}: уже перенесено ({rows_copied} записей)")
+            return rows_copied
+
+        if last_rowid:
+            print(f"🔄 {table_name}: продолжаем с rowid > {last_rowid} ({rows_copied} записей уже перенесено)")
+
+        sqlite_cursor = sqlite_conn.execute(
+            f"SELECT rowid, {', '.join(columns)} FROM {table_name} WHERE rowid > ? ORDER BY rowid",
+            (last_rowid,)
+        )
+        copy_sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN"
+
+        while True:
+            rows = sqlite_cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write('\t'.join(_copy_value(v) for v in row[1:]))
+                buffer.write('\n')
+            buffer.seek(0)
+
+            with pg_conn.cursor() as cursor:
+                cursor.copy_expert(copy_sql, buffer)
+                cursor.execute("""
+                UPDATE migration_progress
+                SET last_rowid = %s, rows_copied = rows_copied + %s
+                WHERE table_name = %s
+                """, (rows[-1][0], len(rows), table_name))
+            pg_conn.commit()
+            rows_copied += len(rows)
+
+        with pg_conn.cursor() as cursor:
+            if table_name in SERIAL_TABLES:
+                cursor.execute(f"""
+                SELECT setval(pg_get_serial_sequence('{table_name}', 'id'),
+                              COALESCE((SELECT MAX(id) FROM {table_name}), 0) + 1, false)
+                """)
+            cursor.execute(
+                "UPDATE migration_progress SET completed_at = CURRENT_TIMESTAMP WHERE table_name = %s",
+                (table_name,)
+            )
         pg_conn.commit()
-        print(f"✅ Успешно перенесено {len(rows)} записей в таблицу {table_name}")
+
+        elapsed = time.perf_counter() - started
+        print(f"✅ {table_name}: {rows_copied} записей за {elapsed:.2f} с")
+        return rows_copied
+
     except Exception as e:
         pg_conn.rollback()
         print(f"❌ Ошибка при миграции таблицы {table_name}: {e}")
+        raise
     finally:
-        pg_cursor.close()
-        sqlite_cursor.close()
-
-# Выполняем миграцию для каждой таблицы
-try:
-    # 1. Таблица user_map
-    migrate_table('user_map', ['tg_id', 'agent_id', 'phone', 'fullname'])
-    
-    # 2. Таблица bonuses
-    migrate_table('bonuses', ['agent_id', 'balance'])
-    
-    # 3. Таблица accrual_log
-    migrate_table('accrual_log', ['demand_id', 'processed_at'])
-    
-    # 4. Таблица loyalty_levels
-    migrate_table('loyalty_levels', 
-                 ['agent_id', 'level_id', 'total_spent', 'total_earned', 
-                  'total_redeemed', 'created_at', 'updated_at'])
-    
-    # 5. Таблица bonus_transactions
-    migrate_table('bonus_transactions', 
-                 ['id', 'agent_id', 'transaction_type', 'amount', 
-                  'description', 'related_demand_id', 'created_at'])
-    
-    # 6. Таблица maintenance_history
-    migrate_table('maintenance_history', 
-                 ['id', 'agent_id', 'work_id', 'performed_date', 'mileage', 
-                  'source', 'demand_id', 'notes', 'created_at'])
-    
-    # 7. Таблица maintenance_settings
-    migrate_table('maintenance_settings', 
-                 ['agent_id', 'work_id', 'custom_mileage_interval', 
-                  'custom_time_interval', 'is_active'])
-    
-    # 8. Таблица maintenance_service_mapping
-    migrate_table('maintenance_service_mapping', 
-                 ['moysklad_service_name', 'work_id', 'is_active'])
-    
-    # 9. Таблица user_achievements
-    migrate_table('user_achievements', 
-                 ['user_id', 'achievement_id', 'unlocked_at'])
-
-    print("\n✅ Миграция данных успешно завершена")
-    
-except Exception as e:
-    print(f"\n❌ Неожиданная ошибка при миграции данных: {e}")
-finally:
-    # Закрываем соединения
-    sqlite_conn.close()
-    pg_conn.close()
-    print("🔄 Соединения с базами данных закрыты")
+        sqlite_conn.close()
+        pg_conn.close()
+
+
+def _normalize(value, temporal: bool) -> str:
+    """Приводит значение к общему виду для сравнения SQLite и PostgreSQL"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if temporal:
+        # SQLite хранит даты строками, PostgreSQL возвращает datetime/date
+        return str(value).replace('T', ' ')[:19]
+    return str(value)
+
+
+def table_checksum(cursor, table_name, columns, temporal_columns):
+    """
+    Считает количество строк и контрольную сумму таблицы
+
+    Сумма не зависит от порядка строк: это сумма хешей строк по модулю 2^64.
+    """
+    temporal_flags = [col in temporal_columns for col in columns]
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table_name}")
+
+    count = 0
+    checksum = 0
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            line = '\x1f'.join(_normalize(v, t) for v, t in zip(row, temporal_flags))
+            checksum = (checksum + int(hashlib.md5(line.encode()).hexdigest()[:16], 16)) % 2 ** 64
+            count += 1
+    return count, checksum
+
+
+def verify_table(table_name, columns, temporal_columns):
+    """Сверяет количество строк и контрольные суммы таблицы"""
+    sqlite_conn = connect_sqlite()
+    pg_conn = connect_postgres()
+    try:
+        sqlite_count, sqlite_sum = table_checksum(sqlite_conn.cursor(), table_name, columns, temporal_columns)
+        with pg_conn.cursor() as cursor:
+            pg_count, pg_sum = table_checksum(cursor, table_name, columns, temporal_columns)
+        ok = sqlite_count == pg_count and sqlite_sum == pg_sum
+        icon = "✅" if ok else "❌"
+        print(f"{icon} {table_name}: SQLite {sqlite_count} / PostgreSQL {pg_count} записей, "
+              f"контрольная сумма {'совпадает' if sqlite_sum == pg_sum else 'НЕ совпадает'}")
+        return ok
+    finally:
+        sqlite_conn.close()
+        pg_conn.close()
+
+
+def run_migration():
+    """Переносит все таблицы волнами, параллельно внутри волны"""
+    total = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for i, wave in enumerate(TABLE_WAVES, 1):
+            print(f"\n📋 Волна {i}: {', '.join(wave)}")
+            futures = [
+                executor.submit(migrate_table, name, columns)
+                for name, (columns, _, _) in wave.items()
+            ]
+            # result() пробрасывает ошибку: следующая волна зависит от текущей
+            total += sum(f.result() for f in futures)
+    return total
+
+
+def run_verification():
+    """Сверяет все таблицы параллельно"""
+    print("\n🔍 Сверка данных...")
+    tables = [(name, spec) for wave in TABLE_WAVES for name, spec in wave.items()]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(
+            lambda item: verify_table(item[0], item[1][0], item[1][2]),
+            tables
+        ))
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграция данных из SQLite в PostgreSQL")
+    parser.add_argument("--fresh", action="store_true", help="очистить целевые таблицы и начать заново")
+    parser.add_argument("--verify", action="store_true", help="только сверить данные")
+    args = parser.parse_args()
+
+    # Проверка существования SQLite базы данных
+    if not os.path.exists(SQLITE_DB_PATH):
+        print(f"❌ SQLite база данных не найдена по пути: {SQLITE_DB_PATH}")
+        sys.exit(1)
+
+    # Проверка подключения к PostgreSQL
+    try:
+        pg_conn = connect_postgres()
+        print(f"✅ Успешное подключение к PostgreSQL ({POSTGRES_HOST}:{POSTGRES_PORT})")
+    except Exception as e:
+        print(f"❌ Ошибка подключения к PostgreSQL: {e}")
+        sys.exit(1)
+
+    try:
+        init_progress_table(pg_conn)
+        if args.fresh:
+            reset_migration(pg_conn)
+    finally:
+        pg_conn.close()
+
+    started = time.perf_counter()
+    if not args.verify:
+        try:
+            total = run_migration()
+        except Exception as e:
+            print(f"\n❌ Миграция прервана: {e}")
+            print("ℹ️ Повторный запуск продолжит перенос с места остановки")
+            sys.exit(1)
+        print(f"\n✅ Перенесено записей: {total} за {time.perf_counter() - started:.2f} с")
+
+    if run_verification():
+        print("\n✅ Миграция данных успешно завершена")
+    else:
+        print("\n❌ Данные в SQLite и PostgreSQL расходятся")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,10 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from bot.moysklad import _get
     from bot.config import HEADERS
+    from bot.db import init_db, refresh_shipment_rollup
+    from bot.maintenance import (
+        init_maintenance_tables, extract_mileage, save_mileage_readings, refresh_maintenance_due
+    )
 except ImportError as e:
     print(f"Ошибка импорта: {e}")
     sys.exit(1)
@@ -102,6 +106,11 @@ def save_demand_to_db(demand):
             0,  # positions_count - можно добавить позже если нужно
             datetime.now().isoformat()
         ))
+        if save_mileage_readings(
+            [(agent_id, demand.get('id'), demand.get('moment'), extract_mileage(demand))],
+            connection=conn
+        ):
+            refresh_maintenance_due(agent_id, conn)
         
         conn.commit()
         return True
@@ -123,6 +132,9 @@ def sync_month_shipments(year, month):
     # Получаем все отгрузки за месяц
     demands = get_all_demands_for_month(year, month)
     
+    init_db()
+    init_maintenance_tables()
+    
     if not demands:
         print("❌ Не найдено отгрузок для синхронизации")
         return 0, 0
@@ -142,6 +154,9 @@ def sync_month_shipments(year, month):
         else:
             failed_count += 1
     
+    # Пересчитываем дневные сводки выручки и визитов за месяц
+    refresh_shipment_rollup([demand.get('moment') for demand in demands])
+    
     # Проверяем итоговые данные в базе
     conn = sqlite3.connect("loyalty.db")
     result = conn.execute("""
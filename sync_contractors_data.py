@@ -17,6 +17,10 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from bot.moysklad import _get
     from bot.config import HEADERS
+    from bot.db import init_db, refresh_shipment_rollup
+    from bot.maintenance import (
+        init_maintenance_tables, extract_mileage, save_mileage_readings, refresh_maintenance_due_for
+    )
 except ImportError as e:
     print(f"Ошибка импорта: {e}")
     print("Убедитесь, что запускаете скрипт из директории проекта")
@@ -100,6 +104,7 @@ def get_contractor_shipments(agent_id: str, limit: int = 1000) -> List[Dict]:
                 'sum': demand.get('sum', 0),
                 'state_name': demand.get('state', {}).get('name', ''),
                 'positions_count': len(demand.get('positions', {}).get('rows', [])),
+                'mileage': extract_mileage(demand),
                 'created_at': datetime.now().isoformat()
             })
         
@@ -147,6 +152,10 @@ def create_tables():
     
     conn.commit()
     conn.close()
+    
+    # Сводки аналитики, история пробега и сроки ТО
+    init_db()
+    init_maintenance_tables()
 
 
 def save_contractor_data(contractor_data: Dict):
@@ -198,7 +207,12 @@ def save_shipments(shipments: List[Dict]):
             shipment['created_at']
         ))
     
-    conn.commit()
+    save_mileage_readings(
+        [(s['agent_id'], s['demand_id'], s['moment'], s.get('mileage', 0)) for s in shipments],
+        connection=conn
+    )
+    refresh_maintenance_due_for([s['agent_id'] for s in shipments if s.get('mileage')], connection=conn)
+    refresh_shipment_rollup([s['moment'] for s in shipments], connection=conn)
     conn.close()
 
 
@@ -15,6 +15,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from bot.moysklad import _get
     from bot.config import HEADERS
+    from bot.db import init_db, refresh_shipment_rollup
 except ImportError as e:
     print(f"Ошибка импорта: {e}")
     sys.exit(1)
@@ -126,6 +127,8 @@ def sync_month_shipments(year, month):
         print("❌ Не найдено отгрузок для синхронизации")
         return
     
+    init_db()
+    
     # Сохраняем в базу
     saved_count = 0
     failed_count = 0
@@ -141,6 +144,9 @@ def sync_month_shipments(year, month):
         else:
             failed_count += 1
     
+    # Пересчитываем дневные сводки выручки и визитов за месяц
+    refresh_shipment_rollup([demand.get('moment') for demand in demands])
+    
     # Итоговый отчет
     print("\n" + "=" * 50)
     print("ИТОГОВЫЙ ОТЧЕТ СИНХРОНИЗАЦИИ:")
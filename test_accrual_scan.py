@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки сканера начислений без МойСклад и PostgreSQL
+API и база подменяются словарями в памяти
+"""
+
+import sys
+import os
+import asyncio
+from datetime import datetime, timedelta
+from contextlib import ExitStack
+from unittest.mock import AsyncMock, patch
+
+# Добавляем путь к проекту
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bot import accrual
+from bot.accrual import AccrualPipeline, AccrualResult, BACKFILL_EVENT_TYPES, LIVE_CURSOR, demand_agent_id
+
+T0 = datetime(2025, 3, 1, 10, 0, 0)
+
+
+def _fmt(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d %H:%M:%S.000")
+
+
+class FakeMoySklad:
+    """Отгрузки в памяти с фильтрами fetch_demands_page"""
+
+    def __init__(self):
+        self.demands = {}
+
+    def put(self, demand_id: str, moment: datetime, updated: datetime, state: str = "Отгружен"):
+        self.demands[demand_id] = {
+            "id": demand_id,
+            "moment": _fmt(moment),
+            "updated": _fmt(updated),
+            "state": state,
+            "sum": 100000,
+            "agent": {"meta": {"href": f"https://api/entity/counterparty/agent-{demand_id}"}},
+        }
+
+    def fetch_demands_page(self, moment_from, moment_to=None, limit=100, offset=0,
+                           state="Отгружен", field="moment"):
+        rows = [
+            d for d in self.demands.values()
+            if (state is None or d["state"] == state)
+            and d[field][:19] >= moment_from
+            and (moment_to is None or d[field][:19] <= moment_to)
+        ]
+        rows.sort(key=lambda d: d[field])
+        return rows[offset:offset + limit]
+
+
+class FakeStore:
+    """accrual_log и курсоры сканера в памяти"""
+
+    def __init__(self):
+        self.accrued = []
+        self.cursors = {}
+
+    def apply_accrual(self, demand, notify=True, rules=None):
+        if demand["id"] in self.accrued:
+            return None
+        self.accrued.append(demand["id"])
+        return AccrualResult(demand, demand_agent_id(demand), 1000, 1)
+
+    def filter_processed_demands(self, demand_ids):
+        return {demand_id for demand_id in demand_ids if demand_id in self.accrued}
+
+
+class FakeSession:
+    """Соединение воркера начислений без PostgreSQL"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def close(self):
+        pass
+
+
+def _patched(api: FakeMoySklad, store: FakeStore):
+    """Подменяет API и базу в модуле начислений"""
+    return (
+        patch.object(accrual, "fetch_demands_page", api.fetch_demands_page),
+        patch.object(accrual, "apply_accrual", store.apply_accrual),
+        patch.object(accrual, "filter_processed_demands", store.filter_processed_demands),
+        patch.object(accrual, "load_recent_processed_demands", lambda: set()),
+        patch.object(accrual, "get_accrual_cursor", lambda name: store.cursors.get(name)),
+        patch.object(accrual, "set_accrual_cursor", lambda name, value: store.cursors.__setitem__(name, value)),
+        patch.object(accrual, "WorkerConnection", FakeSession),
+        patch.object(accrual, "get_rules", lambda: None),
+    )
+
+
+def _pipeline() -> AccrualPipeline:
+    pipeline = AccrualPipeline(notify=False)
+    pipeline.dispatcher.run = AsyncMock()
+    pipeline.dispatcher.dispatch_once = AsyncMock(return_value=0)
+    return pipeline
+
+
+async def _run_passes(api: FakeMoySklad, store: FakeStore, steps) -> list:
+    """Проходы живого сканера; steps — функции, меняющие API перед каждым проходом"""
+    with ExitStack() as stack:
+        for patcher in _patched(api, store):
+            stack.enter_context(patcher)
+        pipeline = _pipeline()
+        tasks = pipeline._start_workers()
+        try:
+            cursor = T0 - timedelta(hours=1)
+            for step in steps:
+                step()
+                cursor = await pipeline.live_pass(cursor)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return store.accrued
+
+
+def test_late_shipped_demand():
+    """Отгрузка, получившая статус «Отгружен» через несколько часов после moment, начисляется"""
+    print("\n🧪 Отгрузка со статусом, выставленным позже moment...")
+    api, store = FakeMoySklad(), FakeStore()
+
+    def first_pass():
+        # late создана в T0, но ещё не отгружена; early отгружена сразу
+        api.put("late", T0, T0, state="Новый")
+        api.put("early", T0 + timedelta(minutes=1), T0 + timedelta(minutes=1))
+
+    def second_pass():
+        # Через 3 часа late переводят в «Отгружен», появляется новая отгрузка
+        api.put("late", T0, T0 + timedelta(hours=3))
+        api.put("next", T0 + timedelta(hours=2), T0 + timedelta(hours=2))
+
+    def third_pass():
+        # Правка уже начисленной отгрузки не приводит к повторному начислению
+        api.put("early", T0 + timedelta(minutes=1), T0 + timedelta(hours=4))
+
+    accrued = asyncio.run(_run_passes(api, store, [first_pass, second_pass, third_pass]))
+    print(f"   Начислено: {accrued}, курсор: {store.cursors.get(LIVE_CURSOR)}")
+    assert accrued == ["early", "next", "late"], accrued
+    assert store.cursors[LIVE_CURSOR] == T0 + timedelta(hours=4)
+    print("✅ Отгрузка с поздним статусом начислена, повторных начислений нет")
+
+
+def test_backfill_cursor_per_range():
+    """Курсор backfill хранится отдельно для каждого диапазона"""
+    print("\n🧪 Курсоры backfill разных диапазонов...")
+    api, store = FakeMoySklad(), FakeStore()
+    for day in range(1, 6):
+        moment = T0 + timedelta(days=day)
+        api.put(f"d{day}", moment, moment)
+
+    pipelines = []
+
+    async def run(date_from, date_to, restart=False):
+        with ExitStack() as stack:
+            for patcher in _patched(api, store):
+                stack.enter_context(patcher)
+            pipelines.append(_pipeline())
+            return await pipelines[-1].backfill(date_from, date_to, throttle=0, restart=restart)
+
+    # Первый диапазон — дни 3–4, затем более широкий 1–5: он не должен
+    # начинать с курсора первого и пропускать дни 1–2
+    asyncio.run(run(T0 + timedelta(days=3), T0 + timedelta(days=4, hours=23)))
+    assert store.accrued == ["d3", "d4"], store.accrued
+    # Outbox разбирается только по своим отгрузкам и событиям без уведомлений,
+    # общий диспетчер не запускается
+    dispatch_once = pipelines[-1].dispatcher.dispatch_once
+    dispatch_once.assert_awaited_once()
+    demand_ids, event_types = dispatch_once.await_args.args
+    assert sorted(demand_ids) == ["d3", "d4"] and event_types == BACKFILL_EVENT_TYPES, dispatch_once.await_args
+    pipelines[-1].dispatcher.run.assert_not_called()
+    asyncio.run(run(T0, T0 + timedelta(days=5, hours=23)))
+    assert sorted(store.accrued) == ["d1", "d2", "d3", "d4", "d5"], store.accrued
+
+    # Повтор завершённого диапазона продолжает с его конца, --restart проходит заново
+    seen = asyncio.run(run(T0 + timedelta(days=3), T0 + timedelta(days=4, hours=23)))
+    seen_restart = asyncio.run(run(T0 + timedelta(days=3), T0 + timedelta(days=4, hours=23), restart=True))
+    print(f"   Просмотрено при продолжении: {seen}, при перезапуске: {seen_restart}")
+    assert seen == 1 and seen_restart == 2, (seen, seen_restart)
+    print("✅ Диапазоны backfill не мешают друг другу")
+
+
+def main():
+    """Основная функция тестирования"""
+    print("🚀 Запуск тестов сканера начислений")
+    print("=" * 50)
+    tests = [
+        ("Поздняя смена статуса", test_late_shipped_demand),
+        ("Курсоры backfill", test_backfill_cursor_per_range),
+    ]
+    passed = 0
+    for test_name, test_func in tests:
+        try:
+            test_func()
+            print(f"✅ {test_name}: ПРОЙДЕН")
+            passed += 1
+        except AssertionError as e:
+            print(f"❌ {test_name}: ПРОВАЛЕН - {e}")
+    print(f"\n{'=' * 50}")
+    print(f"Пройдено тестов: {passed}/{len(tests)}")
+    return passed == len(tests)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -25,6 +25,10 @@ except ImportError as e:
     print(f"❌ Ошибка импорта: {e}")
     sys.exit(1)
 
+def setup_module(module):
+    """Таблицы модуля ТО создаёт init_maintenance_tables, как при запуске бота"""
+    init_maintenance_tables()
+
 def test_cache_operations():
     """Тестирует базовые операции с кэшем"""
     print("\n🧪 Тестирование базовых операций с кэшем...")